@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Compare face detection with a fixed number of upsamplings
+(face_recognition.face_locations) against adaptive upsampling
+(face_recognition.adaptive_face_locations) for the same smallest face size.
+
+Usage:
+    python benchmarks/adaptive_upsampling.py path/to/images --min-face-size 40
+
+The fixed setting upsamples as often as --min-face-size needs (40 pixels is
+number_of_times_to_upsample=1). Recall is the fraction of the faces the
+fixed setting finds that the other modes also find (a box overlapping by
+at least half its union); a native scale pass is included to show what
+upsampling buys at all.
+"""
+from __future__ import print_function
+import argparse
+import math
+import os
+import time
+
+import face_recognition
+from face_recognition.api import DETECTOR_MIN_FACE_SIZE
+
+
+def _iou(a, b):
+    top, right, bottom, left = max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = (a[1] - a[3]) * (a[2] - a[0]) + (b[1] - b[3]) * (b[2] - b[0]) - intersection
+    return intersection / float(union) if union > 0 else 0.0
+
+
+def _found(reference, locations):
+    return sum(1 for box in reference if any(_iou(box, other) >= 0.5 for other in locations))
+
+
+def run(images, detect):
+    started = time.time()
+    results = [detect(image) for image in images]
+    return time.time() - started, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", help="folder of .jpg/.png images to run detection on")
+    parser.add_argument("--min-face-size", type=int, default=40, help="smallest face to look for, in pixels")
+    parser.add_argument("--min-detail", type=float, default=3.0, help="adaptive_face_locations min_detail")
+    parser.add_argument("--limit", type=int, default=64, help="maximum number of images to load")
+    args = parser.parse_args()
+
+    files = sorted(
+        os.path.join(args.folder, f) for f in os.listdir(args.folder)
+        if os.path.splitext(f)[1].lower() in (".jpg", ".jpeg", ".png")
+    )[:args.limit]
+    images = [face_recognition.load_image_file(f) for f in files]
+    upsample = max(0, int(math.ceil(math.log2(DETECTOR_MIN_FACE_SIZE / float(args.min_face_size)))))
+    print("{} images, smallest face {} pixels (upsample {})".format(len(images), args.min_face_size, upsample))
+
+    _, reference = run(images, lambda image: face_recognition.face_locations(image, upsample))
+    total = sum(len(r) for r in reference)
+
+    print("{:<10} {:>10} {:>12} {:>8} {:>8}".format("mode", "seconds", "ms/image", "faces", "recall"))
+    for mode, detect in (
+        ("fixed", lambda image: face_recognition.face_locations(image, upsample)),
+        ("adaptive", lambda image: face_recognition.adaptive_face_locations(
+            image, args.min_face_size, min_detail=args.min_detail)),
+        ("native", lambda image: face_recognition.face_locations(image, 0)),
+    ):
+        elapsed, results = run(images, detect)
+        found = sum(_found(expected, locations) for expected, locations in zip(reference, results))
+        recall = found / float(total) if total else 1.0
+        print("{:<10} {:>10.2f} {:>12.1f} {:>8} {:>8.3f}".format(
+            mode, elapsed, 1000 * elapsed / max(len(images), 1), sum(len(r) for r in results), recall))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Compare gallery search over float64 encodings with search over compact
+float16 and int8 copies (face_recognition.CompactEncodings), with and
+without re-ranking the best candidates against the exact encodings.
+
+Usage:
+    python benchmarks/compact_search.py --rows 1000000 --probes 50
+    python benchmarks/compact_search.py --encodings known_people_cache.npz
+
+Without --encodings the gallery is synthetic: one random identity per row,
+scaled like real face encodings, and each probe is a noisy copy of a
+gallery row, so there is a true nearest neighbour to agree on. With
+--encodings, rows are read from the 'encodings' array of an .npz file (for
+example a cache written by face_recognition_cache) and probes are noisy
+copies of them.
+
+Agreement is the fraction of probes whose top 1 (and whole top k) matches
+the float64 search.
+"""
+from __future__ import print_function
+import argparse
+import time
+
+import numpy as np
+
+import face_recognition
+
+
+def synthetic_gallery(rng, rows):
+    # Real encodings have a norm around 1 with components of a few hundredths
+    gallery = rng.normal(scale=0.09, size=(rows, 128))
+    gallery += rng.normal(scale=0.03, size=128)
+    return gallery
+
+
+def timed(search, probes):
+    started = time.time()
+    results = [search(probe) for probe in probes]
+    return results, (time.time() - started) / len(probes) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000, help="synthetic gallery size")
+    parser.add_argument("--encodings", default=None, help="load the gallery from the 'encodings' array of an .npz file")
+    parser.add_argument("--probes", type=int, default=50, help="searches to average over")
+    parser.add_argument("--k", type=int, default=10, help="neighbours to return per search")
+    parser.add_argument("--noise", type=float, default=0.03, help="standard deviation of the noise added to each probe")
+    parser.add_argument("--candidates", type=int, default=None, help="candidates to re-rank (default: max(4k, 32))")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.encodings:
+        gallery = np.load(args.encodings)["encodings"].astype(np.float64)
+    else:
+        gallery = synthetic_gallery(rng, args.rows)
+    targets = rng.integers(0, len(gallery), size=args.probes)
+    probes = gallery[targets] + rng.normal(scale=args.noise, size=(args.probes, 128))
+    print("{} rows, {} probes, k={}".format(len(gallery), args.probes, args.k))
+
+    reference, baseline = timed(lambda probe: face_recognition.search_gallery(gallery, probe, args.k)[0], probes)
+
+    print("{:>16} {:>10} {:>10} {:>9} {:>9} {:>9}".format("storage", "MB", "ms/search", "speedup", "top-1", "top-k"))
+    print("{:>16} {:>10.1f} {:>10.1f} {:>9.2f} {:>9.3f} {:>9.3f}".format(
+        "float64", gallery.nbytes / 1e6, baseline, 1.0, 1.0, 1.0))
+
+    for dtype in ("float16", "int8"):
+        compact = face_recognition.CompactEncodings(gallery, dtype)
+        for rerank in (False, True):
+            exact = gallery if rerank else None
+            results, elapsed = timed(
+                lambda probe: face_recognition.search_compact(compact, probe, args.k, exact, args.candidates)[0],
+                probes,
+            )
+            top1 = np.mean([a[0] == b[0] for a, b in zip(results, reference)])
+            topk = np.mean([np.array_equal(np.sort(a), np.sort(b)) for a, b in zip(results, reference)])
+            label = dtype + (" + re-rank" if rerank else "")
+            print("{:>16} {:>10.1f} {:>10.1f} {:>9.2f} {:>9.3f} {:>9.3f}".format(
+                label, compact.nbytes / 1e6, elapsed, baseline / elapsed, top1, topk))
+
+
+if __name__ == "__main__":
+    main()
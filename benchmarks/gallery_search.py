@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Measure how exact gallery search scales with the number of shards searched
+in parallel by face_recognition.search_gallery.
+
+Usage:
+    python benchmarks/gallery_search.py --rows 2000000 --probes 20
+
+The gallery is random 128-d vectors, which is all the search cost depends on.
+"""
+from __future__ import print_function
+import argparse
+import os
+import time
+
+import numpy as np
+
+import face_recognition
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000, help="gallery size")
+    parser.add_argument("--probes", type=int, default=20, help="searches to average over")
+    parser.add_argument("--k", type=int, default=10, help="neighbours to return per search")
+    parser.add_argument("--max-shards", type=int, default=os.cpu_count(), help="largest shard count to try")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    gallery = rng.normal(size=(args.rows, 128))
+    probes = rng.normal(size=(args.probes, 128))
+    print("{} rows, {} probes, k={}".format(args.rows, args.probes, args.k))
+
+    shard_counts = sorted(set([1, 2, 4, 8, 16, 32, 64] + [args.max_shards]))
+    shard_counts = [shards for shards in shard_counts if shards <= args.max_shards]
+
+    reference = [face_recognition.search_gallery(gallery, probe, args.k, shards=1)[0] for probe in probes]
+
+    print("{:>7} {:>12} {:>9} {:>8}".format("shards", "ms/search", "speedup", "exact"))
+    baseline = None
+    for shards in shard_counts:
+        # Warm up the thread pool
+        face_recognition.search_gallery(gallery, probes[0], args.k, shards=shards)
+
+        started = time.time()
+        results = [face_recognition.search_gallery(gallery, probe, args.k, shards=shards)[0] for probe in probes]
+        elapsed = (time.time() - started) / args.probes * 1000
+
+        baseline = baseline or elapsed
+        exact = all(np.array_equal(np.sort(a), np.sort(b)) for a, b in zip(results, reference))
+        print("{:>7} {:>12.1f} {:>9.2f} {:>8}".format(shards, elapsed, baseline / elapsed, str(exact)))
+
+
+if __name__ == "__main__":
+    main()
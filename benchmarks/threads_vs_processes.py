@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Compare face detection + encoding throughput and memory when parallelized
+with threads (face_recognition.map_faces) versus a process pool.
+
+Usage:
+    python benchmarks/threads_vs_processes.py path/to/images --workers 4
+
+Memory is reported as resident set size in MB. For the process pool the
+total is the parent plus every worker, since each worker loads its own
+copy of the dlib models.
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import time
+
+import face_recognition
+
+
+def _rss_mb(pid="self"):
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+def _detect_and_encode(image):
+    locations = face_recognition.face_locations(image)
+    return face_recognition.face_encodings(image, locations)
+
+
+def _worker_pid(_):
+    return os.getpid()
+
+
+def run_threads(images, workers):
+    started = time.time()
+    results = face_recognition.map_faces(images, _detect_and_encode, workers)
+    elapsed = time.time() - started
+    return elapsed, sum(len(r) for r in results), _rss_mb()
+
+
+def run_processes(images, workers):
+    context = multiprocessing
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+
+    pool = context.Pool(processes=workers)
+    try:
+        # Warm the workers up so loading the models is not part of the timing
+        pids = set(pool.map(_worker_pid, range(workers * 4), chunksize=1))
+        started = time.time()
+        results = pool.map(_detect_and_encode, images, chunksize=1)
+        elapsed = time.time() - started
+        memory = _rss_mb() + sum(_rss_mb(pid) for pid in pids)
+    finally:
+        pool.close()
+        pool.join()
+    return elapsed, sum(len(r) for r in results), memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", help="folder of .jpg/.png images to run detection and encoding on")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="threads / processes to use")
+    parser.add_argument("--limit", type=int, default=64, help="maximum number of images to load")
+    args = parser.parse_args()
+
+    files = sorted(
+        os.path.join(args.folder, f) for f in os.listdir(args.folder)
+        if os.path.splitext(f)[1].lower() in (".jpg", ".jpeg", ".png")
+    )[:args.limit]
+    images = [face_recognition.load_image_file(f) for f in files]
+    print("{} images, {} workers".format(len(images), args.workers))
+
+    print("{:<10} {:>10} {:>12} {:>8} {:>12}".format("mode", "seconds", "images/sec", "faces", "memory MB"))
+    for mode, runner, workers in (
+        ("serial", run_threads, 1),
+        ("threads", run_threads, args.workers),
+        ("processes", run_processes, args.workers),
+    ):
+        elapsed, faces, memory = runner(images, workers)
+        print("{:<10} {:>10.2f} {:>12.2f} {:>8} {:>12.1f}".format(mode, elapsed, len(images) / elapsed, faces, memory))
+
+
+if __name__ == "__main__":
+    main()
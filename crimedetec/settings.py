@@ -157,3 +157,76 @@ CORS_ALLOWED_ORIGINS = [
     "http://127.0.0.1:5173",
 ]
 CORS_EXPOSE_HEADERS = ["Content-Type", "X-CSRFToken"]
+
+# Face recognition
+# Threads used to detect and encode faces within one process (None uses every core)
+FACE_THREADS = None
+
+# Encoder settings used until a re-embedding job (the reembed command) switches the registry to others
+FACE_ENCODING_JITTERS = 1
+FACE_LANDMARK_MODEL = 'small'
+
+# Smallest face looked for in uploaded images, in pixels; only detailed parts of the image are upsampled to find faces
+# under 80 pixels
+FACE_DETECTION_MIN_SIZE = 40
+# Uploaded images with more pixels than this are searched in tiles on every core, which bounds detection memory
+FACE_TILED_DETECTION_PIXELS = 12000000
+
+# Detected faces are only encoded when their box is at least this many pixels on its shorter side, their aligned
+# chip at least this sharp (variance of the Laplacian) and the head turned at most this many degrees from the camera
+FACE_MIN_SIZE = 36
+FACE_MIN_SHARPNESS = 20.0
+FACE_MAX_YAW = 50.0
+
+# Memory-mapped gallery file shared by every worker process on the host, e.g. '/var/lib/vigilant/gallery.bin'
+# (None keeps one copy per process). POSIX only: Windows hosts always keep one copy per process.
+GALLERY_SHARED_PATH = None
+
+# Search a compact 'float16' or 'int8' copy of the gallery, re-ranking the best candidates exactly (None searches float64)
+GALLERY_SEARCH_DTYPE = None
+
+# Statuses kept in their own gallery partition and checked before the full registry
+GALLERY_WATCHLIST_STATUSES = ['Wanted']
+
+# Seconds long running streams and ingestion keep their gallery before refreshing it from the database
+GALLERY_REFRESH_SECONDS = 30
+
+# Stored unknown faces reported by the retroactive search run when a citizen is marked Wanted
+RETRO_SEARCH_LIMIT = 100
+RETRO_SEARCH_TOLERANCE = 0.5
+
+# Unknown faces join the nearest cluster within this distance; clusters whose centroids come this close are merged
+UNKNOWN_CLUSTER_TOLERANCE = 0.5
+UNKNOWN_CLUSTER_MERGE_DISTANCE = 0.4
+
+# A new citizen whose face is this close to an enrolled citizen's is rejected as a duplicate
+ENROLLMENT_DUPLICATE_THRESHOLD = 0.4
+
+# Packed files of aligned face chips cut at detection and enrollment time, kept out of the public media folder
+FACE_CHIP_DIR = os.path.join(BASE_DIR, 'face_chips')
+
+# Thumbnail sizes (longest side in pixels) served by api/thumbnails; other sizes are rounded up to one of these
+THUMBNAIL_SIZES = [64, 128, 256, 512]
+# Size of the thumbnails linked from list APIs
+THUMBNAIL_LIST_SIZE = 128
+# Rendered thumbnails, keyed by source file and size
+THUMBNAIL_CACHE_DIR = os.path.join(BASE_DIR, 'thumbnail_cache')
+
+# Refuse media files, thumbnails and face chips to clients that are not logged in
+MEDIA_REQUIRE_LOGIN = False
+# Leave media file bodies to the front-end server: None, 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx)
+MEDIA_SENDFILE = None
+# For 'x-accel-redirect': directory -> internal nginx location serving it
+MEDIA_ACCEL_REDIRECT_LOCATIONS = {
+    MEDIA_ROOT: '/protected/media/',
+    THUMBNAIL_CACHE_DIR: '/protected/thumbnails/',
+}
+
+# Process pool size for bulk enrollment (None uses every core)
+BULK_ENROLL_WORKERS = None
+
+# Process pool size for uploaded video jobs, kept running between jobs (half the cores, 1 runs inline)
+VIDEO_DETECTION_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# Latest per-source stats written by the ingest_streams command, served by api/ingest-stats
+INGEST_STATS_FILE = os.path.join(BASE_DIR, 'ingest_stats.json')
@@ -4,4 +4,4 @@ __author__ = """Adam Geitgey"""
 __email__ = 'ageitgey@gmail.com'
 __version__ = '1.2.3'
 
-from .api import load_image_file, face_locations, batch_face_locations, face_landmarks, face_encodings, compare_faces, face_distance
+from .api import load_image_file, face_locations, adaptive_face_locations, tiled_face_locations, non_max_suppression, batch_face_locations, face_landmarks, face_encodings, face_chips, face_quality, FaceQuality, chip_encodings, chip_face_location, encoder_version, compare_faces, face_distance, map_faces, search_gallery, search_compact, CompactEncodings
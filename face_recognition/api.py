@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import math
+import os
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 import PIL.Image
 import dlib
 import numpy as np
@@ -28,6 +36,26 @@ cnn_face_detector = dlib.cnn_face_detection_model_v1(cnn_face_detection_model)
 face_recognition_model = face_recognition_models.face_recognition_model_location()
 face_encoder = dlib.face_recognition_model_v1(face_recognition_model)
 
+# dlib's face detectors keep scratch buffers between calls and crash when one is run from several threads at once.
+# HOG detectors are handed out one per running call from a pool that grows to the number of concurrent callers
+# (making one takes about half a second, so they are kept); the larger CNN model is shared behind a lock. The
+# landmark and encoder models are safe to share.
+_idle_face_detectors = queue.LifoQueue()
+_idle_face_detectors.put(face_detector)
+_cnn_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _hog_detector():
+    try:
+        detector = _idle_face_detectors.get_nowait()
+    except queue.Empty:
+        detector = dlib.get_frontal_face_detector()
+    try:
+        yield detector
+    finally:
+        _idle_face_detectors.put(detector)
+
 
 def _rect_to_css(rect):
     """
@@ -100,9 +128,11 @@ def _raw_face_locations(img, number_of_times_to_upsample=1, model="hog"):
     :return: A list of dlib 'rect' objects of found face locations
     """
     if model == "cnn":
-        return cnn_face_detector(img, number_of_times_to_upsample)
+        with _cnn_lock:
+            return cnn_face_detector(img, number_of_times_to_upsample)
     else:
-        return face_detector(img, number_of_times_to_upsample)
+        with _hog_detector() as detector:
+            return detector(img, number_of_times_to_upsample)
 
 
 def face_locations(img, number_of_times_to_upsample=1, model="hog"):
@@ -121,6 +151,199 @@ def face_locations(img, number_of_times_to_upsample=1, model="hog"):
         return [_trim_css_to_bounds(_rect_to_css(face), img.shape) for face in _raw_face_locations(img, number_of_times_to_upsample, model)]
 
 
+# Smallest face, in pixels, the detectors find without upsampling; each upsampling halves it
+DETECTOR_MIN_FACE_SIZE = 80
+
+
+def _upsample_for(min_face_size):
+    return max(0, int(math.ceil(math.log2(DETECTOR_MIN_FACE_SIZE / float(min_face_size)))))
+
+
+def _face_locations_with_scores(img, number_of_times_to_upsample=1, model="hog"):
+    if model == "cnn":
+        with _cnn_lock:
+            detections = cnn_face_detector(img, number_of_times_to_upsample)
+        return [_rect_to_css(face.rect) for face in detections], [face.confidence for face in detections]
+    with _hog_detector() as detector:
+        rects, scores, _ = detector.run(img, number_of_times_to_upsample, 0.0)
+    return [_rect_to_css(rect) for rect in rects], list(scores)
+
+
+def _box_iou(a, b):
+    top, right, bottom, left = max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = (a[1] - a[3]) * (a[2] - a[0]) + (b[1] - b[3]) * (b[2] - b[0]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def non_max_suppression(face_locations, scores=None, overlap_threshold=0.3):
+    """
+    Merge duplicate detections of the same face, e.g. from overlapping tiles or from several passes at different
+    scales, keeping the most confident box of each group.
+
+    :param face_locations: A list of face locations in css (top, right, bottom, left) order
+    :param scores: Optional - a detection score for each location. Without scores, larger boxes win.
+    :param overlap_threshold: Boxes overlapping a kept box by more than this intersection over union are dropped.
+    :return: The kept face locations, most confident first
+    """
+    if scores is None:
+        scores = [(bottom - top) * (right - left) for top, right, bottom, left in face_locations]
+
+    kept = []
+    for index in sorted(range(len(face_locations)), key=lambda i: scores[i], reverse=True):
+        if all(_box_iou(face_locations[index], other) <= overlap_threshold for other in kept):
+            kept.append(face_locations[index])
+    return kept
+
+
+def _detail_map(img, step=4):
+    # Mean absolute gradient of a subsampled grey copy of the image: low over sky, walls and road, where
+    # there is nothing for a face detector to find
+    grey = img[::step, ::step].astype(np.float32)
+    if grey.ndim == 3:
+        grey = grey.mean(axis=2)
+    detail = np.zeros_like(grey)
+    detail[:, 1:] += np.abs(np.diff(grey, axis=1))
+    detail[1:, :] += np.abs(np.diff(grey, axis=0))
+    return detail
+
+
+def _tile_spans(length, tile_size, overlap):
+    # (start, end) of the fewest tiles of at most tile_size covering length, spread evenly, each overlapping the next by overlap
+    count = max(1, int(math.ceil((length - overlap) / float(tile_size - overlap))))
+    size = int(math.ceil((length + (count - 1) * overlap) / float(count)))
+    starts = [min(i * (size - overlap), length - size) for i in range(count)] if count > 1 else [0]
+    return [(start, min(start + size, length)) for start in starts]
+
+
+def _search_regions(img, tile_size, overlap, min_detail, step=4):
+    # Tiles worth searching again, merged into one region per run of neighbouring tiles in a row, or the whole
+    # image when every tile is, so overlapping tiles are not searched twice where it can be helped
+    height, width = img.shape[:2]
+    rows, columns = _tile_spans(height, tile_size, overlap), _tile_spans(width, tile_size, overlap)
+    detail = _detail_map(img, step) if min_detail else None
+
+    def detailed(top, bottom, left, right):
+        if detail is None:
+            return True
+        region = detail[top // step:max(bottom // step, top // step + 1), left // step:max(right // step, left // step + 1)]
+        return region.mean() >= min_detail
+
+    regions = []
+    for top, bottom in rows:
+        run = None
+        for left, right in columns:
+            if not detailed(top, bottom, left, right):
+                run = None
+            elif run is None:
+                run = [top, right, bottom, left]
+                regions.append(run)
+            else:
+                run[1] = right
+
+    if len(regions) == len(rows) and all(region[3] == 0 and region[1] == width for region in regions):
+        return [(0, width, height, 0)]
+    return [tuple(region) for region in regions]
+
+
+def adaptive_face_locations(img, min_face_size=40, model="hog", tile_size=480, min_detail=3.0):
+    """
+    Returns an array of bounding boxes of human faces in a image, upsampling only where small faces may be.
+
+    Upsampling the whole image to find small faces multiplies the detector's work by four for each time, even
+    when the faces are large or much of the image is sky, wall or road. Here the upsampling is chosen from
+    min_face_size, so faces of DETECTOR_MIN_FACE_SIZE pixels or more are looked for at native scale only.
+    Smaller faces are looked for in overlapping tiles of the image, skipping tiles with too little detail
+    to hold a face: the detailed tiles are searched upsampled, the whole image at native scale for faces
+    too large to fit a tile, and the two passes are merged with non_max_suppression. When every tile has
+    detail, this is a single upsampled pass over the whole image, like face_locations.
+
+    :param img: An image (as a numpy array)
+    :param min_face_size: Smallest face to look for, in pixels. 40 finds what number_of_times_to_upsample=1 finds, 20 what 2
+                          finds, 80 or more what 0 finds.
+    :param model: Which face detection model to use, "hog" (default) or "cnn".
+    :param tile_size: Side of the tiles in pixels, before upsampling. Tiles overlap by DETECTOR_MIN_FACE_SIZE so a face
+                      smaller than that always lies whole within one tile.
+    :param min_detail: Tiles whose mean absolute grey level gradient is lower than this are not searched for small
+                       faces. 0 searches every tile.
+    :return: A list of tuples of found face locations in css (top, right, bottom, left) order
+    """
+    upsample = _upsample_for(min_face_size)
+    height, width = img.shape[:2]
+    regions = []
+    if upsample:
+        tile_size = max(tile_size, 2 * DETECTOR_MIN_FACE_SIZE)
+        regions = _search_regions(img, tile_size, DETECTOR_MIN_FACE_SIZE, min_detail)
+    if regions == [(0, width, height, 0)]:
+        return face_locations(img, upsample, model)
+
+    locations, scores = _face_locations_with_scores(img, 0, model)
+    for top, right, bottom, left in regions:
+        region = np.ascontiguousarray(img[top:bottom, left:right])
+        region_locations, region_scores = _face_locations_with_scores(region, upsample, model)
+        locations += [(t + top, r + left, b + top, l + left) for t, r, b, l in region_locations]
+        scores += region_scores
+
+    return [_trim_css_to_bounds(location, img.shape) for location in non_max_suppression(locations, scores)]
+
+
+def _half_size(img):
+    return np.asarray(PIL.Image.fromarray(img).reduce(2))
+
+
+def tiled_face_locations(img, min_face_size=40, model="hog", tile_size=1024, workers=None):
+    """
+    Returns an array of bounding boxes of human faces in a very large image, searching it tile by tile.
+
+    Upsampling a panorama or a high resolution still to find its small faces needs several times its size in
+    memory, and downscaling it loses them. This splits the image into overlapping tiles of tile_size pixels,
+    searches them in parallel with map_faces, maps the boxes back to the whole image and merges the
+    duplicates found where tiles overlap with non_max_suppression. Memory grows with tile_size and workers
+    rather than with the image.
+
+    Tiles overlap by twice DETECTOR_MIN_FACE_SIZE, so faces up to that size always lie whole within a tile.
+    Larger faces are found on copies of the image halved in size until it fits a single tile, each
+    searched at native scale in tiles the same way, which costs about a third more than the full size pass.
+
+    :param img: An image (as a numpy array)
+    :param min_face_size: Smallest face to look for, in pixels. 40 upsamples the full size tiles once, 20 twice, 80 or more not at all.
+    :param model: Which face detection model to use, "hog" (default) or "cnn". The cnn model searches one tile at a time.
+    :param tile_size: Side of the tiles in pixels, before upsampling.
+    :param workers: How many tiles to search at once, each on a HOG detector of its own. None uses one thread per CPU.
+    :return: A list of tuples of found face locations in css (top, right, bottom, left) order
+    """
+    upsample = _upsample_for(min_face_size)
+    overlap = 2 * DETECTOR_MIN_FACE_SIZE
+    tile_size = max(tile_size, 2 * overlap)
+
+    # (image, tile top, right, bottom, left, scale back to img) of every tile of every level
+    tiles = []
+    level, scale = img, 1
+    while True:
+        height, width = level.shape[:2]
+        for top, bottom in _tile_spans(height, tile_size, overlap):
+            for left, right in _tile_spans(width, tile_size, overlap):
+                tiles.append((level, top, right, bottom, left, scale))
+        if max(height, width) <= tile_size:
+            break
+        level, scale = _half_size(level), scale * 2
+
+    def search_tile(tile):
+        level, top, right, bottom, left, scale = tile
+        # Halved levels are only there for faces too large for the full size tiles, so they need no upsampling
+        locations, scores = _face_locations_with_scores(
+            np.ascontiguousarray(level[top:bottom, left:right]), upsample if scale == 1 else 0, model,
+        )
+        return [((t + top) * scale, (r + left) * scale, (b + top) * scale, (l + left) * scale) for t, r, b, l in locations], scores
+
+    locations, scores = [], []
+    for tile_locations, tile_scores in map_faces(tiles, search_tile, 1 if model == "cnn" else workers):
+        locations += tile_locations
+        scores += tile_scores
+
+    return [_trim_css_to_bounds(location, img.shape) for location in non_max_suppression(locations, scores)]
+
+
 def _raw_face_locations_batched(images, number_of_times_to_upsample=1, batch_size=128):
     """
     Returns an 2d array of dlib rects of human faces in a image using the cnn face detector
@@ -129,7 +352,8 @@ def _raw_face_locations_batched(images, number_of_times_to_upsample=1, batch_siz
     :param number_of_times_to_upsample: How many times to upsample the image looking for faces. Higher numbers find smaller faces.
     :return: A list of dlib 'rect' objects of found face locations
     """
-    return cnn_face_detector(images, number_of_times_to_upsample, batch_size=batch_size)
+    with _cnn_lock:
+        return cnn_face_detector(images, number_of_times_to_upsample, batch_size=batch_size)
 
 
 def batch_face_locations(images, number_of_times_to_upsample=1, batch_size=128):
@@ -200,19 +424,156 @@ def face_landmarks(face_image, face_locations=None, model="large"):
         raise ValueError("Invalid landmarks model type. Supported models are ['small', 'large'].")
 
 
-def face_encodings(face_image, known_face_locations=None, num_jitters=1):
+def face_encodings(face_image, known_face_locations=None, num_jitters=1, model="small"):
     """
     Given an image, return the 128-dimension face encoding for each face in the image.
 
     :param face_image: The image that contains one or more faces
     :param known_face_locations: Optional - the bounding boxes of each face if you already know them.
     :param num_jitters: How many times to re-sample the face when calculating encoding. Higher is more accurate, but slower (i.e. 100 is 100x slower)
+    :param model: Optional - which landmark model to align faces with. "small" (default) which only uses 5 points but is faster, or "large".
     :return: A list of 128-dimensional face encodings (one for each face in the image)
     """
-    raw_landmarks = _raw_face_landmarks(face_image, known_face_locations, model="small")
+    raw_landmarks = _raw_face_landmarks(face_image, known_face_locations, model)
     return [np.array(face_encoder.compute_face_descriptor(face_image, raw_landmark_set, num_jitters)) for raw_landmark_set in raw_landmarks]
 
 
+def face_chips(face_image, known_face_locations=None, model="small", size=150, padding=0.25):
+    """
+    Given an image, return the aligned face chip of each face: the crop face_encodings computes a face's
+    encoding from, rotated and scaled so the eyes and nose land in the same place in every chip.
+
+    chip_encodings gives the same encodings from the chips as face_encodings gives from the whole image, so
+    chips can be kept instead of the original image to encode a face again later.
+
+    :param face_image: The image that contains one or more faces
+    :param known_face_locations: Optional - the bounding boxes of each face if you already know them.
+    :param model: Optional - which landmark model to align faces with. "small" (default) or "large".
+    :param size: Width and height of each chip in pixels. The face encoder expects 150.
+    :param padding: How much of the surroundings to keep around the face, as a fraction of its size. The face encoder expects 0.25.
+    :return: A list of size x size x 3 uint8 arrays (one for each face in the image)
+    """
+    raw_landmarks = _raw_face_landmarks(face_image, known_face_locations, model)
+    return [dlib.get_face_chip(face_image, raw_landmark_set, size, padding) for raw_landmark_set in raw_landmarks]
+
+
+def chip_encodings(face_chips, num_jitters=1):
+    """
+    Given aligned 150x150 face chips from face_chips, return the 128-dimension face encoding of each.
+
+    :param face_chips: A list of chips as returned by face_chips
+    :param num_jitters: How many times to re-sample the face when calculating encoding. Higher is more accurate, but slower (i.e. 100 is 100x slower)
+    :return: A list of 128-dimensional face encodings (one for each chip)
+    """
+    return [np.array(face_encoder.compute_face_descriptor(chip, num_jitters)) for chip in face_chips]
+
+
+FaceQuality = namedtuple("FaceQuality", ["size", "sharpness", "yaw", "score"])
+FaceQuality.__doc__ = """
+How usable a face is for recognition, as measured by face_quality.
+
+size is the shorter side of the face's bounding box in pixels, sharpness the variance of the Laplacian
+over the face in its aligned chip (low when blurred or too small to have detail), yaw a rough estimate of
+how far the head is turned left or right in degrees (0 facing the camera), and score a summary of the
+three between 0 (unusable) and 1. sharpness and yaw are None for faces rejected on size alone.
+"""
+
+# Box size and sharpness past which a face no longer scores any better
+GOOD_FACE_SIZE = 80
+GOOD_FACE_SHARPNESS = 100.0
+
+
+def _sharpness(chip, padding=0.25):
+    margin, _, _, _ = chip_face_location(len(chip), padding)
+    face = chip[margin:len(chip) - margin, margin:len(chip) - margin].astype(np.float32).mean(axis=2)
+    laplacian = (face[:-2, 1:-1] + face[2:, 1:-1] + face[1:-1, :-2] + face[1:-1, 2:]) - 4 * face[1:-1, 1:-1]
+    return float(laplacian.var())
+
+
+def _yaw(landmarks):
+    points = [(p.x, p.y) for p in landmarks.parts()]
+    if len(points) == 5:
+        eye, other_eye, nose = np.mean(points[0:2], axis=0), np.mean(points[2:4], axis=0), np.array(points[4])
+    else:
+        eye, other_eye, nose = np.mean(points[36:42], axis=0), np.mean(points[42:48], axis=0), np.array(points[33])
+
+    # Where the nose falls between the eyes: halfway when facing the camera, towards one eye when turned
+    between = other_eye - eye
+    position = np.dot(nose - eye, between) / max(np.dot(between, between), 1e-6)
+    return math.degrees(math.asin(min(max(2 * position - 1, -1.0), 1.0)))
+
+
+def _quality_score(size, sharpness, yaw):
+    return round(
+        min(size / GOOD_FACE_SIZE, 1.0) * min(sharpness / GOOD_FACE_SHARPNESS, 1.0) * math.cos(math.radians(yaw)), 3
+    )
+
+
+def face_quality(face_image, known_face_locations=None, model="small", min_size=0, min_sharpness=0.0, max_yaw=90.0,
+                 size=150, padding=0.25):
+    """
+    Given an image, score each face's quality and return the aligned chips of the faces worth encoding.
+
+    Scoring costs a fraction of encoding: faces under min_size are rejected from their bounding box alone,
+    the rest are landmarked and aligned as face_chips does, and the chip's sharpness and the head's yaw are
+    measured from there. Passing only the returned chips to chip_encodings skips the encoder for tiny,
+    blurred and turned-away faces, which rarely match anyway.
+
+    :param face_image: The image that contains one or more faces
+    :param known_face_locations: Optional - the bounding boxes of each face if you already know them.
+    :param model: Optional - which landmark model to align faces with. "small" (default) or "large".
+    :param min_size: Faces whose bounding box is smaller than this many pixels on either side are rejected.
+    :param min_sharpness: Faces whose chip's sharpness is lower than this are rejected.
+    :param max_yaw: Faces turned further than this many degrees from the camera are rejected.
+    :param size: Width and height of each chip in pixels. The face encoder expects 150.
+    :param padding: How much of the surroundings to keep around the face, as a fraction of its size. The face encoder expects 0.25.
+    :return: A list of (chip, FaceQuality) tuples (one for each face in the image), where chip is None for rejected faces
+    """
+    if known_face_locations is None:
+        known_face_locations = [_trim_css_to_bounds(_rect_to_css(rect), face_image.shape) for rect in _raw_face_locations(face_image)]
+
+    results = []
+    for location in known_face_locations:
+        top, right, bottom, left = location
+        box_size = min(bottom - top, right - left)
+        if box_size < min_size:
+            results.append((None, FaceQuality(box_size, None, None, 0.0)))
+            continue
+
+        landmarks = _raw_face_landmarks(face_image, [location], model)[0]
+        chip = dlib.get_face_chip(face_image, landmarks, size, padding)
+        sharpness = _sharpness(chip, padding)
+        yaw = _yaw(landmarks)
+        quality = FaceQuality(box_size, sharpness, yaw, _quality_score(box_size, sharpness, yaw))
+        results.append((chip if sharpness >= min_sharpness and abs(yaw) <= max_yaw else None, quality))
+    return results
+
+
+def chip_face_location(size=150, padding=0.25):
+    """
+    Return the bounding box of the face inside a chip from face_chips, in css (top, right, bottom, left) order.
+
+    Passing it to face_encodings with a chip aligns the chip again, e.g. with another landmark model.
+    """
+    margin = int(round(size * padding / (1 + 2 * padding)))
+    return margin, size - margin, size - margin, margin
+
+
+def encoder_version(num_jitters=1, model="small"):
+    """
+    Name the encoder settings face_encodings computes encodings with.
+
+    Encodings are only comparable with encodings of the same version, so stored encodings should be tagged
+    with it and never compared across versions.
+
+    :param num_jitters: The num_jitters passed to face_encodings
+    :param model: The landmark model passed to face_encodings
+    :return: A short string such as "dlib_face_recognition_resnet_model_v1:small:j1"
+    """
+    encoder_name = os.path.splitext(os.path.basename(face_recognition_model))[0]
+    return "{}:{}:j{}".format(encoder_name, model, num_jitters)
+
+
 def compare_faces(known_face_encodings, face_encoding_to_check, tolerance=0.5):
     """
     Compare a list of face encodings against a candidate encoding to see if they match.
@@ -225,3 +586,211 @@ def compare_faces(known_face_encodings, face_encoding_to_check, tolerance=0.5):
     return list(face_distance(known_face_encodings, face_encoding_to_check) <= tolerance)
 
 
+def map_faces(images, fn, workers=None):
+    """
+    Apply a face function to every image on a thread pool and return the results in order.
+
+    The heavy lifting in detection and encoding happens in dlib's native code, which runs without holding
+    the GIL, so threads give real parallelism. The landmark and encoder models loaded by this module are
+    shared by every thread, where a process pool would load them again in each process. dlib's HOG
+    detector is not safe to share, so each concurrent face_locations call runs on a detector of its own,
+    and CNN detection runs one call at a time.
+
+    :param images: An iterable of images (each as a numpy array), or of whatever fn accepts
+    :param fn: Function to call with each image, e.g. face_locations or face_encodings
+    :param workers: How many threads to use. None uses one per CPU and 1 runs everything in the calling thread.
+    :return: A list of fn's results, in the same order as images
+    """
+    if workers == 1:
+        return [fn(image) for image in images]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        return list(executor.map(fn, images))
+
+
+# Rows below which splitting a gallery search across threads costs more than it saves
+MIN_SHARD_ROWS = 50000
+
+_search_executor = None
+
+
+def _get_search_executor():
+    global _search_executor
+    if _search_executor is None:
+        _search_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="gallery-search")
+    return _search_executor
+
+
+def _top_k(distances, k, offset=0):
+    if k < len(distances):
+        indices = np.argpartition(distances, k - 1)[:k]
+    else:
+        indices = np.arange(len(distances))
+    return indices + offset, distances[indices]
+
+
+def _search_shards(n, shard_distances, k, shards, executor):
+    if shards is None:
+        shards = min(os.cpu_count() or 1, max(1, n // MIN_SHARD_ROWS))
+    shards = max(1, min(shards, n))
+
+    def search_shard(bounds):
+        start, end = bounds
+        return _top_k(shard_distances(start, end), k, start)
+
+    bounds = np.linspace(0, n, shards + 1).astype(int)
+    bounds = list(zip(bounds[:-1], bounds[1:]))
+    if shards == 1:
+        results = [search_shard(bounds[0])]
+    else:
+        results = list((executor or _get_search_executor()).map(search_shard, bounds))
+
+    indices = np.concatenate([r[0] for r in results])
+    distances = np.concatenate([r[1] for r in results])
+    order = np.argsort(distances, kind="stable")[:k]
+    return indices[order], distances[order]
+
+
+def search_gallery(known_face_encodings, face_encoding_to_check, k=1, shards=None, executor=None):
+    """
+    Find the k known face encodings closest to a face encoding.
+
+    Large galleries are split into contiguous shards that are searched concurrently, each returning its own
+    top k, which are then merged into the global top k. Distances are the same euclidean distances returned
+    by face_distance.
+
+    :param known_face_encodings: A numpy array (or memmap) of known face encodings, one per row
+    :param face_encoding_to_check: A single face encoding to search for
+    :param k: How many of the closest encodings to return
+    :param shards: How many shards to split the search into. None picks one per CPU for large galleries and
+                   a single shard for small ones.
+    :param executor: Optional concurrent.futures executor to search shards on. Defaults to a shared thread pool.
+    :return: A tuple of (indices, distances) numpy arrays for the closest rows, sorted by distance
+    """
+    n = len(known_face_encodings)
+    if n == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    def shard_distances(start, end):
+        return np.linalg.norm(known_face_encodings[start:end] - face_encoding_to_check, axis=1)
+
+    return _search_shards(n, shard_distances, k, shards, executor)
+
+
+class CompactEncodings(object):
+    """
+    Face encodings stored as float16 (256 bytes per face) or per-dimension scalar-quantized int8
+    (128 bytes per face) instead of float64 (1 KB per face).
+
+    int8 values map each dimension's [min, max] range over the stored encodings onto 256 levels. Distances
+    are computed without dequantizing: the probe is moved into quantized coordinates and each dimension is
+    weighted by its squared step size. Each row's squared norm is kept alongside (4 bytes per face) so a
+    search is one matrix-vector product per block of rows.
+
+    :param encodings: A list or numpy array of face encodings, one per row
+    :param dtype: "float16" or "int8"
+    """
+
+    # Rows decoded to float32 at a time while searching, to bound temporary memory
+    block_rows = 65536
+
+    def __init__(self, encodings, dtype="float16"):
+        encodings = np.asarray(encodings).reshape(-1, 128)
+        self.dtype = dtype
+
+        if dtype == "float16":
+            self.data = encodings.astype(np.float16)
+            self.offset = self.step = None
+        elif dtype == "int8":
+            encodings = encodings.astype(np.float64, copy=False)
+            low = encodings.min(axis=0) if len(encodings) else np.zeros(128)
+            high = encodings.max(axis=0) if len(encodings) else np.ones(128)
+            self.step = np.maximum(high - low, 1e-12) / 255.0
+            self.offset = low
+            self.data = (np.rint((encodings - low) / self.step) - 128).astype(np.int8)
+        else:
+            raise ValueError("Invalid compact encoding type. Supported types are ['float16', 'int8'].")
+
+        # Squared norm of each stored row, in the same (weighted) space distances are computed in
+        weights = np.ones(128) if self.step is None else self.step ** 2
+        self.norms = np.empty(len(self.data), dtype=np.float32)
+        for block_start in range(0, len(self.data), self.block_rows):
+            block = self.data[block_start:block_start + self.block_rows].astype(np.float64)
+            self.norms[block_start:block_start + len(block)] = (block ** 2) @ weights
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        extra = 0 if self.step is None else self.step.nbytes + self.offset.nbytes
+        return self.data.nbytes + self.norms.nbytes + extra
+
+    def decode(self, start=0, end=None):
+        """Return rows [start:end) as approximate float64 encodings."""
+        block = self.data[start:end].astype(np.float64)
+        if self.dtype == "int8":
+            block = (block + 128) * self.step + self.offset
+        return block
+
+    def distances(self, face_encoding_to_check, start=0, end=None):
+        """Approximate euclidean distances from rows [start:end) to a face encoding."""
+        end = len(self.data) if end is None else end
+        probe = np.asarray(face_encoding_to_check, dtype=np.float64)
+        if self.dtype == "int8":
+            # Squared distance in quantized coordinates, each dimension weighted by its squared step
+            weights = self.step ** 2
+            probe = (probe - self.offset) / self.step - 128
+            weighted_probe = (weights * probe).astype(np.float32)
+            probe_norm = np.dot(weights, probe ** 2)
+        else:
+            weighted_probe = probe.astype(np.float32)
+            probe_norm = np.dot(probe, probe)
+
+        # |x - p|^2 = |x|^2 - 2 x.p + |p|^2, so each block only needs one matrix-vector product
+        result = np.empty(end - start, dtype=np.float32)
+        for block_start in range(start, end, self.block_rows):
+            block_end = min(block_start + self.block_rows, end)
+            products = self.data[block_start:block_end].astype(np.float32) @ weighted_probe
+            result[block_start - start:block_end - start] = self.norms[block_start:block_end] - 2 * products + probe_norm
+        return np.sqrt(np.maximum(result, 0))
+
+
+def search_compact(compact_encodings, face_encoding_to_check, k=1, exact_encodings=None, candidates=None, shards=None,
+                   executor=None):
+    """
+    Find the k closest encodings by searching compact (float16/int8) encodings, optionally re-ranking the best
+    candidates against the exact encodings.
+
+    :param compact_encodings: A CompactEncodings instance
+    :param face_encoding_to_check: A single face encoding to search for
+    :param k: How many of the closest encodings to return
+    :param exact_encodings: Optional float64 encodings in the same row order (e.g. a memmap). Only the candidate
+                            rows are read from it.
+    :param candidates: How many compact-search results to re-rank exactly. Defaults to max(4 * k, 32).
+    :param shards: How many shards to split the compact search into, as in search_gallery
+    :param executor: Optional concurrent.futures executor to search shards on
+    :return: A tuple of (indices, distances) numpy arrays for the closest rows, sorted by distance. Distances are
+             exact when exact_encodings is given and approximate otherwise.
+    """
+    n = len(compact_encodings)
+    if n == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    if exact_encodings is None:
+        candidates = k
+    elif candidates is None:
+        candidates = max(4 * k, 32)
+
+    def shard_distances(start, end):
+        return compact_encodings.distances(face_encoding_to_check, start, end)
+
+    indices, distances = _search_shards(n, shard_distances, max(k, candidates), shards, executor)
+    if exact_encodings is None:
+        return indices[:k], distances[:k].astype(np.float64)
+
+    # Fancy indexing reads only the candidate rows, in file order to keep memmap access sequential
+    rows = np.sort(indices)
+    exact = np.linalg.norm(np.asarray(exact_encodings[rows]) - face_encoding_to_check, axis=1)
+    order = np.argsort(exact, kind="stable")[:k]
+    return rows[order], exact[order]
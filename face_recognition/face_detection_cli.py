@@ -2,31 +2,86 @@
 from __future__ import print_function
 import click
 import os
-import re
 import face_recognition.api as face_recognition
 import multiprocessing
+import numpy as np
+import queue
 import sys
-import itertools
+import threading
 
 
-def print_result(filename, location):
+def format_result(filename, location):
     top, right, bottom, left = location
-    print("{},{},{},{},{}".format(filename, top, right, bottom, left))
+    return "{},{},{},{},{}".format(filename, top, right, bottom, left)
+
+
+def print_result(filename, location):
+    print(format_result(filename, location))
 
 
-def test_image(image_to_check, model):
+def check_image(image_to_check, model, upsample=0):
+    """Detect the faces in an image, returning the output lines instead of printing them."""
     unknown_image = face_recognition.load_image_file(image_to_check)
-    face_locations = face_recognition.face_locations(unknown_image, number_of_times_to_upsample=0, model=model)
+    return check_decoded_image(image_to_check, unknown_image, model, upsample)
+
+
+def check_decoded_image(image_to_check, unknown_image, model, upsample=0):
+    """check_image for an image that is already decoded."""
+    face_locations = face_recognition.face_locations(unknown_image, number_of_times_to_upsample=upsample, model=model)
+
+    return [format_result(image_to_check, face_location) for face_location in face_locations]
 
-    for face_location in face_locations:
-        print_result(image_to_check, face_location)
+
+def test_image(image_to_check, model, upsample=0):
+    for line in check_image(image_to_check, model, upsample):
+        print(line)
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
 
 
 def image_files_in_folder(folder):
-    return [os.path.join(folder, f) for f in os.listdir(folder) if re.match(r'.*\.(jpg|jpeg|png)', f, flags=re.I)]
+    """Yield every image file under folder, recursing into subfolders, in a stable order."""
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for f in sorted(files):
+            if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, f)
+
+
+def print_in_order(results):
+    """
+    Print (index, lines) results that arrive in any order, in index order.
+
+    Results that arrive early are held back until every earlier index has
+    been printed, so output is identical to a single-process run.
+    """
+    pending = {}
+    next_index = 0
+    for index, lines in results:
+        pending[index] = lines
+        while next_index in pending:
+            for line in pending.pop(next_index):
+                print(line)
+            next_index += 1
+    sys.stdout.flush()
 
 
-def process_images_in_process_pool(images_to_check, number_of_cpus, model):
+# Set once per pool worker by _init_worker so tasks only carry an image path
+_worker_args = None
+
+
+def _init_worker(model, upsample):
+    global _worker_args
+    _worker_args = (model, upsample)
+
+
+def _check_image_in_worker(task):
+    index, image_to_check = task
+    return index, check_image(image_to_check, *_worker_args)
+
+
+def process_images_in_process_pool(images_to_check, number_of_cpus, model, upsample=0, chunksize=4):
     if number_of_cpus == -1:
         processes = None
     else:
@@ -37,33 +92,162 @@ def process_images_in_process_pool(images_to_check, number_of_cpus, model):
     if "forkserver" in multiprocessing.get_all_start_methods():
         context = multiprocessing.get_context("forkserver")
 
-    pool = context.Pool(processes=processes)
+    pool = context.Pool(processes=processes, initializer=_init_worker, initargs=(model, upsample))
+
+    try:
+        print_in_order(pool.imap_unordered(_check_image_in_worker, enumerate(images_to_check), chunksize))
+    finally:
+        pool.close()
+        pool.join()
+
+
+_END = object()
+
+
+def decode_images(image_files, prefetch=16):
+    """
+    Yield (filename, image) pairs, decoding up to `prefetch` images ahead on a
+    background thread so the detector never waits on JPEG decoding.
+    """
+    decoded = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def decode():
+        try:
+            for image_file in image_files:
+                if stop.is_set():
+                    return
+                try:
+                    item = (image_file, face_recognition.load_image_file(image_file))
+                except Exception as e:
+                    click.echo("WARNING: Could not load {}: {}".format(image_file, e), err=True)
+                    continue
+                decoded.put(item)
+        finally:
+            decoded.put(_END)
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = decoded.get()
+            if item is _END:
+                return
+            yield item
+    finally:
+        stop.set()
+        # Unblock the decoder if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                decoded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def bucket_shape(shape, pad_to):
+    """The shape an image is padded to for batching: height and width rounded up to a multiple of pad_to."""
+    height, width = shape[:2]
+    return (-(-height // pad_to) * pad_to, -(-width // pad_to) * pad_to) + tuple(shape[2:])
+
+
+def pad_image(image, shape):
+    """Pad an image with black on the bottom and right to shape, so face locations in it are unchanged."""
+    if image.shape == shape:
+        return image
+    padded = np.zeros(shape, dtype=image.dtype)
+    padded[:image.shape[0], :image.shape[1]] = image
+    return padded
+
+
+def unpad_locations(face_locations, shape):
+    """Clip face locations found in a padded image to the original image shape, dropping any left in the padding."""
+    height, width = shape[:2]
+    return [
+        (top, min(right, width), min(bottom, height), left)
+        for top, right, bottom, left in face_locations
+        if top < height and left < width
+    ]
+
+
+def batches_by_size(decoded_images, batch_size, max_pending=None, pad_to=128):
+    """
+    Group (filename, image) pairs into batches of images of one bucket shape,
+    since the batched CNN detector needs every image in a batch to be the
+    same shape. Each image is padded up to its bucket_shape, so images whose
+    sizes differ by less than pad_to pixels share a batch. Buckets are
+    flushed when full, when too many images are pending across buckets
+    (largest bucket first), and at the end.
+
+    :param pad_to: bucket granularity in pixels; 1 only batches images of exactly the same size
+    :return: a generator of (filenames, original shapes, padded images) tuples
+    """
+    max_pending = max_pending or 4 * batch_size
+    buckets = {}
+    pending = 0
+
+    for image_file, image in decoded_images:
+        shape = bucket_shape(image.shape, pad_to)
+        bucket = buckets.setdefault(shape, [])
+        bucket.append((image_file, image.shape, pad_image(image, shape)))
+        pending += 1
+
+        if len(bucket) >= batch_size:
+            del buckets[shape]
+        elif pending >= max_pending:
+            bucket = buckets.pop(max(buckets, key=lambda shape: len(buckets[shape])))
+        else:
+            continue
+
+        pending -= len(bucket)
+        yield tuple(zip(*bucket))
+
+    for bucket in buckets.values():
+        yield tuple(zip(*bucket))
 
-    function_parameters = zip(
-        images_to_check,
-        itertools.repeat(model),
-    )
 
-    pool.starmap(test_image, function_parameters)
+def process_images_in_batches(images_to_check, batch_size, upsample=0, pad_to=128):
+    """Run the batched CNN detector over images, printing results batch by batch (not in input order)."""
+    decoded = decode_images(images_to_check, prefetch=2 * batch_size)
+    for image_files, shapes, images in batches_by_size(decoded, batch_size, pad_to=pad_to):
+        batch_locations = face_recognition.batch_face_locations(list(images), number_of_times_to_upsample=upsample, batch_size=batch_size)
+        for image_file, shape, face_locations in zip(image_files, shapes, batch_locations):
+            for face_location in unpad_locations(face_locations, shape):
+                print_result(image_file, face_location)
+
+
+def process_images(images_to_check, model, upsample=0):
+    """Detect faces in images one at a time, decoding the next images on a background thread meanwhile."""
+    for image_file, image in decode_images(images_to_check):
+        for line in check_decoded_image(image_file, image, model, upsample):
+            print(line)
 
 
 @click.command()
 @click.argument('image_to_check')
 @click.option('--cpus', default=-1, help='number of CPU cores to use in parallel. -1 means "use all in system"')
 @click.option('--model', default="cnn", help='Which face detection model to use. Options are "hog" or "cnn".')
-def main(image_to_check, cpus, model):
+@click.option('--upsample', default=0, help='How many times to upsample each image looking for faces. Higher numbers find smaller faces.')
+@click.option('--batch-size', default=1, help='With the cnn model, run images of similar size through the detector in batches of this many (best on a GPU).')
+@click.option('--pad-to', default=128, help='With --batch-size, pad images to a multiple of this many pixels so images of similar size share a batch.')
+def main(image_to_check, cpus, model, upsample, batch_size, pad_to):
     # Multi-core processing only supported on Python 3.4 or greater
     if (sys.version_info < (3, 4)) and cpus != 1:
         click.echo("WARNING: Multi-processing support requires Python 3.4 or greater. Falling back to single-threaded processing!")
         cpus = 1
 
+    if batch_size > 1 and model != "cnn":
+        click.echo("WARNING: --batch-size only applies to the cnn model. Ignoring it.")
+        batch_size = 1
+
     if os.path.isdir(image_to_check):
-        if cpus == 1:
-            [test_image(image_file, model) for image_file in image_files_in_folder(image_to_check)]
+        if batch_size > 1:
+            process_images_in_batches(image_files_in_folder(image_to_check), batch_size, upsample, max(1, pad_to))
+        elif cpus == 1:
+            process_images(image_files_in_folder(image_to_check), model, upsample)
         else:
-            process_images_in_process_pool(image_files_in_folder(image_to_check), cpus, model)
+            process_images_in_process_pool(image_files_in_folder(image_to_check), cpus, model, upsample)
     else:
-        test_image(image_to_check, model)
+        test_image(image_to_check, model, upsample)
 
 
 if __name__ == "__main__":
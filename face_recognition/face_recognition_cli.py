@@ -2,44 +2,154 @@
 from __future__ import print_function
 import click
 import os
-import re
+import hashlib
 import face_recognition.api as face_recognition
 import multiprocessing
-import itertools
 import sys
 import PIL.Image
 import numpy as np
 
 
-def scan_known_people(known_people_folder):
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _encode_known_file(file):
+    img = face_recognition.load_image_file(file)
+    encodings = face_recognition.face_encodings(img)
+    return file, len(encodings), encodings[0] if encodings else None
+
+
+def load_encoding_cache(cache_path):
+    """
+    Load a known-people encoding cache written by save_encoding_cache.
+
+    :return: dict of file path -> dict with size, mtime, digest, face_count and encoding (None when no face was found)
+    """
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+
+    with np.load(cache_path) as data:
+        return {
+            str(path): {
+                'size': int(size),
+                'mtime': float(mtime),
+                'digest': str(digest),
+                'face_count': int(face_count),
+                'encoding': encoding if face_count else None,
+            }
+            for path, size, mtime, digest, face_count, encoding in zip(
+                data['paths'], data['sizes'], data['mtimes'], data['digests'], data['face_counts'], data['encodings'])
+        }
+
+
+def save_encoding_cache(cache_path, entries):
+    paths = sorted(entries)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(
+            f,
+            paths=np.array(paths, dtype=str),
+            sizes=np.array([entries[p]['size'] for p in paths], dtype=np.int64),
+            mtimes=np.array([entries[p]['mtime'] for p in paths], dtype=np.float64),
+            digests=np.array([entries[p]['digest'] for p in paths], dtype=str),
+            face_counts=np.array([entries[p]['face_count'] for p in paths], dtype=np.int64),
+            encodings=np.array([entries[p]['encoding'] if entries[p]['face_count'] else np.zeros(128) for p in paths]).reshape(-1, 128),
+        )
+    os.replace(tmp_path, cache_path)
+
+
+def update_encoding_cache(known_people_folder, cache_path=None, number_of_cpus=1):
+    """
+    Bring the known-people encoding cache up to date with the folder.
+
+    A file is reused from the cache when its size and mtime are unchanged, or
+    when they changed but its content hash did not. Only new and changed
+    files are decoded and encoded, in parallel when number_of_cpus != 1.
+
+    :return: dict of file path -> cache entry for every image in the folder
+    """
+    cache = load_encoding_cache(cache_path)
+    entries = {}
+    to_encode = []
+    changed = False
+
+    for file in image_files_in_folder(known_people_folder):
+        stat = os.stat(file)
+        cached = cache.get(file)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            entries[file] = cached
+            continue
+
+        changed = True
+        digest = _file_digest(file)
+        if cached is not None and cached['digest'] == digest:
+            entries[file] = dict(cached, size=stat.st_size, mtime=stat.st_mtime)
+        else:
+            entries[file] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest}
+            to_encode.append(file)
+
+    pool = None
+    if number_of_cpus == 1 or len(to_encode) < 2:
+        results = map(_encode_known_file, to_encode)
+    else:
+        pool = _process_pool(number_of_cpus)
+        results = pool.imap_unordered(_encode_known_file, to_encode, chunksize=4)
+
+    try:
+        for file, face_count, encoding in results:
+            entries[file]['face_count'] = face_count
+            entries[file]['encoding'] = encoding
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if cache_path and (changed or len(entries) != len(cache)):
+        save_encoding_cache(cache_path, entries)
+
+    return entries
+
+
+def scan_known_people(known_people_folder, cache_path=None, number_of_cpus=1):
     known_names = []
     known_face_encodings = []
 
-    for file in image_files_in_folder(known_people_folder):
+    entries = update_encoding_cache(known_people_folder, cache_path, number_of_cpus)
+
+    for file in sorted(entries):
         basename = os.path.splitext(os.path.basename(file))[0]
-        img = face_recognition.load_image_file(file)
-        encodings = face_recognition.face_encodings(img)
+        face_count = entries[file]['face_count']
 
-        if len(encodings) > 1:
+        if face_count > 1:
             click.echo("WARNING: More than one face found in {}. Only considering the first face.".format(file))
 
-        if len(encodings) == 0:
+        if face_count == 0:
             click.echo("WARNING: No faces found in {}. Ignoring file.".format(file))
         else:
             known_names.append(basename)
-            known_face_encodings.append(encodings[0])
+            known_face_encodings.append(entries[file]['encoding'])
 
     return known_names, known_face_encodings
 
 
-def print_result(filename, name, distance, show_distance=False):
+def format_result(filename, name, distance, show_distance=False):
     if show_distance:
-        print("{},{},{}".format(filename, name, distance))
+        return "{},{},{}".format(filename, name, distance)
     else:
-        print("{},{}".format(filename, name))
+        return "{},{}".format(filename, name)
 
 
-def test_image(image_to_check, known_names, known_face_encodings, tolerance=0.5, show_distance=False):
+def print_result(filename, name, distance, show_distance=False):
+    print(format_result(filename, name, distance, show_distance))
+
+
+def check_image(image_to_check, known_names, known_face_encodings, tolerance=0.5, show_distance=False):
+    """Match every face in an image against the known people, returning the output lines instead of printing them."""
     unknown_image = face_recognition.load_image_file(image_to_check)
 
     # Scale down image if it's giant so things run a little faster
@@ -49,26 +159,42 @@ def test_image(image_to_check, known_names, known_face_encodings, tolerance=0.5,
         unknown_image = np.array(pil_img)
 
     unknown_encodings = face_recognition.face_encodings(unknown_image)
+    lines = []
 
     for unknown_encoding in unknown_encodings:
         distances = face_recognition.face_distance(known_face_encodings, unknown_encoding)
         result = list(distances <= tolerance)
 
         if True in result:
-            [print_result(image_to_check, name, distance, show_distance) for is_match, name, distance in zip(result, known_names, distances) if is_match]
+            lines.extend(format_result(image_to_check, name, distance, show_distance) for is_match, name, distance in zip(result, known_names, distances) if is_match)
         else:
-            print_result(image_to_check, "unknown_person", None, show_distance)
+            lines.append(format_result(image_to_check, "unknown_person", None, show_distance))
 
     if not unknown_encodings:
         # print out fact that no faces were found in image
-        print_result(image_to_check, "no_persons_found", None, show_distance)
+        lines.append(format_result(image_to_check, "no_persons_found", None, show_distance))
+
+    return lines
+
+
+def test_image(image_to_check, known_names, known_face_encodings, tolerance=0.5, show_distance=False):
+    for line in check_image(image_to_check, known_names, known_face_encodings, tolerance, show_distance):
+        print(line)
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
 
 
 def image_files_in_folder(folder):
-    return [os.path.join(folder, f) for f in os.listdir(folder) if re.match(r'.*\.(jpg|jpeg|png)', f, flags=re.I)]
+    """Yield every image file under folder, recursing into subfolders, in a stable order."""
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for f in sorted(files):
+            if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, f)
 
 
-def process_images_in_process_pool(images_to_check, known_names, known_face_encodings, number_of_cpus, tolerance, show_distance):
+def _process_pool(number_of_cpus, initializer=None, initargs=()):
     if number_of_cpus == -1:
         processes = None
     else:
@@ -79,17 +205,50 @@ def process_images_in_process_pool(images_to_check, known_names, known_face_enco
     if "forkserver" in multiprocessing.get_all_start_methods():
         context = multiprocessing.get_context("forkserver")
 
-    pool = context.Pool(processes=processes)
+    return context.Pool(processes=processes, initializer=initializer, initargs=initargs)
+
+
+def print_in_order(results):
+    """
+    Print (index, lines) results that arrive in any order, in index order.
+
+    Results that arrive early are held back until every earlier index has
+    been printed, so output is identical to a single-process run.
+    """
+    pending = {}
+    next_index = 0
+    for index, lines in results:
+        pending[index] = lines
+        while next_index in pending:
+            for line in pending.pop(next_index):
+                print(line)
+            next_index += 1
+    sys.stdout.flush()
 
-    function_parameters = zip(
-        images_to_check,
-        itertools.repeat(known_names),
-        itertools.repeat(known_face_encodings),
-        itertools.repeat(tolerance),
-        itertools.repeat(show_distance)
-    )
 
-    pool.starmap(test_image, function_parameters)
+# Set once per pool worker by _init_worker so tasks only carry an image path
+_worker_args = None
+
+
+def _init_worker(known_names, known_face_encodings, tolerance, show_distance):
+    global _worker_args
+    _worker_args = (known_names, np.array(known_face_encodings), tolerance, show_distance)
+
+
+def _check_image_in_worker(task):
+    index, image_to_check = task
+    return index, check_image(image_to_check, *_worker_args)
+
+
+def process_images_in_process_pool(images_to_check, known_names, known_face_encodings, number_of_cpus, tolerance, show_distance, chunksize=4):
+    # The known people are sent to each worker once, not once per image
+    pool = _process_pool(number_of_cpus, _init_worker, (known_names, known_face_encodings, tolerance, show_distance))
+
+    try:
+        print_in_order(pool.imap_unordered(_check_image_in_worker, enumerate(images_to_check), chunksize))
+    finally:
+        pool.close()
+        pool.join()
 
 
 @click.command()
@@ -98,14 +257,15 @@ def process_images_in_process_pool(images_to_check, known_names, known_face_enco
 @click.option('--cpus', default=1, help='number of CPU cores to use in parallel (can speed up processing lots of images). -1 means "use all in system"')
 @click.option('--tolerance', default=0.6, help='Tolerance for face comparisons. Default is 0.6. Lower this if you get multiple matches for the same person.')
 @click.option('--show-distance', default=False, type=bool, help='Output face distance. Useful for tweaking tolerance setting.')
-def main(known_people_folder, image_to_check, cpus, tolerance, show_distance):
-    known_names, known_face_encodings = scan_known_people(known_people_folder)
-
+@click.option('--cache', default=None, help='Known people encoding cache (.npz) to reuse between runs. Created if missing.')
+def main(known_people_folder, image_to_check, cpus, tolerance, show_distance, cache):
     # Multi-core processing only supported on Python 3.4 or greater
     if (sys.version_info < (3, 4)) and cpus != 1:
         click.echo("WARNING: Multi-processing support requires Python 3.4 or greater. Falling back to single-threaded processing!")
         cpus = 1
 
+    known_names, known_face_encodings = scan_known_people(known_people_folder, cache, cpus)
+
     if os.path.isdir(image_to_check):
         if cpus == 1:
             [test_image(image_file, known_names, known_face_encodings, tolerance, show_distance) for image_file in image_files_in_folder(image_to_check)]
@@ -115,5 +275,16 @@ def main(known_people_folder, image_to_check, cpus, tolerance, show_distance):
         test_image(image_to_check, known_names, known_face_encodings, tolerance, show_distance)
 
 
+@click.command()
+@click.argument('known_people_folder')
+@click.argument('cache')
+@click.option('--cpus', default=-1, help='number of CPU cores to use in parallel. -1 means "use all in system"')
+def build_cache(known_people_folder, cache, cpus):
+    """Prebuild or refresh the known people encoding cache used by `face_recognition --cache`."""
+    entries = update_encoding_cache(known_people_folder, cache, cpus)
+    faces = sum(1 for entry in entries.values() if entry['face_count'])
+    click.echo("Cached {} images ({} with faces) in {}".format(len(entries), faces, cache))
+
+
 if __name__ == "__main__":
     main()
@@ -8,10 +8,20 @@ urlpatterns = [
     
     path('users', api_views.api_users, name='api_users'),
     path('citizens', api_views.api_citizens, name='api_citizens'),
+    path('citizens/bulk', api_views.api_bulk_add_citizens, name='api_bulk_add_citizens'),
     path('add-citizen', api_views.api_add_citizen, name='api_add_citizen'),
     path('spotted-criminals', api_views.api_spotted_criminals, name='api_spotted_criminals'),
     path('detect-image', api_views.api_detect_image, name='api_detect_image'),
+    path('detect-video', api_views.api_detect_video, name='api_detect_video'),
+    path('video-jobs/<int:job_id>', api_views.api_video_job, name='api_video_job'),
+    path('ingest-stats', api_views.api_ingest_stats, name='api_ingest_stats'),
+    path('thumbnails/<int:size>/<path:path>', api_views.api_thumbnail, name='api_thumbnail'),
+    path('chips/<int:chip_id>', api_views.api_face_chip, name='api_face_chip'),
+    path('reembed-jobs', api_views.api_reembed_jobs, name='api_reembed_jobs'),
+    path('unknown-clusters', api_views.api_unknown_clusters, name='api_unknown_clusters'),
     path('reports-statistics', api_views.api_reports_statistics, name='api_reports_statistics'),
     path('test-media', api_views.api_test_media, name='api_test_media'),
+    path('citizen/<int:citizen_id>/sightings', api_views.api_citizen_sightings, name='api_citizen_sightings'),
+    path('citizen/<int:citizen_id>/faces', api_views.api_citizen_faces, name='api_citizen_faces'),
     path('citizen/<int:citizen_id>/<str:action>', api_views.api_update_citizen_status, name='api_update_citizen_status'),
 ]
@@ -1,14 +1,30 @@
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.contrib.auth import logout
 from django.contrib import messages
 from django.shortcuts import get_object_or_404
+from django.conf import settings
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
 import json
+import os
+import zipfile
 import bcrypt
-from main.models import User, Person, ThiefLocation, DetectionEvent, DetectionMatch
-import face_recognition
 import numpy as np
+import PIL
+from main.models import User, Person, PersonFace, ThiefLocation, DetectionEvent, DetectionMatch, RetroSearch, UnknownCluster, ReembedJob, FaceChip, VideoJob
+from main.gallery import get_gallery, update_gallery_status
+from main.video import start_video_job
+from main.sightings import pack_encoding, start_retro_search
+from main.clustering import assign_unknown_face
+from main.enrollment import check_enrollment, remember_enrollment
+from main.bulk_enroll import enroll_citizens, open_images, read_manifest
+from main.encoders import active_encoder
+from main.chips import read_chip, save_chip, save_chips
+from main.thumbnails import content_type, get_thumbnail, media_path, thumbnail_url, thumbnail_version
+from main.media import IMMUTABLE, REVALIDATE, serve_file
+import face_recognition
 from django.core.files.storage import FileSystemStorage
 from urllib.parse import unquote
 
@@ -124,12 +140,15 @@ def api_users(request):
 @require_http_methods(["GET"])
 def api_citizens(request):
     try:
-        citizens = Person.objects.all().values(
+        citizens = list(Person.objects.all().values(
             'id', 'name', 'national_id', 'address', 'picture', 'status', 'created_at', 'updated_at'
-        )
+        ))
+        # Small cached copy of each picture for list rows
+        for citizen in citizens:
+            citizen['thumbnail_url'] = thumbnail_url(citizen['picture'])
         return JsonResponse({
             'success': True,
-            'citizens': list(citizens)
+            'citizens': citizens
         })
     except Exception as e:
         return JsonResponse({
@@ -141,13 +160,15 @@ def api_citizens(request):
 @require_http_methods(["GET"])
 def api_spotted_criminals(request):
     try:
-        criminals = ThiefLocation.objects.filter(status="Wanted").values(
+        criminals = list(ThiefLocation.objects.filter(status="Wanted").values(
             'id', 'name', 'national_id', 'address', 'picture', 'status', 
             'latitude', 'longitude', 'created_at', 'updated_at'
-        )
+        ))
+        for criminal in criminals:
+            criminal['thumbnail_url'] = thumbnail_url(criminal['picture'])
         return JsonResponse({
             'success': True,
-            'criminals': list(criminals)
+            'criminals': criminals
         })
     except Exception as e:
         return JsonResponse({
@@ -169,6 +190,11 @@ def api_detect_image(request):
         if "image" not in request.FILES:
             return JsonResponse({"success": False, "error": "No image provided"}, status=400)
 
+        # 'watchlist' only reports citizens with a watchlist status; 'all' checks the watchlist first, then everyone
+        scope = request.POST.get("scope", "all")
+        if scope not in ("all", "watchlist"):
+            return JsonResponse({"success": False, "error": "scope must be 'all' or 'watchlist'"}, status=400)
+
         uploaded = request.FILES["image"]
         fs = FileSystemStorage()
         filename = fs.save(uploaded.name, uploaded)
@@ -176,30 +202,8 @@ def api_detect_image(request):
         # Convert to filesystem path (remove leading slash if present)
         uploaded_path = unquote(uploaded_url[1:]) if uploaded_url.startswith("/") else unquote(uploaded_url)
 
-        # Load known images from Person records
-        persons = Person.objects.all()
-        known_encodings = []
-        known_names = []
-        known_status = []
-        known_nid = []
-
-        for p in persons:
-            try:
-                img_path = p.picture
-                if not img_path:
-                    continue
-                # face_recognition.load_image_file accepts file path
-                img = face_recognition.load_image_file(img_path)
-                encs = face_recognition.face_encodings(img)
-                if len(encs) == 0:
-                    continue
-                known_encodings.append(encs[0])
-                known_names.append(p.name)
-                known_status.append(p.status)
-                known_nid.append(p.national_id)
-            except Exception:
-                # skip problematic person images
-                continue
+        # Known citizens are encoded once and cached across requests
+        gallery = get_gallery()
 
         # Load and analyze uploaded image
         try:
@@ -207,48 +211,34 @@ def api_detect_image(request):
         except Exception as e:
             return JsonResponse({"success": False, "error": f"Failed to load uploaded image: {str(e)}"}, status=400)
 
-        face_locations = face_recognition.face_locations(unknown_image)
-        face_encodings = face_recognition.face_encodings(unknown_image, face_locations)
+        if unknown_image.shape[0] * unknown_image.shape[1] > settings.FACE_TILED_DETECTION_PIXELS:
+            face_locations = face_recognition.tiled_face_locations(unknown_image, settings.FACE_DETECTION_MIN_SIZE)
+        else:
+            face_locations = face_recognition.adaptive_face_locations(unknown_image, settings.FACE_DETECTION_MIN_SIZE)
+        # Faces are encoded from their aligned chips, which are kept so the upload is never decoded again.
+        # Faces too small, blurred or turned away to match are reported without being encoded.
+        assessed = gallery.face_quality(unknown_image, face_locations)
+        face_chips = [chip for chip, _ in assessed]
+        encoded = iter(gallery.chip_encodings([chip for chip in face_chips if chip is not None]))
+        face_encodings = [next(encoded) if chip is not None else None for chip in face_chips]
 
         detections = []
 
         # Loop by index so we can attach the corresponding bounding box
         for i, face_encoding in enumerate(face_encodings):
             top, right, bottom, left = face_locations[i]
-
-            if len(known_encodings) == 0:
-                detections.append({
-                    "name": "Unknown",
-                    "confidence": 0.0,
-                    "status": "Unknown",
-                    "national_id": None,
-                    "box": [int(top), int(right), int(bottom), int(left)],
-                })
-                continue
-
-            matches = face_recognition.compare_faces(known_encodings, face_encoding)
-            face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-
-            best_index = int(np.argmin(face_distances))
-            best_distance = float(face_distances[best_index])
-            confidence = round(max(0.0, (1.0 - best_distance)) * 100.0, 2)
-
-            if matches[best_index]:
-                detections.append({
-                    "name": known_names[best_index],
-                    "confidence": confidence,
-                    "status": known_status[best_index] if known_status[best_index] else "Unknown",
-                    "national_id": known_nid[best_index],
-                    "box": [int(top), int(right), int(bottom), int(left)],
-                })
+            if face_encoding is None:
+                detection = gallery.unmatched()
             else:
-                detections.append({
-                    "name": "Unknown",
-                    "confidence": confidence,
-                    "status": "Unknown",
-                    "national_id": None,
-                    "box": [int(top), int(right), int(bottom), int(left)],
-                })
+                detection = gallery.match(
+                    face_encoding,
+                    statuses=settings.GALLERY_WATCHLIST_STATUSES,
+                    fallback=(scope == "all"),
+                )
+            detection["box"] = [int(top), int(right), int(bottom), int(left)]
+            detection["quality"] = assessed[i][1].score
+            detection["low_quality"] = face_encoding is None
+            detections.append(detection)
 
         # Calculate processing time and statistics
         processing_time = time.time() - start_time
@@ -273,26 +263,29 @@ def api_detect_image(request):
             user_id=user_id
         )
         
-        # Create detection match records for each face
-        for detection in detections:
-            matched_person = None
-            if detection['name'] != 'Unknown':
-                # Find the person by name (you might want to improve this matching logic)
-                try:
-                    matched_person = Person.objects.filter(name__icontains=detection['name'].split()[0]).first()
-                except:
-                    pass
-            
+        # Create detection match records for each face, grouping unknown faces with earlier sightings of them
+        stored_chips = save_chips(face_chips, gallery.encoder.model)
+        for detection, face_encoding, chip in zip(detections, face_encodings, stored_chips):
+            cluster_id = None
+            if detection['person_id'] is None and face_encoding is not None:
+                cluster_id = assign_unknown_face(face_encoding, gallery.encoder.version)
+                detection['cluster_id'] = cluster_id
             DetectionMatch.objects.create(
                 detection_event=detection_event,
-                matched_person=matched_person,
+                matched_person_id=detection['person_id'],
                 confidence_score=detection['confidence'],
                 is_match=(detection['name'] != 'Unknown'),
                 face_top=detection['box'][0],
                 face_right=detection['box'][1],
                 face_bottom=detection['box'][2],
-                face_left=detection['box'][3]
+                face_left=detection['box'][3],
+                face_encoding=pack_encoding(face_encoding) if face_encoding is not None else None,
+                encoder_version=gallery.encoder.version,
+                chip=chip,
+                quality_score=detection['quality'],
+                unknown_cluster_id=cluster_id
             )
+            detection['chip_url'] = _chip_url(chip.id if chip is not None else None)
         
         # Return the saved image URL so the frontend can render it and overlay boxes
         return JsonResponse({
@@ -313,6 +306,105 @@ def api_detect_image(request):
         }, status=500)
 
 
+@csrf_exempt
+@require_http_methods(["POST"])
+def api_detect_video(request):
+    try:
+        if "video" not in request.FILES:
+            return JsonResponse({"success": False, "error": "No video provided"}, status=400)
+
+        try:
+            sample_fps = float(request.POST.get("sample_fps", 2.0))
+        except ValueError:
+            return JsonResponse({"success": False, "error": "sample_fps must be a number"}, status=400)
+        if sample_fps <= 0:
+            return JsonResponse({"success": False, "error": "sample_fps must be positive"}, status=400)
+
+        uploaded = request.FILES["video"]
+        fs = FileSystemStorage()
+        filename = fs.save(uploaded.name, uploaded)
+
+        # Analysis takes about as long as the footage, so it runs in the background and the client polls the job
+        job = VideoJob.objects.create(
+            video_name=uploaded.name,
+            video_url=fs.url(filename),
+            sample_fps=sample_fps,
+            user_id=request.session.get("id"),
+        )
+        start_video_job(job)
+
+        return JsonResponse({
+            "success": True,
+            "job_id": job.id,
+            "status": job.status,
+            "video_url": job.video_url,
+            "poll_url": reverse('api_video_job', args=[job.id]),
+        }, status=202)
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@require_http_methods(["GET"])
+def api_video_job(request, job_id):
+    """Status of a video detection job and, once it is done, its tracked faces and statistics"""
+    try:
+        job = VideoJob.objects.filter(pk=job_id).select_related('detection_event').first()
+        if job is None:
+            return JsonResponse({
+                'success': False,
+                'error': 'Video job not found'
+            }, status=404)
+
+        response = {
+            'success': True,
+            'job_id': job.id,
+            'status': job.status,
+            'error': job.error,
+            'video_url': job.video_url,
+            'created_at': job.created_at.isoformat(),
+            'completed_at': job.completed_at.isoformat() if job.completed_at else None,
+        }
+
+        event = job.detection_event
+        if event is not None:
+            tracks = []
+            for match in event.matches.select_related('matched_person').order_by('track_id'):
+                person = match.matched_person
+                tracks.append({
+                    'track_id': match.track_id,
+                    'person_id': person.id if person else None,
+                    'name': person.name if person else 'Unknown',
+                    'status': person.status if person else 'Unknown',
+                    'national_id': person.national_id if person else None,
+                    'confidence': match.confidence_score,
+                    'quality': match.quality_score,
+                    'box': [match.face_top, match.face_right, match.face_bottom, match.face_left],
+                    'first_seen': match.first_seen_seconds,
+                    'last_seen': match.last_seen_seconds,
+                    'frames_seen': match.frames_seen,
+                    'chip_url': _chip_url(match.chip_id),
+                })
+            response['event_id'] = event.id
+            response['tracks'] = tracks
+            response['statistics'] = {
+                'frames_analyzed': job.frames_analyzed,
+                'total_faces': event.total_faces_detected,
+                'known_faces': event.known_faces_matched,
+                'unknown_faces': event.unknown_faces_detected,
+                'processing_time': round(event.processing_time_seconds, 2),
+            }
+
+        return JsonResponse(response)
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def api_add_citizen(request):
@@ -341,6 +433,17 @@ def api_add_citizen(request):
         filename = fs.save(image.name, image)
         uploaded_file_url = fs.url(filename)
         
+        # Reject a face that is already enrolled under another National ID, unless force is set
+        encoding, duplicates, chip = check_enrollment(fs.path(filename))
+        force = request.POST.get('force', '').lower() in ('1', 'true', 'yes')
+        if duplicates and not force:
+            fs.delete(filename)
+            return JsonResponse({
+                'success': False,
+                'error': 'This face is already enrolled as another citizen',
+                'duplicates': duplicates
+            }, status=409)
+        
         # Create the person record
         person = Person.objects.create(
             name=name,
@@ -349,6 +452,7 @@ def api_add_citizen(request):
             picture=uploaded_file_url[1:],  # Remove leading slash
             status="Free",
         )
+        remember_enrollment(person, encoding, chip)
         
         return JsonResponse({
             'success': True,
@@ -360,7 +464,9 @@ def api_add_citizen(request):
                 'address': person.address,
                 'picture': person.picture,
                 'status': person.status
-            }
+            },
+            'face_found': encoding is not None,
+            'duplicates': duplicates
         })
         
     except Exception as e:
@@ -370,6 +476,124 @@ def api_add_citizen(request):
         }, status=500)
 
 
+@csrf_exempt
+@require_http_methods(["POST"])
+def api_bulk_add_citizens(request):
+    """Enroll many citizens from a 'manifest' (CSV or JSONL) and an 'images' zip upload"""
+    try:
+        manifest = request.FILES.get('manifest')
+        images = request.FILES.get('images')
+        if not manifest or not images:
+            return JsonResponse({
+                'success': False,
+                'error': 'A manifest file and an images zip are required'
+            }, status=400)
+
+        try:
+            rows = read_manifest(manifest.file, manifest.name)
+            images = open_images(images.file)
+        except (IOError, ValueError, zipfile.BadZipFile) as e:
+            return JsonResponse({
+                'success': False,
+                'error': f'Could not read the upload: {str(e)}'
+            }, status=400)
+
+        allow_duplicates = request.POST.get('allow_duplicates', '').lower() in ('1', 'true', 'yes')
+        report = enroll_citizens(
+            rows,
+            images,
+            workers=settings.BULK_ENROLL_WORKERS,
+            threshold=None if allow_duplicates else settings.ENROLLMENT_DUPLICATE_THRESHOLD,
+        )
+
+        return JsonResponse({
+            'success': True,
+            'report': report
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def api_citizen_faces(request, citizen_id):
+    """List a citizen's enrollment faces (GET) or enroll another picture of them (POST with 'image')"""
+    try:
+        citizen = get_object_or_404(Person, pk=citizen_id)
+
+        if request.method == "POST":
+            image = request.FILES.get('image')
+            if not image:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'No image provided'
+                }, status=400)
+
+            fs = FileSystemStorage()
+            filename = fs.save(image.name, image)
+            uploaded_file_url = fs.url(filename)
+
+            encoding, duplicates, chip = check_enrollment(fs.path(filename), exclude=citizen.id)
+            encoder = get_gallery().encoder
+            if encoding is None:
+                fs.delete(filename)
+                return JsonResponse({
+                    'success': False,
+                    'error': 'No face found in the image'
+                }, status=400)
+
+            force = request.POST.get('force', '').lower() in ('1', 'true', 'yes')
+            if duplicates and not force:
+                fs.delete(filename)
+                return JsonResponse({
+                    'success': False,
+                    'error': 'This face is already enrolled as another citizen',
+                    'duplicates': duplicates
+                }, status=409)
+
+            PersonFace.objects.create(
+                person=citizen,
+                picture=uploaded_file_url[1:],  # Remove leading slash
+                face_encoding=np.asarray(encoding, dtype=np.float64).tobytes(),
+                encoder_version=encoder.version,
+                chip=save_chip(chip, encoder.model),
+            )
+
+        faces = [{
+            'id': None,
+            'picture': citizen.picture,
+            'thumbnail_url': thumbnail_url(citizen.picture),
+            'chip_url': _chip_url(citizen.chip_id),
+            'primary': True,
+            'created_at': citizen.created_at.isoformat()
+        }]
+        faces += [
+            {
+                'id': face.id,
+                'picture': face.picture,
+                'thumbnail_url': thumbnail_url(face.picture),
+                'chip_url': _chip_url(face.chip_id),
+                'primary': False,
+                'created_at': face.created_at.isoformat()
+            }
+            for face in citizen.faces.order_by('id')
+        ]
+
+        return JsonResponse({
+            'success': True,
+            'citizen_id': citizen.id,
+            'faces': faces
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
 @require_http_methods(["GET"])
 def api_reports_statistics(request):
     try:
@@ -435,13 +659,15 @@ def api_reports_statistics(request):
         ).order_by('-match_count')[:10]
         
         # Recent detections
-        recent_detections = DetectionEvent.objects.filter(
+        recent_detections = list(DetectionEvent.objects.filter(
             created_at__gte=start_date
         ).order_by('-created_at')[:20].values(
             'id', 'image_name', 'image_path', 'total_faces_detected', 
             'known_faces_matched', 'unknown_faces_detected',
             'processing_time_seconds', 'created_at'
-        )
+        ))
+        for detection in recent_detections:
+            detection['thumbnail_url'] = thumbnail_url(detection['image_path'])
         
         return JsonResponse({
             'success': True,
@@ -456,7 +682,7 @@ def api_reports_statistics(request):
                 },
                 'daily_stats': daily_stats,
                 'top_matches': list(top_matches),
-                'recent_detections': list(recent_detections)
+                'recent_detections': recent_detections
             }
         })
     except Exception as e:
@@ -466,6 +692,28 @@ def api_reports_statistics(request):
         }, status=500)
 
 
+@require_http_methods(["GET"])
+def api_ingest_stats(request):
+    try:
+        with open(settings.INGEST_STATS_FILE) as f:
+            stats = json.load(f)
+    except FileNotFoundError:
+        return JsonResponse({
+            'success': False,
+            'error': 'The ingestion service has not reported any stats yet'
+        }, status=404)
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+    return JsonResponse({
+        'success': True,
+        'stats': stats
+    })
+
+
 @require_http_methods(["GET"])
 def api_test_media(request):
     """Test endpoint to check media file serving"""
@@ -507,13 +755,277 @@ def api_update_citizen_status(request, citizen_id, action):
             citizen.status = 'Free'
         
         citizen.save()
+        update_gallery_status(citizen.id, citizen.status)
+        
+        # Look for earlier sightings among stored unknown faces in the background
+        retro_search = start_retro_search(citizen.id) if action == 'wanted' else None
         
         return JsonResponse({
             'success': True,
-            'message': f'Status updated to {citizen.status}'
+            'message': f'Status updated to {citizen.status}',
+            'retro_search_id': retro_search.id if retro_search else None
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@require_http_methods(["GET"])
+def api_citizen_sightings(request, citizen_id):
+    """Results of the latest retroactive search for a citizen, closest sightings first"""
+    try:
+        retro_search = RetroSearch.objects.filter(person_id=citizen_id).order_by('-created_at', '-id').first()
+        if retro_search is None:
+            return JsonResponse({
+                'success': False,
+                'error': 'No retroactive search has been run for this citizen'
+            }, status=404)
+
+        sightings = []
+        for sighting in retro_search.sightings.select_related('detection_match__detection_event'):
+            match = sighting.detection_match
+            event = match.detection_event
+            sightings.append({
+                'detection_match_id': match.id,
+                'detection_event_id': event.id,
+                'distance': round(sighting.distance, 4),
+                'confidence': round(max(0.0, 1.0 - sighting.distance) * 100.0, 2),
+                'image_path': event.image_path,
+                'thumbnail_url': thumbnail_url(event.image_path),
+                'chip_url': _chip_url(match.chip_id),
+                'detection_method': event.detection_method,
+                'seen_at': match.created_at.isoformat(),
+                'box': [match.face_top, match.face_right, match.face_bottom, match.face_left],
+                'first_seen_seconds': match.first_seen_seconds,
+                'last_seen_seconds': match.last_seen_seconds,
+            })
+
+        return JsonResponse({
+            'success': True,
+            'retro_search': {
+                'id': retro_search.id,
+                'status': retro_search.status,
+                'faces_searched': retro_search.faces_searched,
+                'error': retro_search.error,
+                'created_at': retro_search.created_at.isoformat(),
+                'completed_at': retro_search.completed_at.isoformat() if retro_search.completed_at else None,
+            },
+            'sightings': sightings
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@require_http_methods(["GET"])
+def api_unknown_clusters(request):
+    """Clusters of recurring unknown faces, largest (?order=size) or most recently seen (?order=recent) first"""
+    try:
+        order = request.GET.get('order', 'size')
+        if order not in ('size', 'recent'):
+            return JsonResponse({
+                'success': False,
+                'error': "order must be 'size' or 'recent'"
+            }, status=400)
+        try:
+            limit = min(max(int(request.GET.get('limit', 20)), 1), 100)
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'error': 'limit must be a number'
+            }, status=400)
+
+        ordering = ['-size', '-last_seen_at'] if order == 'size' else ['-last_seen_at', '-size']
+        clusters = []
+        for cluster in UnknownCluster.objects.order_by(*ordering)[:limit]:
+            # A few of the latest faces, so the cluster can be shown and identified
+            samples = cluster.matches.select_related('detection_event').order_by('-created_at')[:3]
+            clusters.append({
+                'id': cluster.id,
+                'size': cluster.size,
+                'first_seen_at': cluster.first_seen_at.isoformat(),
+                'last_seen_at': cluster.last_seen_at.isoformat(),
+                'samples': [
+                    {
+                        'detection_match_id': match.id,
+                        'detection_event_id': match.detection_event_id,
+                        'image_path': match.detection_event.image_path,
+                        'thumbnail_url': thumbnail_url(match.detection_event.image_path),
+                        'chip_url': _chip_url(match.chip_id),
+                        'box': [match.face_top, match.face_right, match.face_bottom, match.face_left],
+                        'seen_at': match.created_at.isoformat(),
+                    }
+                    for match in samples
+                ],
+            })
+
+        return JsonResponse({
+            'success': True,
+            'clusters': clusters
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@require_http_methods(["GET"])
+def api_reembed_jobs(request):
+    """The active encoder version and the progress of the latest re-embedding jobs (started with the reembed command)"""
+    try:
+        jobs = []
+        for job in ReembedJob.objects.order_by('-id')[:10]:
+            jobs.append({
+                'id': job.id,
+                'encoder_version': job.encoder_version,
+                'status': job.status,
+                'processed': job.processed,
+                'total': job.total,
+                'failed': job.failed,
+                'percent': round(100.0 * job.processed / job.total, 1) if job.total else 0.0,
+                'error': job.error,
+                'created_at': job.created_at.isoformat(),
+                'updated_at': job.updated_at.isoformat(),
+                'completed_at': job.completed_at.isoformat() if job.completed_at else None,
+            })
+
+        return JsonResponse({
+            'success': True,
+            'active_encoder_version': active_encoder().version,
+            'jobs': jobs
         })
     except Exception as e:
         return JsonResponse({
             'success': False,
             'error': str(e)
         }, status=500)
+
+
+def _chip_url(chip_id):
+    return reverse('api_face_chip', args=[chip_id]) if chip_id else None
+
+
+@require_http_methods(["GET"])
+def api_face_chip(request, chip_id):
+    """The aligned 150x150 face chip stored for a detected or enrolled face, as a WebP image"""
+    try:
+        if settings.MEDIA_REQUIRE_LOGIN and not request.session.get("id"):
+            return JsonResponse({
+                'success': False,
+                'error': 'Not logged in'
+            }, status=403)
+
+        chip = FaceChip.objects.filter(pk=chip_id).first()
+        if chip is None:
+            return JsonResponse({
+                'success': False,
+                'error': 'Face chip not found'
+            }, status=404)
+
+        # Stored chips are never rewritten, so the id names the content
+        etag = '"chip-{}"'.format(chip.id)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(read_chip(chip), content_type='image/webp')
+        response['ETag'] = etag
+        response['Cache-Control'] = IMMUTABLE
+        return response
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@require_http_methods(["GET"])
+def api_thumbnail(request, size, path):
+    """
+    A cached thumbnail of a media image (citizen picture or detection upload), at most size pixels on its
+    longest side. WebP when the client accepts it (or ?format=webp), JPEG otherwise.
+    """
+    try:
+        if settings.MEDIA_REQUIRE_LOGIN and not request.session.get("id"):
+            return JsonResponse({
+                'success': False,
+                'error': 'Not logged in'
+            }, status=403)
+
+        image_format = request.GET.get('format')
+        if image_format not in ('webp', 'jpeg'):
+            image_format = 'webp' if 'image/webp' in request.META.get('HTTP_ACCEPT', '') else 'jpeg'
+
+        path = media_path(path)
+        if path is None:
+            return JsonResponse({
+                'success': False,
+                'error': 'Image not found'
+            }, status=404)
+        try:
+            thumbnail = get_thumbnail(path, size, image_format)
+        except (FileNotFoundError, IsADirectoryError):
+            return JsonResponse({
+                'success': False,
+                'error': 'Image not found'
+            }, status=404)
+        except PIL.UnidentifiedImageError:
+            return JsonResponse({
+                'success': False,
+                'error': 'Not an image'
+            }, status=400)
+
+        # Cached thumbnails are named after their source's version, size and format, so the name is a
+        # strong validator, and a URL naming the current version can be cached for good
+        version = request.GET.get('v')
+        response = serve_file(
+            request, thumbnail, content_type=content_type(image_format),
+            etag='"{}"'.format(os.path.basename(thumbnail)),
+            cache_control=IMMUTABLE if version == thumbnail_version(thumbnail) else REVALIDATE,
+        )
+        # The format depends on the Accept header
+        response['Vary'] = 'Accept'
+        return response
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
+@require_http_methods(["GET", "HEAD"])
+def media_file(request, path):
+    """
+    A file under MEDIA_ROOT (citizen picture, detection upload), served at MEDIA_URL with an ETag, Range
+    support and X-Sendfile/X-Accel-Redirect when configured. Anonymous clients are refused when
+    settings.MEDIA_REQUIRE_LOGIN is set.
+    """
+    try:
+        if settings.MEDIA_REQUIRE_LOGIN and not request.session.get("id"):
+            return JsonResponse({
+                'success': False,
+                'error': 'Not logged in'
+            }, status=403)
+
+        path = media_path(path)
+        # Dotfiles (e.g. editor or upload leftovers) are never served
+        if path is None or any(part.startswith('.') for part in path.split('/')):
+            return JsonResponse({
+                'success': False,
+                'error': 'File not found'
+            }, status=404)
+        try:
+            return serve_file(request, os.path.join(settings.MEDIA_ROOT, path))
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return JsonResponse({
+                'success': False,
+                'error': 'File not found'
+            }, status=404)
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
@@ -0,0 +1,229 @@
+import csv
+import functools
+import io
+import json
+import os
+import time
+import zipfile
+
+import numpy as np
+import face_recognition
+
+from main.video import process_pool
+
+REQUIRED_FIELDS = ('name', 'national_id', 'address', 'image')
+
+
+def read_manifest(f, name=''):
+    """
+    Read a CSV (with a header row) or JSONL manifest of citizens to enroll.
+
+    Each row needs name, national_id, address and image, the file name of the
+    citizen's picture in the image folder or zip ("picture" is accepted for
+    image). Rows are returned as dicts with their 1-based manifest line.
+    """
+    text = io.TextIOWrapper(f, encoding='utf-8') if not isinstance(f, io.TextIOBase) else f
+    if name.endswith('.jsonl') or name.endswith('.json'):
+        rows = []
+        for line_number, line in enumerate(text, 1):
+            if line.strip():
+                rows.append(dict(json.loads(line), line=line_number))
+    else:
+        # Line 1 is the header
+        rows = [dict(row, line=line_number) for line_number, row in enumerate(csv.DictReader(text), 2)]
+
+    for row in rows:
+        if not row.get('image') and row.get('picture'):
+            row['image'] = row['picture']
+    return rows
+
+
+class FolderImages:
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, name):
+        path = os.path.join(self.path, name)
+        # Manifest names must stay inside the folder
+        if os.path.commonpath([os.path.abspath(path), os.path.abspath(self.path)]) != os.path.abspath(self.path):
+            raise IOError("Image path escapes the image folder: {}".format(name))
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class ZipImages:
+    def __init__(self, f):
+        self.zip = zipfile.ZipFile(f)
+
+    def read(self, name):
+        try:
+            return self.zip.read(name)
+        except KeyError:
+            raise IOError("No such image in the zip: {}".format(name))
+
+
+def open_images(source):
+    """Image folder path, zip file path or zip file object -> an object whose read(name) returns image bytes."""
+    if isinstance(source, str) and os.path.isdir(source):
+        return FolderImages(source)
+    return ZipImages(source)
+
+
+def _encode_image(data, num_jitters=1, model="small"):
+    # Runs in a pool worker, so it takes and returns plain values
+    try:
+        image = face_recognition.load_image_file(io.BytesIO(data))
+        chips = face_recognition.face_chips(image, model=model)[:1]
+        encodings = face_recognition.chip_encodings(chips, num_jitters)
+    except Exception as e:
+        return None, None, "Could not read image: {}".format(e)
+    if not encodings:
+        return None, None, "No face found in the image"
+    return encodings[0], chips[0], None
+
+
+def enroll_citizens(rows, images, workers=None, batch_size=200, threshold=None, progress=None):
+    """
+    Enroll citizens from manifest rows in batches.
+
+    Pictures are decoded and encoded on a process pool; each batch of
+    accepted rows is saved to media storage, with its aligned face chips,
+    and inserted with bulk_create.
+    Rows whose National ID is already enrolled are skipped, so rerunning the
+    same manifest after an interruption resumes where it stopped.
+
+    :param rows: manifest rows from read_manifest
+    :param images: an image source from open_images
+    :param workers: pool size for decoding and encoding. None uses every core, 1 runs inline.
+    :param threshold: reject faces this close to an enrolled citizen or an earlier row. None disables the check.
+    :param progress: called with the report so far after every batch
+    :return: a report dict with counts, throughput and a list of per-row failures
+    """
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import FileSystemStorage
+    from main.chips import save_chips
+    from main.gallery import get_gallery
+    from main.models import Person
+
+    started = time.time()
+    report = {'rows': len(rows), 'enrolled': 0, 'skipped': 0, 'failed': 0, 'failures': []}
+    fs = FileSystemStorage()
+    gallery = get_gallery()
+    encode = functools.partial(_encode_image, num_jitters=gallery.encoder.num_jitters, model=gallery.encoder.model)
+    # Encodings enrolled by this run, checked alongside the gallery
+    enrolled = _EnrolledFaces()
+    seen_ids = set()
+
+    def fail(row, error):
+        report['failed'] += 1
+        report['failures'].append({'line': row.get('line'), 'national_id': row.get('national_id'), 'error': error})
+
+    pool = process_pool(workers) if workers != 1 else None
+    try:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            existing = set(Person.objects.filter(
+                national_id__in=[row.get('national_id') for row in batch]
+            ).values_list('national_id', flat=True))
+
+            pending = []
+            for row in batch:
+                missing = [field for field in REQUIRED_FIELDS if not row.get(field)]
+                if missing:
+                    fail(row, "Missing {}".format(", ".join(missing)))
+                elif row['national_id'] in existing:
+                    report['skipped'] += 1
+                elif row['national_id'] in seen_ids:
+                    fail(row, "National ID appears earlier in the manifest")
+                else:
+                    try:
+                        pending.append((row, images.read(row['image'])))
+                        seen_ids.add(row['national_id'])
+                    except IOError as e:
+                        fail(row, str(e))
+
+            data = [image for _, image in pending]
+            results = pool.map(encode, data) if pool is not None else map(encode, data)
+
+            people = []
+            encodings = []
+            chips = []
+            for (row, image), (encoding, chip, error) in zip(pending, results):
+                if error:
+                    fail(row, error)
+                    continue
+                if threshold is not None:
+                    duplicate = _find_duplicate(gallery, enrolled, encoding, threshold)
+                    if duplicate:
+                        fail(row, duplicate)
+                        continue
+                    enrolled.add(row['national_id'], encoding)
+
+                filename = fs.save(os.path.basename(row['image']), ContentFile(image))
+                people.append(Person(
+                    name=row['name'],
+                    national_id=row['national_id'],
+                    address=row['address'],
+                    picture=fs.url(filename)[1:],
+                    status="Free",
+                ))
+                encodings.append(encoding)
+                chips.append(chip)
+
+            for person, chip in zip(people, save_chips(chips, gallery.encoder.model)):
+                person.chip = chip
+            Person.objects.bulk_create(people)
+            report['enrolled'] += len(people)
+            for person, encoding in zip(people, encodings):
+                # Backends that do not return ids from bulk_create just encode the picture again on refresh
+                if person.id is not None:
+                    gallery.remember(person, encoding)
+
+            report['elapsed_seconds'] = round(time.time() - started, 2)
+            report['rows_per_second'] = round((start + len(batch)) / max(time.time() - started, 1e-6), 2)
+            if progress is not None:
+                progress(report)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    report['elapsed_seconds'] = round(time.time() - started, 2)
+    report['rows_per_second'] = round(len(rows) / max(time.time() - started, 1e-6), 2)
+    report['failures'].sort(key=lambda failure: failure['line'] or 0)
+    return report
+
+
+class _EnrolledFaces:
+    # Grows by doubling, so checking each row against every earlier row does not copy the matrix per row
+
+    def __init__(self):
+        self.national_ids = []
+        self._matrix = np.empty((0, 128))
+
+    def add(self, national_id, encoding):
+        count = len(self.national_ids)
+        if count == len(self._matrix):
+            grown = np.empty((max(256, 2 * count), 128))
+            grown[:count] = self._matrix[:count]
+            self._matrix = grown
+        self._matrix[count] = encoding
+        self.national_ids.append(national_id)
+
+    def nearest(self, encoding):
+        indices, distances = face_recognition.search_gallery(self._matrix[:len(self.national_ids)], encoding, k=1)
+        if not len(indices):
+            return None, None
+        return self.national_ids[int(indices[0])], float(distances[0])
+
+
+def _find_duplicate(gallery, enrolled, encoding, threshold):
+    duplicates = gallery.duplicates(encoding, threshold, k=1)
+    if duplicates:
+        return "Face is already enrolled as citizen {} (National ID {})".format(
+            duplicates[0]['person_id'], duplicates[0]['national_id'])
+
+    national_id, distance = enrolled.nearest(encoding)
+    if national_id is not None and distance <= threshold:
+        return "Same face as National ID {} earlier in the manifest".format(national_id)
+    return None
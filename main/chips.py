@@ -0,0 +1,157 @@
+import contextlib
+import io
+import os
+import re
+
+import numpy as np
+import PIL.Image
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are not serialized across processes
+    fcntl = None
+
+
+SEGMENT_NAME = re.compile(r'^chips-(\d{6})\.bin$')
+
+
+def encode_chip(chip):
+    """Compress a face chip array to lossless WebP bytes, so re-encoding the stored chip gives the same encoding."""
+    buffer = io.BytesIO()
+    PIL.Image.fromarray(np.asarray(chip, dtype=np.uint8)).save(buffer, 'WEBP', lossless=True)
+    return buffer.getvalue()
+
+
+def decode_chip(data):
+    """Decode stored chip bytes back into a 150x150x3 uint8 RGB array."""
+    return np.array(PIL.Image.open(io.BytesIO(data)).convert('RGB'))
+
+
+class ChipStore:
+    """
+    Aligned face chips packed back to back into append-only segment files.
+
+    A chip is a few tens of kilobytes where its original upload or video
+    frame is megabytes, so showing a face or encoding it again reads one
+    small record instead of decoding the original. A FaceChip row records
+    the segment, offset and length of each chip. Segments are closed once
+    they pass segment_size bytes, so no file grows without bound.
+
+    Records are never rewritten, so readers need no locking; appends take
+    an exclusive lock across processes.
+    """
+
+    def __init__(self, directory, segment_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+
+    def path(self, segment):
+        return os.path.join(self.directory, "chips-{:06d}.bin".format(segment))
+
+    def append(self, records):
+        """
+        Append chip records (bytes) to the current segment.
+
+        :return: a (segment, offset, length) tuple for each record
+        """
+        if not records:
+            return []
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock():
+            segment = self._current_segment()
+            path = self.path(segment)
+            if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+                segment += 1
+                path = self.path(segment)
+
+            locations = []
+            with open(path, 'ab') as f:
+                offset = f.tell()
+                for record in records:
+                    f.write(record)
+                    locations.append((segment, offset, len(record)))
+                    offset += len(record)
+                f.flush()
+                os.fsync(f.fileno())
+        return locations
+
+    def read(self, segment, offset, length):
+        with open(self.path(segment), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise IOError("Face chip at {}:{} is truncated".format(segment, offset))
+        return data
+
+    def _current_segment(self):
+        segments = [int(match.group(1)) for match in map(SEGMENT_NAME.match, os.listdir(self.directory)) if match]
+        return max(segments, default=0)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+
+        with open(os.path.join(self.directory, 'chips.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+_store = None
+
+
+def get_chip_store():
+    """The process-wide ChipStore in settings.FACE_CHIP_DIR."""
+    # Django is imported lazily so pool workers can import this module to decode chips
+    global _store
+    if _store is None:
+        from django.conf import settings
+        _store = ChipStore(settings.FACE_CHIP_DIR)
+    return _store
+
+
+def save_chips(chips, landmark_model):
+    """
+    Store face chips (arrays from face_recognition.face_chips, or None) and create their FaceChip rows.
+
+    :param landmark_model: the landmark model the chips were aligned with
+    :return: a FaceChip, or None, for each chip
+    """
+    from django.db import connection
+    from main.models import FaceChip
+
+    present = [chip for chip in chips if chip is not None]
+    locations = get_chip_store().append([encode_chip(chip) for chip in present])
+    rows = [
+        FaceChip(segment=segment, offset=offset, length=length, landmark_model=landmark_model)
+        for segment, offset, length in locations
+    ]
+    if connection.features.can_return_rows_from_bulk_insert:
+        FaceChip.objects.bulk_create(rows)
+    else:
+        # The rows need their ids to be referenced
+        for row in rows:
+            row.save()
+
+    rows = iter(rows)
+    return [next(rows) if chip is not None else None for chip in chips]
+
+
+def save_chip(chip, landmark_model):
+    """Store one face chip; returns its FaceChip, or None when chip is None."""
+    return save_chips([chip], landmark_model)[0]
+
+
+def read_chip(face_chip):
+    """The stored WebP bytes of a FaceChip."""
+    return get_chip_store().read(face_chip.segment, face_chip.offset, face_chip.length)
+
+
+def load_chip(face_chip):
+    """A FaceChip as a 150x150x3 uint8 RGB array."""
+    return decode_chip(read_chip(face_chip))
@@ -0,0 +1,202 @@
+import threading
+from datetime import timedelta
+
+import numpy as np
+import face_recognition
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from main.models import DetectionMatch, UnknownCluster
+
+
+def pack_centroid(centroid):
+    return np.asarray(centroid, dtype=np.float64).tobytes()
+
+
+def unpack_centroid(data):
+    return np.frombuffer(bytes(data), dtype=np.float64).copy()
+
+
+class ClusterIndex:
+    """
+    Online nearest-centroid clustering of unknown faces.
+
+    Each new unknown face joins the closest cluster whose centroid is within
+    `tolerance`, moving the centroid to the running mean of its faces, or
+    starts a new cluster. When an updated centroid ends up within
+    `merge_distance` of another cluster the two are merged, so a person
+    first split across clusters converges into one as more faces arrive.
+
+    Centroids are kept in memory in one matrix and scanned with
+    face_recognition.search_gallery; there are far fewer clusters than faces.
+    The database is the source of truth: clusters changed by other processes
+    are picked up on the next assignment, and each assignment re-reads the
+    cluster it updates under a row lock.
+
+    Only clusters of one encoder version are indexed at a time; a face
+    encoded with another version switches the index over to that version's
+    clusters, so faces are never clustered across versions.
+    """
+
+    # Clusters updated this long before the last sync are re-read, to cover transactions still committing then
+    sync_slack = timedelta(seconds=5)
+
+    def __init__(self, tolerance=0.5, merge_distance=0.4):
+        self._lock = threading.Lock()
+        self.tolerance = tolerance
+        self.merge_distance = merge_distance
+        self.ids = []
+        self.sizes = []
+        # cluster id -> row in the centroid matrix
+        self._rows = {}
+        self._centroids = np.empty((0, 128))
+        self._synced_at = None
+        self.encoder_version = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def centroids(self):
+        return self._centroids[:len(self.ids)]
+
+    def _put(self, cluster_id, centroid, size):
+        row = self._rows.get(cluster_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self._centroids):
+                grown = np.empty((max(64, 2 * row), 128))
+                grown[:row] = self._centroids[:row]
+                self._centroids = grown
+            self.ids.append(cluster_id)
+            self.sizes.append(size)
+            self._rows[cluster_id] = row
+        self._centroids[row] = centroid
+        self.sizes[row] = size
+
+    def _remove(self, cluster_id):
+        row = self._rows.pop(cluster_id, None)
+        if row is None:
+            return
+        # Move the last cluster into the freed row so the matrix stays contiguous
+        last = len(self.ids) - 1
+        if row != last:
+            moved = self.ids[last]
+            self.ids[row] = moved
+            self.sizes[row] = self.sizes[last]
+            self._centroids[row] = self._centroids[last]
+            self._rows[moved] = row
+        self.ids.pop()
+        self.sizes.pop()
+
+    def _sync(self):
+        for full in (self._synced_at is None, True):
+            started = timezone.now()
+            if full:
+                self.ids, self.sizes, self._rows = [], [], {}
+
+            clusters = UnknownCluster.objects.filter(encoder_version=self.encoder_version)
+            if not full:
+                clusters = clusters.filter(updated_at__gte=self._synced_at)
+            for cluster_id, centroid, size in clusters.values_list('id', 'centroid', 'size').iterator():
+                self._put(cluster_id, unpack_centroid(centroid), size)
+
+            self._synced_at = started - self.sync_slack
+            # Another process merged clusters away since the last sync, so reload everything once
+            if full or UnknownCluster.objects.filter(encoder_version=self.encoder_version).count() == len(self.ids):
+                return
+
+    def assign(self, face_encoding, encoder_version, seen_at=None):
+        """
+        Add an unknown face encoding to its cluster.
+
+        :param encoder_version: version of the encoder the face was encoded with
+        :return: the id of the UnknownCluster the face now belongs to
+        """
+        face_encoding = np.asarray(face_encoding, dtype=np.float64)
+        seen_at = seen_at or timezone.now()
+
+        with self._lock:
+            if encoder_version != self.encoder_version:
+                self.encoder_version = encoder_version
+                self._synced_at = None
+            try:
+                with transaction.atomic():
+                    return self._assign(face_encoding, seen_at)
+            except Exception:
+                # The in-memory clusters may be ahead of a rolled back transaction
+                self._synced_at = None
+                raise
+
+    def _assign(self, face_encoding, seen_at):
+        self._sync()
+
+        cluster = None
+        indices, distances = face_recognition.search_gallery(self.centroids, face_encoding, k=1)
+        if len(indices) and distances[0] <= self.tolerance:
+            cluster_id = self.ids[int(indices[0])]
+            cluster = UnknownCluster.objects.select_for_update().filter(pk=cluster_id).first()
+            if cluster is None:
+                # Merged away by another process since the last sync
+                self._remove(cluster_id)
+
+        if cluster is None:
+            cluster = UnknownCluster.objects.create(
+                centroid=pack_centroid(face_encoding), size=1, first_seen_at=seen_at, last_seen_at=seen_at,
+                encoder_version=self.encoder_version,
+            )
+            self._put(cluster.id, face_encoding, 1)
+            return cluster.id
+
+        size = cluster.size + 1
+        centroid = unpack_centroid(cluster.centroid)
+        centroid += (face_encoding - centroid) / size
+        cluster.centroid = pack_centroid(centroid)
+        cluster.size = size
+        cluster.last_seen_at = max(cluster.last_seen_at, seen_at)
+        cluster.save()
+        self._put(cluster.id, centroid, size)
+
+        return self._merge_nearest(cluster)
+
+    def _merge_nearest(self, cluster):
+        centroid = self._centroids[self._rows[cluster.id]]
+        indices, distances = face_recognition.search_gallery(self.centroids, centroid, k=2)
+        for index, distance in zip(indices, distances):
+            other_id = self.ids[int(index)]
+            if other_id != cluster.id and distance <= self.merge_distance:
+                return self._merge(cluster.id, other_id)
+        return cluster.id
+
+    def _merge(self, cluster_id, other_id):
+        clusters = {c.id: c for c in UnknownCluster.objects.select_for_update().filter(pk__in=[cluster_id, other_id])}
+        if len(clusters) < 2:
+            return cluster_id
+
+        # The larger cluster keeps its id
+        keep, absorb = sorted(clusters.values(), key=lambda c: (-c.size, c.id))
+        size = keep.size + absorb.size
+        centroid = (unpack_centroid(keep.centroid) * keep.size + unpack_centroid(absorb.centroid) * absorb.size) / size
+
+        DetectionMatch.objects.filter(unknown_cluster=absorb).update(unknown_cluster=keep)
+        keep.centroid = pack_centroid(centroid)
+        keep.size = size
+        keep.first_seen_at = min(keep.first_seen_at, absorb.first_seen_at)
+        keep.last_seen_at = max(keep.last_seen_at, absorb.last_seen_at)
+        keep.save()
+        # delete() clears the instance's id
+        absorb_id = absorb.id
+        absorb.delete()
+
+        self._remove(absorb_id)
+        self._put(keep.id, centroid, size)
+        return keep.id
+
+
+_index = ClusterIndex(settings.UNKNOWN_CLUSTER_TOLERANCE, settings.UNKNOWN_CLUSTER_MERGE_DISTANCE)
+
+
+def assign_unknown_face(face_encoding, encoder_version, seen_at=None):
+    """Assign an unknown face encoding to a cluster of recurring unknown faces, returning the cluster id."""
+    return _index.assign(face_encoding, encoder_version, seen_at)
@@ -0,0 +1,39 @@
+from collections import namedtuple
+
+import face_recognition
+from django.conf import settings
+
+from main.models import ReembedJob
+
+
+# The face_encodings settings stored encodings are computed with, and the version string they are tagged with
+EncoderConfig = namedtuple('EncoderConfig', ['version', 'num_jitters', 'model'])
+
+
+def encoder_config(num_jitters=None, model=None):
+    """Build an EncoderConfig, defaulting to settings.FACE_ENCODING_JITTERS and settings.FACE_LANDMARK_MODEL."""
+    num_jitters = settings.FACE_ENCODING_JITTERS if num_jitters is None else num_jitters
+    model = model or settings.FACE_LANDMARK_MODEL
+    return EncoderConfig(face_recognition.encoder_version(num_jitters, model), num_jitters, model)
+
+
+def active_encoder():
+    """
+    Return the EncoderConfig new encodings are computed with.
+
+    Until a re-embedding job completes this is the one in settings; after that it is the last completed job's,
+    so switching versions on a populated registry goes through a job that has already re-encoded it.
+    """
+    job = ReembedJob.objects.filter(status='done').order_by('-completed_at', '-id').first()
+    if job is None:
+        return encoder_config()
+    return EncoderConfig(job.encoder_version, job.num_jitters, job.landmark_model)
+
+
+def quality_thresholds():
+    """The face_recognition.face_quality thresholds from settings, as keyword arguments."""
+    return {
+        'min_size': settings.FACE_MIN_SIZE,
+        'min_sharpness': settings.FACE_MIN_SHARPNESS,
+        'max_yaw': settings.FACE_MAX_YAW,
+    }
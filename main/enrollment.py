@@ -0,0 +1,53 @@
+import face_recognition
+from django.conf import settings
+
+from main.chips import save_chip
+from main.gallery import get_gallery
+
+
+def encode_picture_file(path, gallery=None):
+    """
+    Encode the first face in an image file.
+
+    :return: a tuple of (encoding, aligned face chip), both None when no face is found
+    """
+    gallery = gallery or get_gallery()
+    image = face_recognition.load_image_file(path)
+    chips = gallery.face_chips(image)
+    if not chips:
+        return None, None
+    return gallery.chip_encodings(chips[:1])[0], chips[0]
+
+
+def check_enrollment(path, threshold=None, exclude=None):
+    """
+    Encode a new citizen's picture once and look for enrolled citizens with the same face.
+
+    :param path: filesystem path of the uploaded picture
+    :param threshold: face distance under which two citizens count as the same person
+                      (default: settings.ENROLLMENT_DUPLICATE_THRESHOLD)
+    :param exclude: id of a citizen not to report, when adding another face of an enrolled citizen
+    :return: a tuple of (encoding, or None when the picture has no face, the conflicting citizens as
+             Gallery.search dicts, closest first, and the aligned face chip to store with save_chip)
+    """
+    if threshold is None:
+        threshold = settings.ENROLLMENT_DUPLICATE_THRESHOLD
+
+    gallery = get_gallery()
+    encoding, chip = encode_picture_file(path, gallery)
+    if encoding is None:
+        return None, [], None
+    return encoding, gallery.duplicates(encoding, threshold, exclude=exclude), chip
+
+
+def remember_enrollment(person, encoding, chip=None):
+    """
+    Store the face chip cut at enrollment with the citizen, and hand the encoding computed at enrollment to
+    the gallery so the picture is not encoded again.
+    """
+    gallery = get_gallery()
+    if chip is not None:
+        person.chip = save_chip(chip, gallery.encoder.model)
+        person.save(update_fields=['chip'])
+    if encoding is not None:
+        gallery.remember(person, encoding)
@@ -0,0 +1,559 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import unquote
+
+import numpy as np
+import face_recognition
+from django.conf import settings
+
+from django.db.models import Count, Max
+
+from main.encoders import active_encoder, quality_thresholds
+from main.models import Person, PersonFace, ReembedResult
+from main.shared_gallery import SharedGalleryFile
+
+
+# One immutable snapshot of the gallery, swapped in whole on refresh so
+# readers never see ids from one refresh and encodings from another.
+# encoder is the main.encoders.EncoderConfig every encoding in it was computed with.
+GalleryState = namedtuple('GalleryState', [
+    'ids', 'names', 'statuses', 'national_ids', 'matrix', 'compact', 'partitions', 'extras', 'encoder',
+])
+
+# Citizens with additional enrollment faces (PersonFace rows). Each has one template row, the mean of all
+# their faces, used to find candidates, and its exemplars (every face, primary picture included) in
+# exemplars[offsets[i]:offsets[i + 1]], used to score a candidate by their closest face.
+ExtraFaces = namedtuple('ExtraFaces', [
+    'ids', 'names', 'statuses', 'national_ids', 'templates', 'offsets', 'exemplars', 'index',
+])
+
+EMPTY_EXTRAS = ExtraFaces([], [], [], [], np.empty((0, 128)), np.zeros(1, dtype=np.int64), np.empty((0, 128)), {})
+
+EMPTY_STATE = GalleryState([], [], [], [], np.empty((0, 128)), None, {}, EMPTY_EXTRAS, None)
+
+# The gallery rows of one status: their indices into the full gallery and a contiguous copy of their encodings
+Partition = namedtuple('Partition', ['indices', 'matrix'])
+
+
+class Gallery:
+    """
+    Cache of the known citizens' face encodings.
+
+    Every detection path used to reload and re-encode each Person picture on
+    every request. The gallery encodes a picture once and keeps the encoding
+    for as long as the row's picture and updated_at are unchanged, so a
+    refresh only costs one query plus encoding of new or edited citizens.
+
+    With a shared file the matrix lives in a memory-mapped SharedGalleryFile
+    that all worker processes on the host map read-only; the first worker to
+    notice the database changed rebuilds it under a lock and the others
+    re-map the new version.
+
+    With a compact dtype, searches scan a float16 or int8 copy of the matrix
+    and re-rank the best candidates against the exact float64 rows, so only
+    a handful of exact rows are read per search.
+
+    Citizens with a watchlist status (e.g. Wanted) are also kept in their own
+    small partition, so a probe can be checked against the watchlist first;
+    a watchlist hit is only reported when nobody else in the registry is
+    closer to the probe.
+
+    Citizens enrolled with additional faces are reduced to one mean template
+    each for the candidate search, and candidates are then scored by their
+    closest face, so search cost grows with citizens rather than faces.
+
+    Every encoding in the gallery is computed with the active encoder
+    (main.encoders.active_encoder). When a re-embedding job completes the
+    next refresh switches to its version in one step, starting from the
+    encodings the job staged, and PersonFace rows of other versions are left
+    out, so encodings of two versions are never compared.
+
+    :param shared_path: where to keep the shared gallery file, or None to keep the matrix in this process only
+                        (always the case where SharedGalleryFile is not supported)
+    :param compact_dtype: "float16" or "int8" to search a compact copy of the matrix, or None to search it directly
+    :param watchlist: statuses to keep a partition for
+    """
+
+    def __init__(self, shared_path=None, compact_dtype=None, watchlist=('Wanted',)):
+        self._lock = threading.Lock()
+        # person id -> ((picture, updated_at), encoding or None when no face was found)
+        self._encodings = {}
+        # signature of the rows the current matrix was built from
+        self._built_from = None
+        self.shared = SharedGalleryFile(shared_path) if shared_path and SharedGalleryFile.supported else None
+        self.compact_dtype = compact_dtype
+        self.watchlist = tuple(watchlist)
+        # PersonFace (encoder version, count, last id) the current extras were built from
+        self._faces_version = None
+        self._refreshed_at = None
+        self._stale_lock = threading.Lock()
+        self.state = EMPTY_STATE
+
+    def __len__(self):
+        return len(self.state.ids)
+
+    @property
+    def encoder(self):
+        """The EncoderConfig probes must be encoded with to be compared against this gallery."""
+        return self.state.encoder
+
+    def refresh(self):
+        encoder = active_encoder()
+        people = list(Person.objects.values_list('id', 'name', 'national_id', 'status', 'picture', 'updated_at'))
+        faces = PersonFace.objects.filter(encoder_version=encoder.version).aggregate(count=Count('id'), last=Max('id'))
+
+        with self._lock:
+            if self.state.encoder != encoder:
+                # Cached encodings are of another version; start from the ones re-embedding staged for this one
+                self._encodings = _staged_encodings(encoder.version)
+
+            rows = [row for row in people if row[4]]
+            if self.shared is None:
+                ids, matrix = self._refresh_local(rows, encoder)
+            else:
+                ids, matrix = self._refresh_shared(rows, encoder)
+
+            compact = self.state.compact
+            if matrix is not self.state.matrix:
+                compact = face_recognition.CompactEncodings(matrix, self.compact_dtype) if self.compact_dtype else None
+
+            meta = {row[0]: row for row in rows}
+            statuses = [meta[person_id][3] for person_id in ids]
+            partitions = self.state.partitions
+            if matrix is not self.state.matrix or statuses != self.state.statuses:
+                partitions = self._partitions(statuses, matrix)
+
+            extras = self.state.extras
+            faces_version = (encoder.version, faces['count'], faces['last'])
+            if matrix is not self.state.matrix or faces_version != self._faces_version:
+                extras = _build_extras(ids, matrix, encoder.version)
+                self._faces_version = faces_version
+            people = {row[0]: row for row in people}
+            extras = extras._replace(
+                names=[people[person_id][1] for person_id in extras.ids],
+                statuses=[people[person_id][3] for person_id in extras.ids],
+                national_ids=[people[person_id][2] for person_id in extras.ids],
+            )
+
+            self.state = GalleryState(
+                ids,
+                [meta[person_id][1] for person_id in ids],
+                statuses,
+                [meta[person_id][2] for person_id in ids],
+                matrix,
+                compact,
+                partitions,
+                extras,
+                encoder,
+            )
+            self._refreshed_at = time.monotonic()
+
+        return self
+
+    def refresh_if_stale(self, max_age):
+        """
+        Refresh when the last refresh is more than max_age seconds old, for long running users of the gallery
+        (streams, ingestion) that cannot afford a query per frame but must see new citizens and status changes.
+        Only one of several threads calling it at once does the refresh.
+        """
+        with self._stale_lock:
+            if self._refreshed_at is not None and time.monotonic() - self._refreshed_at < max_age:
+                return self
+            self._refreshed_at = time.monotonic()
+        return self.refresh()
+
+    def _partitions(self, statuses, matrix):
+        return {status: _partition(statuses, matrix, status) for status in self.watchlist}
+
+    def set_status(self, person_id, status):
+        """
+        Move a citizen to another status partition of this process's gallery without waiting for the next
+        refresh. Galleries in other processes (detect_stream, ingest_streams) pick the change up on their next
+        refresh_if_stale.
+        """
+        with self._lock:
+            state = self.state
+            if person_id in state.extras.index:
+                extra_statuses = list(state.extras.statuses)
+                extra_statuses[state.extras.index[person_id]] = status
+                state = state._replace(extras=state.extras._replace(statuses=extra_statuses))
+            if person_id in state.ids:
+                statuses = list(state.statuses)
+                statuses[state.ids.index(person_id)] = status
+                state = state._replace(statuses=statuses, partitions=self._partitions(statuses, state.matrix))
+            self.state = state
+
+    def _encode_rows(self, rows, encoder, reuse=None):
+        """Return {person id: ((picture, updated_at), encoding or None)}, encoding only pictures that are not cached."""
+        encodings = {}
+        missing = []
+
+        for person_id, name, national_id, status, picture, updated_at in rows:
+            key = (picture, updated_at)
+            cached = self._encodings.get(person_id)
+            if (cached is None or cached[0] != key) and reuse is not None:
+                cached = reuse(person_id, key)
+            if cached is not None and cached[0] == key:
+                encodings[person_id] = cached
+            else:
+                missing.append((person_id, key))
+
+        # New and edited pictures are decoded and encoded concurrently on threads
+        encode = functools.partial(_encode_picture, encoder=encoder)
+        new_encodings = face_recognition.map_faces([key[0] for _, key in missing], encode, settings.FACE_THREADS)
+        for (person_id, key), encoding in zip(missing, new_encodings):
+            encodings[person_id] = (key, encoding)
+
+        self._encodings = encodings
+        return encodings
+
+    def _refresh_local(self, rows, encoder):
+        signature = _signature(rows, encoder.version)
+        if signature == self._built_from:
+            return self.state.ids, self.state.matrix
+
+        encodings = self._encode_rows(rows, encoder)
+        ids = [row[0] for row in rows if encodings[row[0]][1] is not None]
+        matrix = np.array([encodings[person_id][1] for person_id in ids]) if ids else np.empty((0, 128))
+        self._built_from = signature
+        return ids, matrix
+
+    def _refresh_shared(self, rows, encoder):
+        store = self.shared
+        signature = _signature(rows, encoder.version)
+
+        if store.changed() or store.signature is None:
+            store.attach()
+
+        if store.signature != signature:
+            with store.lock():
+                # Another worker may have rebuilt it while we waited for the lock
+                store.attach()
+                if store.signature != signature:
+                    self._rebuild_shared(rows, encoder, signature)
+                    store.attach()
+
+        if store.signature == self._built_from:
+            return self.state.ids, self.state.matrix
+        self._built_from = store.signature
+        return [int(person_id) for person_id in store.ids[:store.faces]], store.matrix[:store.faces]
+
+    def _rebuild_shared(self, rows, encoder, signature):
+        store = self.shared
+        # Reuse rows from the current file whose picture and updated_at have not changed (keys include the encoder version)
+        existing = {
+            (int(person_id), int(key)): index
+            for index, (person_id, key) in enumerate(zip(store.ids, store.keys))
+        }
+
+        def reuse(person_id, key):
+            index = existing.get((person_id, _picture_key(key, encoder.version)))
+            if index is None:
+                return None
+            return key, (np.array(store.matrix[index]) if index < store.faces else None)
+
+        encodings = self._encode_rows(rows, encoder, reuse)
+        # The shared file is the cache now; keeping per-process copies would defeat it
+        self._encodings = {}
+
+        with_face = [row[0] for row in rows if encodings[row[0]][1] is not None]
+        without_face = [row[0] for row in rows if encodings[row[0]][1] is None]
+        ids = with_face + without_face
+        matrix = np.zeros((len(ids), 128))
+        for index, person_id in enumerate(with_face):
+            matrix[index] = encodings[person_id][1]
+
+        keys = [_picture_key(encodings[person_id][0], encoder.version) for person_id in ids]
+        store.publish(ids, keys, matrix, len(with_face), signature)
+
+    def face_encodings(self, face_image, known_face_locations=None):
+        """face_recognition.face_encodings with the gallery's encoder settings, so the encodings can be matched."""
+        encoder = self.state.encoder
+        return face_recognition.face_encodings(face_image, known_face_locations, encoder.num_jitters, encoder.model)
+
+    def face_chips(self, face_image, known_face_locations=None):
+        """face_recognition.face_chips aligned with the gallery's landmark model, to be encoded with chip_encodings."""
+        return face_recognition.face_chips(face_image, known_face_locations, self.state.encoder.model)
+
+    def face_quality(self, face_image, known_face_locations=None):
+        """
+        face_recognition.face_quality aligned with the gallery's landmark model and gated by the settings'
+        quality thresholds: a list of (chip, or None for faces not worth encoding, FaceQuality).
+        """
+        return face_recognition.face_quality(
+            face_image, known_face_locations, self.state.encoder.model, **quality_thresholds()
+        )
+
+    def chip_encodings(self, face_chips):
+        """face_recognition.chip_encodings with the gallery's encoder settings, so the encodings can be matched."""
+        return face_recognition.chip_encodings(face_chips, self.state.encoder.num_jitters)
+
+    def encoding_for(self, person_id):
+        """Return a citizen's encoding (their mean template if they have several faces), or None if not in the gallery."""
+        state = self.state
+        if person_id in state.extras.index:
+            return np.array(state.extras.templates[state.extras.index[person_id]])
+        try:
+            index = state.ids.index(person_id)
+        except ValueError:
+            return None
+        return np.array(state.matrix[index])
+
+    def remember(self, person, face_encoding):
+        """
+        Seed the encoding cache with an encoding already computed for a saved citizen's picture (e.g. at
+        enrollment), so the next refresh does not decode and encode the picture again.
+        """
+        with self._lock:
+            self._encodings[person.id] = ((str(person.picture), person.updated_at), face_encoding)
+
+    def duplicates(self, face_encoding, threshold=0.4, k=5, exclude=None):
+        """Return the citizens (as search() dicts) whose face is within threshold of an encoding, closest first."""
+        return [
+            found for found in self.search(face_encoding, k)
+            if found["distance"] <= threshold and found["person_id"] != exclude
+        ]
+
+    def duplicate_pairs(self, threshold=0.4, block_rows=512, block_columns=8192):
+        """
+        Yield (row, other row, distance) for every pair of gallery rows whose faces are within threshold.
+
+        Distances are computed a block at a time from |a|^2 + |b|^2 - 2 a.b, only for row < other row, so
+        auditing the whole registry never holds more than one block_rows x block_columns matrix.
+        """
+        matrix = self.state.matrix
+        count = len(matrix)
+        norms = np.einsum('ij,ij->i', matrix, matrix)
+
+        for start in range(0, count, block_rows):
+            end = min(start + block_rows, count)
+            rows = np.asarray(matrix[start:end])
+            for column_start in range(start, count, block_columns):
+                column_end = min(column_start + block_columns, count)
+                columns = np.asarray(matrix[column_start:column_end])
+                squared = norms[start:end, None] + norms[None, column_start:column_end] - 2 * rows @ columns.T
+                close = np.argwhere(squared <= threshold ** 2)
+                for i, j in close:
+                    row, other = start + int(i), column_start + int(j)
+                    if row < other:
+                        yield row, other, float(np.sqrt(max(squared[i, j], 0.0)))
+
+    def describe(self, row):
+        """The citizen at a gallery row, as a dict with person_id, name, status and national_id."""
+        return _describe(self.state, "gallery", row)
+
+    def search(self, face_encoding, k=5):
+        """Return the k closest citizens as dicts with person_id, name, status, national_id and distance, closest first."""
+        state = self.state
+        return [
+            dict(_describe(state, source, index), distance=distance)
+            for distance, source, index in _nearest(state, face_encoding, k)
+        ]
+
+    def unmatched(self):
+        """The detection dict, in match()'s shape, of a face that was not encoded (e.g. under the quality thresholds)."""
+        return _unknown(0.0)
+
+    def match(self, face_encoding, tolerance=0.5, statuses=None, fallback=True):
+        """
+        Find the closest known citizen for a face encoding.
+
+        Returns a detection dict in the shape used by the detection APIs;
+        'name' is "Unknown" when the closest citizen is further than tolerance.
+
+        :param statuses: check citizens with these statuses first (e.g. ('Wanted',)). One of them is only
+                         reported when it is within tolerance and no citizen with another status is closer;
+                         otherwise the face is closer to someone else and the closest citizen is reported
+                         instead (or "Unknown" without fallback). This keeps a look-alike on the watchlist
+                         from raising an alert for a registered citizen, while the exact search of the
+                         watchlist partition makes sure an approximate registry search cannot miss one.
+        :param fallback: with statuses, search the whole registry when none of them matched. Without it the
+                         answer is "Unknown" unless a citizen with one of the statuses matched.
+        """
+        state = self.state
+
+        if statuses:
+            best = _nearest(state, face_encoding, 1, statuses)
+            if best and best[0][0] <= tolerance:
+                nearest = _nearest(state, face_encoding, 1)
+                if not nearest or best[0][0] <= nearest[0][0]:
+                    return _detection(state, best, tolerance)
+                if not fallback:
+                    return _unknown(_confidence(nearest[0][0]))
+                return _detection(state, nearest, tolerance)
+            if not fallback:
+                return _detection(state, best, tolerance)
+
+        return _detection(state, _nearest(state, face_encoding, 1), tolerance)
+
+
+def _detection(state, best, tolerance):
+    if not best:
+        return _unknown(0.0)
+
+    best_distance, source, index = best[0]
+    confidence = _confidence(best_distance)
+
+    if best_distance > tolerance:
+        return _unknown(confidence)
+
+    detection = _describe(state, source, index)
+    detection["confidence"] = confidence
+    detection["status"] = detection["status"] or "Unknown"
+    return detection
+
+
+def _confidence(distance):
+    return round(max(0.0, (1.0 - distance)) * 100.0, 2)
+
+
+def _describe(state, source, index):
+    people = state if source == "gallery" else state.extras
+    return {
+        "person_id": people.ids[index],
+        "name": people.names[index],
+        "status": people.statuses[index],
+        "national_id": people.national_ids[index],
+    }
+
+
+def _nearest(state, face_encoding, k, statuses=None):
+    """
+    Return [(distance, source, index)] for the k closest citizens, closest first, where source is "gallery"
+    (index is a gallery row) or "extra" (index is an entry in state.extras).
+
+    Citizens with additional faces are scored by their closest face: candidates come from the primary
+    rows and the per-citizen templates, then each candidate with extra faces is re-scored on its exemplars.
+    """
+    extras = state.extras
+    candidates = max(4 * k, 32) if extras.ids else k
+    # person id -> (distance, source, index)
+    found = {}
+
+    if statuses:
+        for status in statuses:
+            partition = state.partitions.get(status) or _partition(state.statuses, state.matrix, status)
+            indices, distances = face_recognition.search_gallery(partition.matrix, face_encoding, candidates)
+            for row, distance in zip(partition.indices[indices], distances):
+                found[state.ids[row]] = (float(distance), "gallery", int(row))
+    elif len(state.ids):
+        indices, distances = _search(state, face_encoding, candidates)
+        for row, distance in zip(indices, distances):
+            found[state.ids[row]] = (float(distance), "gallery", int(row))
+
+    if extras.ids:
+        indices, _ = face_recognition.search_gallery(extras.templates, face_encoding, candidates)
+        rescore = set(int(index) for index in indices)
+        rescore.update(extras.index[person_id] for person_id in found if person_id in extras.index)
+        for index in rescore:
+            if statuses and extras.statuses[index] not in statuses:
+                continue
+            exemplars = extras.exemplars[extras.offsets[index]:extras.offsets[index + 1]]
+            distance = float(face_recognition.face_distance(exemplars, face_encoding).min())
+            person_id = extras.ids[index]
+            if person_id not in found or distance <= found[person_id][0]:
+                found[person_id] = (distance, "extra", index)
+
+    return sorted(found.values(), key=lambda entry: entry[0])[:k]
+
+
+def _build_extras(ids, matrix, encoder_version):
+    faces = PersonFace.objects.filter(encoder_version=encoder_version).order_by('person_id', 'id')
+    faces = faces.values_list('person_id', 'face_encoding')
+    grouped = {}
+    for person_id, data in faces.iterator():
+        grouped.setdefault(person_id, []).append(np.frombuffer(bytes(data), dtype=np.float64))
+    if not grouped:
+        return EMPTY_EXTRAS
+
+    rows = {person_id: row for row, person_id in enumerate(ids)}
+    extra_ids = []
+    templates = []
+    offsets = [0]
+    exemplars = []
+    for person_id, encodings in grouped.items():
+        if person_id in rows:
+            encodings = [np.asarray(matrix[rows[person_id]])] + encodings
+        extra_ids.append(person_id)
+        templates.append(np.mean(encodings, axis=0))
+        exemplars.extend(encodings)
+        offsets.append(len(exemplars))
+
+    count = len(extra_ids)
+    return ExtraFaces(
+        extra_ids, [None] * count, [None] * count, [None] * count,
+        np.array(templates), np.array(offsets, dtype=np.int64), np.array(exemplars),
+        {person_id: index for index, person_id in enumerate(extra_ids)},
+    )
+
+
+def _partition(statuses, matrix, status):
+    indices = np.array([index for index, value in enumerate(statuses) if value == status], dtype=np.int64)
+    return Partition(indices, np.asarray(matrix[indices]) if len(indices) else np.empty((0, 128)))
+
+
+def _search(state, face_encoding, k):
+    if state.compact is None:
+        return face_recognition.search_gallery(state.matrix, face_encoding, k)
+    return face_recognition.search_compact(state.compact, face_encoding, k, exact_encodings=state.matrix)
+
+
+def _unknown(confidence):
+    return {
+        "person_id": None,
+        "name": "Unknown",
+        "confidence": confidence,
+        "status": "Unknown",
+        "national_id": None,
+    }
+
+
+def _picture_key(key, encoder_version):
+    picture, updated_at = key
+    key = "{}:{}:{}".format(encoder_version, picture, updated_at.isoformat())
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'little', signed=True)
+
+
+def _signature(rows, encoder_version):
+    digest = hashlib.sha256()
+    digest.update("{};".format(encoder_version).encode())
+    for row in sorted(rows):
+        digest.update("{}:{}:{};".format(row[0], row[4], row[5].isoformat()).encode())
+    return digest.digest()
+
+
+def _staged_encodings(encoder_version):
+    """{person id: ((picture, updated_at), encoding or None)} staged by the completed re-embedding job for a version."""
+    staged = ReembedResult.objects.filter(
+        job__encoder_version=encoder_version, job__status='done', person__isnull=False,
+    ).values_list('person_id', 'picture', 'picture_updated_at', 'face_encoding')
+    return {
+        person_id: ((picture, updated_at), np.frombuffer(bytes(data), dtype=np.float64) if data is not None else None)
+        for person_id, picture, updated_at, data in staged.iterator()
+    }
+
+
+def _encode_picture(picture, encoder):
+    try:
+        image = face_recognition.load_image_file(unquote(picture))
+        encodings = face_recognition.face_encodings(image, num_jitters=encoder.num_jitters, model=encoder.model)
+    except Exception:
+        # skip problematic person images
+        return None
+    return encodings[0] if encodings else None
+
+
+_gallery = Gallery(settings.GALLERY_SHARED_PATH, settings.GALLERY_SEARCH_DTYPE, settings.GALLERY_WATCHLIST_STATUSES)
+
+
+def get_gallery():
+    """Return the process-wide gallery, refreshed against the database."""
+    return _gallery.refresh()
+
+
+def update_gallery_status(person_id, status):
+    """Move a citizen between status partitions of the process-wide gallery after their status changed."""
+    _gallery.set_status(person_id, status)
@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+
+import cv2
+
+from main.pipeline import LatestFrameSlot, StageStats
+from main.stream import open_capture
+
+
+def _is_file(uri):
+    return isinstance(uri, str) and not uri.isdigit() and "://" not in uri
+
+
+class Source:
+    """
+    One camera or video file feeding the ingestion service.
+
+    The capture thread keeps only the freshest frame. Devices and URLs are
+    reopened after a failure; files end the source when they run out unless
+    `loop` is set. Files are read at their own frame rate when `realtime`
+    is set (the default for files) so they behave like a live camera.
+
+    :param name: label used in detections and stats
+    :param uri: device index, video file path or stream URL
+    :param processor: the StreamProcessor used for this source's frames
+    """
+
+    def __init__(self, name, uri, processor, realtime=None, loop=False, reconnect_delay=5.0):
+        self.name = name
+        self.uri = uri
+        self.processor = processor
+        self.is_file = _is_file(uri)
+        self.realtime = self.is_file if realtime is None else realtime
+        self.loop = loop
+        self.reconnect_delay = reconnect_delay
+
+        self.capture_stats = StageStats("capture")
+        self.inference_stats = StageStats("inference")
+        self.slot = LatestFrameSlot(self.capture_stats)
+        self.lag = 0.0
+        self.busy = False
+        self.done = False
+        self.last_error = None
+
+    def capture_loop(self, stop, notify):
+        frame_index = 0
+        try:
+            while not stop.is_set():
+                try:
+                    capture = open_capture(self.uri)
+                except IOError as e:
+                    self._failed(e)
+                    if self.is_file:
+                        return
+                    stop.wait(self.reconnect_delay)
+                    continue
+
+                fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+                started = time.time()
+                read = 0
+                try:
+                    while not stop.is_set():
+                        ok, frame = capture.read()
+                        if not ok:
+                            break
+                        now = time.time()
+                        timestamp = read / fps if self.is_file else now - started
+                        if self.realtime and self.is_file:
+                            delay = started + timestamp - now
+                            if delay > 0:
+                                stop.wait(delay)
+                        read += 1
+
+                        self.capture_stats.tick()
+                        self.slot.put((frame_index, timestamp, frame, time.time()))
+                        frame_index += 1
+                        notify()
+                finally:
+                    capture.release()
+
+                if self.is_file and not self.loop:
+                    return
+                if not self.is_file:
+                    self._failed(IOError("Lost video source {!r}".format(self.uri)))
+                    stop.wait(self.reconnect_delay)
+        finally:
+            self.slot.close()
+            notify()
+
+    def _failed(self, error):
+        self.capture_stats.error()
+        self.last_error = str(error)
+
+    def stats(self):
+        return {
+            "uri": str(self.uri),
+            "capture": self.capture_stats.as_dict(),
+            "inference": self.inference_stats.as_dict(),
+            "lag_seconds": round(self.lag, 3),
+            "last_error": self.last_error,
+            "done": self.done,
+        }
+
+
+class IngestionService:
+    """
+    Runs a capture thread per source and a shared pool of inference threads.
+
+    Workers pick sources round-robin, skipping sources with no new frame
+    or already being processed by another worker. So each source's frames
+    are processed in order by one worker at a time, while busy sources
+    are spread across every worker. A source's StreamProcessor (its
+    detection schedule, motion state and tracker) is therefore never used
+    by two workers at once; face detection itself is safe to run from
+    every worker, as face_recognition gives each concurrent call its own
+    HOG detector.
+
+    :param sources: list of Source
+    :param workers: number of inference threads (default: one per core)
+    :param on_detections: called with (source, detections) from the worker thread for every processed frame with faces
+    """
+
+    def __init__(self, sources, workers=None, on_detections=None):
+        self.sources = sources
+        self.workers = workers or os.cpu_count() or 1
+        self.on_detections = on_detections
+        self.started = None
+
+        self._stop = threading.Event()
+        self._cond = threading.Condition()
+        self._cursor = 0
+        self._threads = []
+
+    def notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def start(self):
+        self.started = time.time()
+        for source in self.sources:
+            self._threads.append(threading.Thread(
+                target=source.capture_loop,
+                args=(self._stop, self.notify),
+                name="capture-{}".format(source.name),
+                daemon=True,
+            ))
+        for i in range(self.workers):
+            self._threads.append(threading.Thread(target=self._work, name="inference-{}".format(i), daemon=True))
+
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for source in self.sources:
+            source.slot.close()
+        self.notify()
+        for thread in self._threads:
+            thread.join()
+
+    def wait(self, timeout=None):
+        """Block until every source has finished or timeout passes. Returns True once all sources are done."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not all(source.done for source in self.sources):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _next_job(self):
+        with self._cond:
+            while not self._stop.is_set():
+                count = len(self.sources)
+                for offset in range(count):
+                    index = (self._cursor + offset) % count
+                    source = self.sources[index]
+                    if source.busy or source.done:
+                        continue
+                    item = source.slot.get(timeout=0)
+                    if item is not None:
+                        source.busy = True
+                        self._cursor = (index + 1) % count
+                        return source, item
+                    if source.slot.closed:
+                        source.done = True
+                        self._cond.notify_all()
+
+                if all(source.done for source in self.sources):
+                    return None
+                self._cond.wait(0.5)
+        return None
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            source, (frame_index, timestamp, frame, captured_at) = job
+            try:
+                detections = source.processor.process(frame, frame_index, timestamp)
+                source.inference_stats.tick()
+                source.lag = time.time() - captured_at
+                if detections and self.on_detections is not None:
+                    self.on_detections(source, detections)
+            except Exception as e:
+                source.inference_stats.error()
+                source.last_error = str(e)
+            finally:
+                with self._cond:
+                    source.busy = False
+                    self._cond.notify_all()
+
+    def stats(self):
+        return {
+            "uptime_seconds": round(time.time() - self.started, 1) if self.started else 0.0,
+            "workers": self.workers,
+            "sources": {source.name: source.stats() for source in self.sources},
+        }
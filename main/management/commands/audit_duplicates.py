@@ -0,0 +1,32 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.gallery import get_gallery
+
+
+class Command(BaseCommand):
+    help = "Find citizens enrolled more than once under different records, printing one JSON pair per line"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threshold', type=float, default=settings.ENROLLMENT_DUPLICATE_THRESHOLD,
+                            help='Face distance under which two citizens count as the same person')
+        parser.add_argument('--block-size', type=int, default=512, help='Citizens compared per block')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        gallery = get_gallery()
+
+        pairs = 0
+        for row, other, distance in gallery.duplicate_pairs(options['threshold'], options['block_size']):
+            pairs += 1
+            self.stdout.write(json.dumps({
+                "citizen": gallery.describe(row),
+                "duplicate_of": gallery.describe(other),
+                "distance": round(distance, 4),
+            }))
+
+        self.stderr.write("Checked {} citizens in {:.2f}s, {} duplicate pairs".format(
+            len(gallery), time.time() - started, pairs))
@@ -0,0 +1,102 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.gallery import get_gallery
+from main.pipeline import Pipeline, VideoRecorder
+from main.stream import StreamProcessor, open_capture
+from main.tracking import FaceTracker
+
+
+class Command(BaseCommand):
+    help = "Run headless face recognition over a webcam or video file and print one JSON detection per line"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default='0', help='Device index, video file path or stream URL (default: webcam 0)')
+        parser.add_argument('--detect-every', type=int, default=5, help='Run detection at least once every N frames')
+        parser.add_argument('--scale', type=float, default=0.5, help='Resize factor applied to frames before detection')
+        parser.add_argument('--motion-threshold', type=float, default=None,
+                            help='Fraction of changed pixels that triggers detection before the next scheduled frame')
+        parser.add_argument('--tolerance', type=float, default=0.5, help='Face distance tolerance for a match')
+        parser.add_argument('--model', default='hog', choices=['hog', 'cnn'], help='Face detection model')
+        parser.add_argument('--upsample', type=int, default=1, help='Times to upsample the resized frame when detecting')
+        parser.add_argument('--max-frames', type=int, default=None, help='Stop after reading this many frames')
+        parser.add_argument('--track', action='store_true',
+                            help='Track faces between detections and only re-encode a track when needed')
+        parser.add_argument('--correlation', action='store_true',
+                            help='With --track, follow faces on skipped frames with a correlation tracker')
+        parser.add_argument('--reencode-every', type=int, default=15,
+                            help='With --track, re-encode a steady track after this many detections')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Inference threads running behind the capture thread '
+                                 '(only with --detect-every 1 and no motion checks or tracking)')
+        parser.add_argument('--keep-all-frames', action='store_true',
+                            help='Process every frame instead of only the freshest one (use for video files)')
+        parser.add_argument('--record', default=None, help='Write annotated frames to this video file')
+        parser.add_argument('--stats-every', type=float, default=10.0, help='Print per-stage stats every N seconds (0 disables)')
+
+    def handle(self, *args, **options):
+        try:
+            capture = open_capture(options['source'])
+        except IOError as e:
+            raise CommandError(str(e))
+
+        gallery = get_gallery()
+        tracker = None
+        if options['track']:
+            tracker = FaceTracker(reencode_every=options['reencode_every'], use_correlation=options['correlation'])
+        processor = StreamProcessor(
+            gallery,
+            detect_every=options['detect_every'],
+            scale=options['scale'],
+            motion_threshold=options['motion_threshold'],
+            tolerance=options['tolerance'],
+            model=options['model'],
+            upsample=options['upsample'],
+            tracker=tracker,
+            refresh_every=settings.GALLERY_REFRESH_SECONDS,
+        )
+
+        pipeline = Pipeline(
+            capture,
+            processor,
+            workers=options['workers'],
+            drop_stale=not options['keep_all_frames'],
+            max_frames=options['max_frames'],
+        )
+        if pipeline.workers < options['workers']:
+            self.stderr.write(
+                "Using 1 inference worker: frame skipping, motion checks and tracking need frames in order "
+                "(pass --detect-every 1 without --motion-threshold or --track to use more)"
+            )
+        recorder = VideoRecorder(options['record']) if options['record'] else None
+        stats_every = options['stats_every']
+        last_stats = time.time()
+
+        pipeline.start()
+        try:
+            for frame_index, frame, detections in pipeline:
+                if recorder is not None:
+                    recorder(frame_index, frame, detections)
+                for detection in detections or []:
+                    self.stdout.write(json.dumps(detection))
+
+                if stats_every and time.time() - last_stats >= stats_every:
+                    last_stats = time.time()
+                    self.write_stats(pipeline, processor)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pipeline.stop()
+            capture.release()
+            if recorder is not None:
+                recorder.close()
+
+        self.write_stats(pipeline, processor)
+
+    def write_stats(self, pipeline, processor):
+        stats = pipeline.stats()
+        stats["encoder_calls"] = processor.encoder_calls
+        self.stderr.write(json.dumps(stats))
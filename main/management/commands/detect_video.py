@@ -0,0 +1,66 @@
+import json
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand, CommandError
+
+from main.gallery import get_gallery
+from main.thumbnails import media_path
+from main.video import analyze_video, record_video_event
+
+
+class Command(BaseCommand):
+    help = "Recognize faces in a recorded video file and store one detection event with a match per tracked face"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to a local video file')
+        parser.add_argument('--sample-fps', type=float, default=2.0, help='Frames per second of footage to analyze')
+        parser.add_argument('--workers', type=int, default=None, help='Process pool size (default: every core, 1 runs inline)')
+        parser.add_argument('--tolerance', type=float, default=0.5, help='Face distance tolerance for a match')
+        parser.add_argument('--model', default='hog', choices=['hog', 'cnn'], help='Face detection model')
+        parser.add_argument('--upsample', type=int, default=1, help='Times to upsample each frame when detecting')
+        parser.add_argument('--max-seconds', type=float, default=None, help='Only analyze the start of the video')
+        parser.add_argument('--no-save', action='store_true', help='Print the tracks without storing a detection event')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError("No such video file: {}".format(path))
+
+        try:
+            result = analyze_video(
+                path,
+                get_gallery(),
+                sample_fps=options['sample_fps'],
+                workers=options['workers'],
+                tolerance=options['tolerance'],
+                model=options['model'],
+                upsample=options['upsample'],
+                max_seconds=options['max_seconds'],
+            )
+        except IOError as e:
+            raise CommandError(str(e))
+
+        for track in result['tracks']:
+            self.stdout.write(json.dumps(track))
+
+        if not options['no_save']:
+            event = record_video_event(os.path.basename(path), self.media_url(path), result)
+            self.stderr.write("Stored detection event {}".format(event.id))
+
+        self.stderr.write("Analyzed {} frames in {:.2f}s, {} tracked faces".format(
+            result['frames_analyzed'], result['processing_time'], len(result['tracks'])))
+
+    def media_url(self, path):
+        # Events store a /media/ URL like uploads do; a video outside MEDIA_ROOT is copied into it first
+        fs = FileSystemStorage()
+        try:
+            relative = os.path.relpath(os.path.realpath(path), os.path.realpath(fs.location)).replace(os.sep, '/')
+        except ValueError:
+            # On another drive
+            relative = None
+        if relative and media_path(relative) is not None:
+            return fs.url(relative)
+        with open(path, 'rb') as f:
+            return fs.url(fs.save(os.path.basename(path), File(f)))
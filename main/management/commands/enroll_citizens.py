@@ -0,0 +1,49 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.bulk_enroll import enroll_citizens, open_images, read_manifest
+
+
+class Command(BaseCommand):
+    help = "Enroll citizens in bulk from a CSV or JSONL manifest and a folder or zip of pictures"
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', help='CSV (with a header) or JSONL file with name, national_id, address and image per citizen')
+        parser.add_argument('images', help='Folder or zip file holding the pictures named in the manifest')
+        parser.add_argument('--workers', type=int, default=settings.BULK_ENROLL_WORKERS,
+                            help='Process pool size for encoding (default: every core, 1 runs inline)')
+        parser.add_argument('--batch-size', type=int, default=200, help='Citizens inserted per bulk_create')
+        parser.add_argument('--threshold', type=float, default=settings.ENROLLMENT_DUPLICATE_THRESHOLD,
+                            help='Reject faces this close to an enrolled citizen')
+        parser.add_argument('--allow-duplicates', action='store_true', help='Skip the duplicate face check')
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['images']):
+            raise CommandError("No such image folder or zip: {}".format(options['images']))
+
+        try:
+            with open(options['manifest'], 'rb') as f:
+                rows = read_manifest(f, options['manifest'])
+            images = open_images(options['images'])
+        except (IOError, ValueError) as e:
+            raise CommandError(str(e))
+
+        def progress(report):
+            self.stderr.write("{enrolled} enrolled, {skipped} already enrolled, {failed} failed "
+                              "({rows_per_second} rows/s)".format(**report))
+
+        report = enroll_citizens(
+            rows,
+            images,
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            threshold=None if options['allow_duplicates'] else options['threshold'],
+            progress=progress,
+        )
+
+        for failure in report.pop('failures'):
+            self.stdout.write(json.dumps(failure))
+        self.stderr.write(json.dumps(report))
@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from main.gallery import get_gallery
+from main.ingest import IngestionService, Source
+from main.stream import StreamProcessor
+from main.tracking import FaceTracker
+
+PROCESSOR_OPTIONS = ('detect_every', 'scale', 'motion_threshold', 'tolerance', 'model', 'upsample')
+
+
+class Command(BaseCommand):
+    help = "Run face recognition over many cameras or video files at once, printing one JSON detection per line"
+
+    def add_arguments(self, parser):
+        parser.add_argument('config', help='JSON file with a "sources" list of {"name", "uri", ...} entries')
+        parser.add_argument('--workers', type=int, default=None, help='Shared inference threads (default: config value or one per core)')
+        parser.add_argument('--stats-every', type=float, default=10.0, help='Write per-source stats every N seconds (0: only when the sources are done)')
+        parser.add_argument('--stats-file', default=settings.INGEST_STATS_FILE, help='Where to keep the latest stats for api/ingest-stats')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['config']) as f:
+                config = json.load(f)
+        except (IOError, ValueError) as e:
+            raise CommandError("Could not read config: {}".format(e))
+
+        if not config.get('sources'):
+            raise CommandError("Config has no sources")
+        if options['stats_every'] < 0:
+            raise CommandError("--stats-every must be 0 or more seconds")
+
+        gallery = get_gallery()
+        defaults = config.get('defaults', {})
+        sources = []
+        for i, entry in enumerate(config['sources']):
+            entry = dict(defaults, **entry)
+            if 'uri' not in entry:
+                raise CommandError("Source {} has no uri".format(i))
+
+            tracker = None
+            if entry.get('track'):
+                tracker = FaceTracker(
+                    reencode_every=entry.get('reencode_every', 15),
+                    use_correlation=entry.get('correlation', False),
+                )
+            processor = StreamProcessor(
+                gallery,
+                tracker=tracker,
+                refresh_every=settings.GALLERY_REFRESH_SECONDS,
+                **{key: entry[key] for key in PROCESSOR_OPTIONS if key in entry}
+            )
+            sources.append(Source(
+                entry.get('name', 'source-{}'.format(i)),
+                entry['uri'],
+                processor,
+                realtime=entry.get('realtime'),
+                loop=entry.get('loop', False),
+                reconnect_delay=entry.get('reconnect_delay', 5.0),
+            ))
+
+        write_lock = threading.Lock()
+
+        def on_detections(source, detections):
+            lines = []
+            for detection in detections:
+                detection['source'] = source.name
+                lines.append(json.dumps(detection))
+            with write_lock:
+                for line in lines:
+                    self.stdout.write(line)
+
+        service = IngestionService(sources, options['workers'] or config.get('workers'), on_detections)
+        service.start()
+        try:
+            if options['stats_every']:
+                while not service.wait(options['stats_every']):
+                    self.write_stats(service, options['stats_file'])
+            else:
+                service.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.stop()
+
+        self.write_stats(service, options['stats_file'])
+
+    def write_stats(self, service, path):
+        stats = service.stats()
+        stats['updated_at'] = time.time()
+        self.stderr.write(json.dumps(stats))
+
+        if path:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, path)
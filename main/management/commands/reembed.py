@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from main.encoders import active_encoder, encoder_config
+from main.reembed import run_reembed_job, start_reembed_job
+
+
+class Command(BaseCommand):
+    help = "Re-encode every citizen face with new encoder settings and switch the gallery to them when done"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--num-jitters', type=int, default=None,
+                            help='Times each face is re-sampled when encoding (default: settings.FACE_ENCODING_JITTERS)')
+        parser.add_argument('--landmark-model', choices=['small', 'large'], default=None,
+                            help='Landmark model faces are aligned with (default: settings.FACE_LANDMARK_MODEL)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Process pool size for encoding (default: every core, 1 runs inline)')
+        parser.add_argument('--batch-size', type=int, default=200, help='Faces encoded and staged per batch')
+
+    def handle(self, *args, **options):
+        encoder = encoder_config(options['num_jitters'], options['landmark_model'])
+        if encoder.version == active_encoder().version:
+            raise CommandError("{} is already the active encoder".format(encoder.version))
+
+        job = start_reembed_job(encoder)
+        if job.processed:
+            self.stderr.write("Resuming job {} at {} faces".format(job.id, job.processed))
+
+        def progress(job):
+            self.stderr.write("{} / {} faces re-encoded, {} without a face".format(job.processed, job.total, job.failed))
+
+        job = run_reembed_job(job, workers=options['workers'], batch_size=options['batch_size'], progress=progress)
+        if job.status != 'done':
+            raise CommandError("Re-embedding job {} failed: {}".format(job.id, job.error))
+        self.stderr.write(json.dumps({
+            'job': job.id, 'encoder_version': job.encoder_version, 'processed': job.processed, 'failed': job.failed,
+        }))
@@ -0,0 +1,142 @@
+import hashlib
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+# Files whose URL changes whenever their content does can be cached for good
+IMMUTABLE = "private, max-age=31536000, immutable"
+# Others are reused for a while, then revalidated against their ETag
+REVALIDATE = "private, max-age=3600"
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def file_etag(stat):
+    """A strong ETag for a file version: any write changes its size or modification time."""
+    digest = hashlib.sha1("{}:{}:{}".format(stat.st_ino, stat.st_size, stat.st_mtime_ns).encode()).hexdigest()
+    return '"{}"'.format(digest[:32])
+
+
+def serve_file(request, path, content_type=None, etag=None, cache_control=REVALIDATE):
+    """
+    Serve a file with validators, cache headers and Range support.
+
+    Conditional requests (If-None-Match, If-Modified-Since) are answered with 304. With
+    settings.MEDIA_SENDFILE set, the body is left to the front-end server through X-Sendfile or
+    X-Accel-Redirect, which also takes care of ranges. Otherwise a single byte range is answered with
+    206, and everything else with a FileResponse, which WSGI servers with wsgi.file_wrapper (e.g.
+    gunicorn) send with sendfile() without copying the file through Python.
+
+    :param path: filesystem path of the file; the caller checks it may be served
+    :param etag: quoted ETag to use instead of one derived from the file's stat
+    :param cache_control: Cache-Control header, e.g. IMMUTABLE for content-addressed URLs
+    :raises FileNotFoundError: when there is no such file
+    """
+    stat = os.stat(path)
+    etag = etag or file_etag(stat)
+    content_type = content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        response = _sendfile_response(path, content_type) or _file_response(request, path, stat, etag, content_type)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = cache_control
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _sendfile_response(path, content_type):
+    mode = settings.MEDIA_SENDFILE
+    if not mode:
+        return None
+
+    response = HttpResponse(content_type=content_type)
+    if mode == 'x-sendfile':
+        response['X-Sendfile'] = path
+        return response
+
+    # X-Accel-Redirect names an internal nginx location rather than a filesystem path
+    for root, location in settings.MEDIA_ACCEL_REDIRECT_LOCATIONS.items():
+        relative = os.path.relpath(path, root)
+        if not relative.startswith(os.pardir):
+            response['X-Accel-Redirect'] = location.rstrip('/') + '/' + quote(relative.replace(os.sep, '/'))
+            return response
+    return None
+
+
+def _file_response(request, path, stat, etag, content_type):
+    byte_range = _requested_range(request, stat, etag)
+    if byte_range is None:
+        return FileResponse(open(path, 'rb'), content_type=content_type)
+
+    size = stat.st_size
+    start, end = byte_range
+    if start >= size:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+
+    end = min(end, size - 1)
+    f = open(path, 'rb')
+    f.seek(start)
+    response = FileResponse(_FileRange(f, end - start + 1), status=206, content_type=content_type)
+    response['Content-Length'] = end - start + 1
+    response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    return response
+
+
+def _requested_range(request, stat, etag):
+    """(first byte, last byte) of a single byte range request, or None to send the whole file."""
+    header = request.META.get('HTTP_RANGE', '').strip()
+    match = RANGE.match(header)
+    if not match or match.group(1) == match.group(2) == '':
+        # Multiple ranges and malformed headers get the whole file, which RFC 9110 allows
+        return None
+
+    # If-Range: only send part of the file if it is still the version the client has the rest of
+    if_range = request.META.get('HTTP_IF_RANGE', '').strip()
+    if if_range:
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            if if_range != etag:
+                return None
+        elif parse_http_date_safe(if_range) != int(stat.st_mtime):
+            return None
+
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        return max(stat.st_size - int(last), 0), stat.st_size - 1
+    if last and int(last) < int(first):
+        # An invalid range (RFC 9110 14.1.1) is ignored, not unsatisfiable
+        return None
+    return int(first), int(last) if last else stat.st_size - 1
+
+
+class _FileRange:
+    # Reads at most `length` bytes from the current position of a file. It keeps fileno() so WSGI servers
+    # can still sendfile() it; they send Content-Length bytes from the file's current offset.
+
+    def __init__(self, f, length):
+        self.file = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
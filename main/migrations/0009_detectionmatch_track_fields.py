@@ -0,0 +1,33 @@
+# Generated migration for per-track video detection matches
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_detection_models'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='detectionmatch',
+            name='track_id',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='detectionmatch',
+            name='first_seen_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='detectionmatch',
+            name='last_seen_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='detectionmatch',
+            name='frames_seen',
+            field=models.IntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated migration for stored probe encodings and retroactive searches
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_detectionmatch_track_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetroSearch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(default='pending', max_length=20)),
+                ('faces_searched', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='retro_searches', to='main.person')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='detectionmatch',
+            name='face_encoding',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='RetroSighting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('distance', models.FloatField()),
+                ('detection_match', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='retro_sightings', to='main.detectionmatch')),
+                ('retro_search', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sightings', to='main.retrosearch')),
+            ],
+            options={
+                'ordering': ['distance'],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated migration for additional enrollment faces per citizen
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_unknown_clusters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PersonFace',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('picture', models.CharField(max_length=255)),
+                ('face_encoding', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('person', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='faces', to='main.person')),
+            ],
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated migration for encoder-versioned encodings and re-embedding jobs
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_person_faces'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReembedJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('encoder_version', models.CharField(max_length=64)),
+                ('num_jitters', models.IntegerField(default=1)),
+                ('landmark_model', models.CharField(default='small', max_length=10)),
+                ('status', models.CharField(default='running', max_length=20)),
+                ('total', models.IntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('person_cursor', models.IntegerField(default=0)),
+                ('face_cursor', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        # Every encoding stored so far was computed with the default encoder settings
+        migrations.AddField(
+            model_name='detectionmatch',
+            name='encoder_version',
+            field=models.CharField(default='dlib_face_recognition_resnet_model_v1:small:j1', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='personface',
+            name='encoder_version',
+            field=models.CharField(default='dlib_face_recognition_resnet_model_v1:small:j1', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='unknowncluster',
+            name='encoder_version',
+            field=models.CharField(default='dlib_face_recognition_resnet_model_v1:small:j1', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='ReembedResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('picture', models.CharField(max_length=255)),
+                ('face_encoding', models.BinaryField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='main.reembedjob')),
+                ('person', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='main.person')),
+                ('person_face', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='main.personface')),
+            ],
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated migration for stored face chips
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_encoder_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FaceChip',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('segment', models.IntegerField()),
+                ('offset', models.BigIntegerField()),
+                ('length', models.IntegerField()),
+                ('landmark_model', models.CharField(default='small', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='reembedjob',
+            name='match_cursor',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='reembedresult',
+            name='detection_match',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='main.detectionmatch'),
+        ),
+        migrations.AddField(
+            model_name='detectionmatch',
+            name='chip',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.facechip'),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='chip',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.facechip'),
+        ),
+        migrations.AddField(
+            model_name='personface',
+            name='chip',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='main.facechip'),
+        ),
+    ]
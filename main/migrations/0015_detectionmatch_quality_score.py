@@ -0,0 +1,18 @@
+# Generated migration for face quality scores
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_face_chips'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='detectionmatch',
+            name='quality_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
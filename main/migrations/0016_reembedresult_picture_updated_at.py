@@ -0,0 +1,18 @@
+# Generated migration for the updated_at of re-embedded citizen pictures
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_detectionmatch_quality_score'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reembedresult',
+            name='picture_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated migration for background video detection jobs
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_reembedresult_picture_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VideoJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('video_name', models.CharField(max_length=255)),
+                ('video_url', models.CharField(max_length=255)),
+                ('sample_fps', models.FloatField(default=2.0)),
+                ('status', models.CharField(default='pending', max_length=20)),
+                ('frames_analyzed', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('user_id', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('detection_event', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='video_jobs', to='main.detectionevent')),
+            ],
+        ),
+    ]
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 from django.db import models
+from django.utils import timezone
 
 class UserManager(models.Manager):
     def validator(self, postData):
@@ -46,9 +47,20 @@ class Person(models.Model):
     address = models.CharField(max_length=255)
     picture = models.CharField(max_length=255)
     status = models.CharField(max_length=255)
+    # Aligned face chip cut from the picture at enrollment
+    chip = models.ForeignKey('FaceChip', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+class PersonFace(models.Model):
+    # Additional enrollment picture of a citizen; the gallery matches a citizen by their closest face
+    person = models.ForeignKey(Person, on_delete=models.CASCADE, related_name='faces')
+    picture = models.CharField(max_length=255)
+    face_encoding = models.BinaryField()  # 128 float64 values
+    encoder_version = models.CharField(max_length=64)  # face_recognition.encoder_version() of face_encoding
+    chip = models.ForeignKey('FaceChip', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+
 class File(models.Model):
   file = models.FileField(blank=False, null=False)
   remark = models.CharField(max_length=20)
@@ -66,7 +78,7 @@ class DetectionEvent(models.Model):
     
     # Processing information
     processing_time_seconds = models.FloatField(default=0.0)
-    detection_method = models.CharField(max_length=50, default='image_upload')  # 'image_upload', 'webcam', etc.
+    detection_method = models.CharField(max_length=50, default='image_upload')  # 'image_upload', 'webcam', 'video_file', etc.
     
     # User who performed the detection
     user_id = models.IntegerField(null=True, blank=True)  # Reference to User.id
@@ -93,6 +105,23 @@ class DetectionMatch(models.Model):
     face_bottom = models.IntegerField(default=0)
     face_left = models.IntegerField(default=0)
     
+    # Video detections collapse every sighting of a tracked face into one row
+    track_id = models.IntegerField(null=True, blank=True)
+    first_seen_seconds = models.FloatField(null=True, blank=True)
+    last_seen_seconds = models.FloatField(null=True, blank=True)
+    frames_seen = models.IntegerField(default=1)
+    
+    # Probe encoding as 128 float16 values (256 bytes), searched when someone is later marked Wanted
+    face_encoding = models.BinaryField(null=True, blank=True)
+    encoder_version = models.CharField(max_length=64)
+    # Aligned chip of the face, shown as its thumbnail and re-encoded by re-embedding jobs
+    chip = models.ForeignKey('FaceChip', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # face_recognition.face_quality score between 0 and 1; faces under the quality thresholds are stored unencoded
+    quality_score = models.FloatField(null=True, blank=True)
+    
+    # Cluster of recurring unknown faces this face was assigned to
+    unknown_cluster = models.ForeignKey('UnknownCluster', on_delete=models.SET_NULL, null=True, blank=True, related_name='matches')
+    
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     
@@ -100,3 +129,104 @@ class DetectionMatch(models.Model):
         if self.matched_person:
             return f"Match: {self.matched_person.name} ({self.confidence_score:.2f})"
         return f"Unknown face ({self.confidence_score:.2f})"
+
+class RetroSearch(models.Model):
+    # Search of stored unknown faces for a citizen, run in the background when they are marked Wanted
+    person = models.ForeignKey(Person, on_delete=models.CASCADE, related_name='retro_searches')
+    status = models.CharField(max_length=20, default='pending')  # 'pending', 'running', 'done', 'failed'
+    faces_searched = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Retro search {self.id} for {self.person.name} ({self.status})"
+
+class VideoJob(models.Model):
+    # Analysis of an uploaded video file, run in the background and polled through the API
+    video_name = models.CharField(max_length=255)
+    video_url = models.CharField(max_length=255)  # /media/ URL of the stored upload
+    sample_fps = models.FloatField(default=2.0)
+    status = models.CharField(max_length=20, default='pending')  # 'pending', 'running', 'done', 'failed'
+    detection_event = models.ForeignKey(DetectionEvent, on_delete=models.SET_NULL, null=True, blank=True, related_name='video_jobs')
+    frames_analyzed = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    user_id = models.IntegerField(null=True, blank=True)
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Video job {self.id} for {self.video_name} ({self.status})"
+
+class RetroSighting(models.Model):
+    # A stored unknown face that a retro search found close to the citizen
+    retro_search = models.ForeignKey(RetroSearch, on_delete=models.CASCADE, related_name='sightings')
+    detection_match = models.ForeignKey(DetectionMatch, on_delete=models.CASCADE, related_name='retro_sightings')
+    distance = models.FloatField()
+    
+    class Meta:
+        ordering = ['distance']
+
+class UnknownCluster(models.Model):
+    # Recurring unidentified face: the running mean of the unknown face encodings assigned to it
+    centroid = models.BinaryField()  # 128 float64 values
+    encoder_version = models.CharField(max_length=64)
+    size = models.IntegerField(default=0)
+    first_seen_at = models.DateTimeField(default=timezone.now)
+    last_seen_at = models.DateTimeField(default=timezone.now)
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Unknown cluster {self.id} ({self.size} faces)"
+
+class ReembedJob(models.Model):
+    # Re-encoding of the whole registry with new encoder settings; becomes the active encoder when done
+    encoder_version = models.CharField(max_length=64)
+    num_jitters = models.IntegerField(default=1)
+    landmark_model = models.CharField(max_length=10, default='small')
+    status = models.CharField(max_length=20, default='running')  # 'running', 'done', 'failed'
+    
+    # Progress, and where to resume: the last Person, PersonFace and DetectionMatch ids already re-encoded
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    person_cursor = models.IntegerField(default=0)
+    face_cursor = models.IntegerField(default=0)
+    match_cursor = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Re-embedding {self.id} to {self.encoder_version} ({self.status})"
+
+class ReembedResult(models.Model):
+    # New encoding of one citizen picture, PersonFace or stored probe, staged until its job completes
+    job = models.ForeignKey(ReembedJob, on_delete=models.CASCADE, related_name='results')
+    person = models.ForeignKey(Person, on_delete=models.CASCADE, null=True, blank=True)
+    person_face = models.ForeignKey(PersonFace, on_delete=models.CASCADE, null=True, blank=True)
+    detection_match = models.ForeignKey(DetectionMatch, on_delete=models.CASCADE, null=True, blank=True)
+    picture = models.CharField(max_length=255)
+    picture_updated_at = models.DateTimeField(null=True, blank=True)  # the citizen's updated_at when their picture was read
+    face_encoding = models.BinaryField(null=True, blank=True)  # None when no face was found
+
+class FaceChip(models.Model):
+    # Aligned 150x150 face chip (face_recognition.face_chips) stored as a lossless WebP in a packed segment file
+    segment = models.IntegerField()
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
+    landmark_model = models.CharField(max_length=10, default='small')  # landmark model the chip was aligned with
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"Face chip {self.id} (segment {self.segment}, {self.length} bytes)"
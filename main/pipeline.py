@@ -0,0 +1,309 @@
+import queue
+import threading
+import time
+from collections import deque
+
+import cv2
+
+from main.stream import frame_timestamp
+
+
+class StageStats:
+    """
+    Thread-safe counters for one pipeline stage: frames handled, frames
+    dropped, errors, and a rolling frames-per-second over the last `window`
+    seconds.
+    """
+
+    def __init__(self, name, window=5.0):
+        self.name = name
+        self.window = window
+        self.frames = 0
+        self.dropped = 0
+        self.errors = 0
+        self._times = deque()
+        self._lock = threading.Lock()
+
+    def tick(self):
+        now = time.time()
+        with self._lock:
+            self.frames += 1
+            self._times.append(now)
+            self._trim(now)
+
+    def drop(self):
+        with self._lock:
+            self.dropped += 1
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def fps(self):
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            if len(self._times) < 2:
+                return 0.0
+            elapsed = now - self._times[0]
+            return len(self._times) / elapsed if elapsed > 0 else 0.0
+
+    def _trim(self, now):
+        while self._times and now - self._times[0] > self.window:
+            self._times.popleft()
+
+    def as_dict(self):
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "fps": round(self.fps(), 2),
+        }
+
+
+class LatestFrameSlot:
+    """
+    A one-item buffer between a producer and its consumers.
+
+    With drop_stale (the default) put() never blocks: a frame that nobody
+    took before the next one arrived is overwritten and counted as dropped,
+    so consumers always get the freshest frame. Without it put() waits for
+    the slot to be emptied, which is what you want when every frame of a
+    file should be seen.
+    """
+
+    def __init__(self, stats=None, drop_stale=True):
+        self.stats = stats
+        self.drop_stale = drop_stale
+        self._item = None
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put(self, item):
+        with self._cond:
+            if not self.drop_stale:
+                while self._item is not None and not self._closed:
+                    self._cond.wait()
+            if self._closed:
+                return
+            if self._item is not None and self.stats is not None:
+                self.stats.drop()
+            self._item = item
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Take the current item, or None after timeout or once the slot is closed and empty."""
+        with self._cond:
+            if self._item is None and not self._closed:
+                self._cond.wait(timeout)
+            item, self._item = self._item, None
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+def capture_loop(capture, slot, stats, stop, max_frames=None):
+    """Read frames from a cv2.VideoCapture into a slot as (frame_index, timestamp, frame) until exhausted or stopped."""
+    started = time.time()
+    frame_index = 0
+
+    try:
+        while not stop.is_set() and (max_frames is None or frame_index < max_frames):
+            ok, frame = capture.read()
+            if not ok:
+                break
+            stats.tick()
+            slot.put((frame_index, frame_timestamp(capture, started), frame))
+            frame_index += 1
+    finally:
+        slot.close()
+
+
+_END = object()
+
+
+class Pipeline:
+    """
+    Capture, inference and output decoupled into separate threads.
+
+    A capture thread keeps only the newest frame in a LatestFrameSlot, one
+    or more inference workers take the freshest frame and run the
+    StreamProcessor on it, and the caller consumes results by iterating
+    over the pipeline, which is where drawing, display or recording happens.
+    When dropping stale frames, results that arrive behind a newer frame
+    are dropped too; otherwise nothing is dropped anywhere and results are
+    yielded in the order workers finish them.
+
+    A processor that skips frames, checks for motion or tracks faces keeps
+    state from one frame to the next and needs its frames one at a time and
+    in order, so it always runs on a single worker. Only a stateless
+    processor (StreamProcessor.stateless) is shared by several workers.
+
+    :param capture: an opened cv2.VideoCapture
+    :param processor: the StreamProcessor run on every frame
+    :param workers: number of inference threads, used only with a stateless processor (see self.workers)
+    :param drop_stale: drop frames inference could not keep up with. Disable to process every frame of a file.
+    :param max_frames: stop capturing after this many frames
+    :param queue_size: how many results may wait for the consumer before the oldest is dropped
+    """
+
+    def __init__(self, capture, processor, workers=1, drop_stale=True, max_frames=None, queue_size=8):
+        self.capture = capture
+        self.processor = processor
+        self.workers = max(1, workers) if processor.stateless else 1
+        self.drop_stale = drop_stale
+        self.max_frames = max_frames
+
+        self.capture_stats = StageStats("capture")
+        self.inference_stats = StageStats("inference")
+        self.sink_stats = StageStats("sink")
+
+        self.slot = LatestFrameSlot(self.capture_stats, drop_stale)
+        self.results = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._threads = []
+        self._running_workers = 0
+        self._lock = threading.Lock()
+
+        # Keep the driver from buffering frames on our behalf where the backend allows it
+        if drop_stale:
+            capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def start(self):
+        capture_thread = threading.Thread(
+            target=capture_loop,
+            args=(self.capture, self.slot, self.capture_stats, self._stop, self.max_frames),
+            name="capture",
+            daemon=True,
+        )
+        self._threads.append(capture_thread)
+
+        self._running_workers = self.workers
+        for i in range(self.workers):
+            worker = threading.Thread(
+                target=self._infer,
+                args=(self.processor,),
+                name="inference-{}".format(i),
+                daemon=True,
+            )
+            self._threads.append(worker)
+
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.slot.close()
+        for thread in self._threads:
+            thread.join()
+
+    def _infer(self, processor):
+        try:
+            while not self._stop.is_set():
+                item = self.slot.get(timeout=0.5)
+                if item is None:
+                    if self.slot.closed:
+                        break
+                    continue
+
+                frame_index, timestamp, frame = item
+                try:
+                    detections = processor.process(frame, frame_index, timestamp)
+                except Exception:
+                    self.inference_stats.error()
+                    continue
+                self.inference_stats.tick()
+                self._publish((frame_index, frame, detections))
+        finally:
+            with self._lock:
+                self._running_workers -= 1
+                last = self._running_workers == 0
+            if last:
+                self._publish(_END)
+
+    def _publish(self, item):
+        if not self.drop_stale:
+            while not self._stop.is_set():
+                try:
+                    self.results.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+            return
+
+        while True:
+            try:
+                self.results.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.results.get_nowait()
+                    self.sink_stats.drop()
+                except queue.Empty:
+                    pass
+
+    def __iter__(self):
+        """Yield (frame_index, frame, detections) until the pipeline finishes."""
+        last_index = -1
+        while True:
+            item = self.results.get()
+            if item is _END:
+                return
+            if self.drop_stale and item[0] < last_index:
+                self.sink_stats.drop()
+                continue
+            last_index = item[0]
+            self.sink_stats.tick()
+            yield item
+
+    def stats(self):
+        return {
+            stage.name: stage.as_dict()
+            for stage in (self.capture_stats, self.inference_stats, self.sink_stats)
+        }
+
+
+def draw_detections(frame, detections):
+    """Draw a labelled box for each detection on a BGR frame: red for known faces, green for unknown."""
+    for detection in detections:
+        top, right, bottom, left = detection["box"]
+        name = detection["name"]
+        color = (0, 0, 255) if name != "Unknown" else (0, 255, 0)
+
+        cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
+        cv2.rectangle(frame, (left, bottom - 35), (right, bottom), color, cv2.FILLED)
+        cv2.putText(frame, name, (left + 6, bottom - 6), cv2.FONT_HERSHEY_DUPLEX, 1.0, (255, 255, 255), 1)
+    return frame
+
+
+class VideoRecorder:
+    """Sink that writes annotated frames to a video file, keeping the last boxes on frames that skipped detection."""
+
+    def __init__(self, path, fps=15.0, fourcc="mp4v"):
+        self.path = path
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self._writer = None
+        self._detections = []
+
+    def __call__(self, frame_index, frame, detections):
+        if detections is not None:
+            self._detections = detections
+        if self._writer is None:
+            height, width = frame.shape[:2]
+            self._writer = cv2.VideoWriter(self.path, self.fourcc, self.fps, (width, height))
+        self._writer.write(draw_detections(frame.copy(), self._detections))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
@@ -0,0 +1,179 @@
+import functools
+from urllib.parse import unquote
+
+import numpy as np
+import face_recognition
+
+from main.chips import decode_chip
+from main.video import process_pool
+
+
+def _encode_face(face, num_jitters=1, model="small"):
+    # Runs in a pool worker, so it takes and returns plain values: face is (picture, stored chip bytes or
+    # None, landmark model the chip was aligned with), and the result is (encoding or None, chip cut from
+    # the picture when there was no stored chip or None)
+    picture, chip_data, chip_model = face
+    try:
+        if chip_data is not None:
+            chip = decode_chip(chip_data)
+            if chip_model == model:
+                return face_recognition.chip_encodings([chip], num_jitters)[0], None
+            # Aligned with another landmark model: align the chip again with this one
+            location = face_recognition.chip_face_location(len(chip))
+            encodings = face_recognition.face_encodings(chip, [location], num_jitters, model)
+            return (encodings[0] if encodings else None), None
+
+        image = face_recognition.load_image_file(unquote(picture))
+        chips = face_recognition.face_chips(image, model=model)[:1]
+    except Exception:
+        return None, None
+    if not chips:
+        return None, None
+    return face_recognition.chip_encodings(chips, num_jitters)[0], chips[0]
+
+
+def start_reembed_job(encoder):
+    """
+    Return the ReembedJob re-encoding the registry with an EncoderConfig, resuming an unfinished one for the
+    same version instead of starting over.
+    """
+    from main.models import ReembedJob
+
+    job = ReembedJob.objects.filter(encoder_version=encoder.version, status__in=['running', 'failed']).order_by('-id').first()
+    if job is None:
+        return ReembedJob.objects.create(
+            encoder_version=encoder.version, num_jitters=encoder.num_jitters, landmark_model=encoder.model,
+        )
+    job.status = 'running'
+    job.error = ''
+    job.save(update_fields=['status', 'error', 'updated_at'])
+    return job
+
+
+def run_reembed_job(job, workers=None, batch_size=200, progress=None):
+    """
+    Re-encode every citizen picture, PersonFace and stored probe with a job's encoder settings, then make
+    them active.
+
+    Faces are encoded from their stored face chips, so the original pictures and uploads are only decoded
+    for faces enrolled before chips were kept; their chips are stored on the way so the next job does
+    not decode them either. Stored probes without a chip cannot be re-encoded and keep their old version.
+
+    Faces are encoded on a process pool in batches of batch_size, in id order. Each batch's encodings are
+    staged as ReembedResult rows in the same transaction that advances the job's cursors, so a job
+    interrupted at any point resumes after the last staged batch. Rows added while the job runs are
+    picked up by repeating the sweep until it finds nothing new.
+
+    Nothing in use changes until the end: then, in one transaction, PersonFace rows and stored probes get
+    their new encodings and the job is marked done, which makes its version the active encoder. Each
+    gallery switches on its next refresh, building the new matrix from the staged encodings.
+
+    :param job: a running ReembedJob, from start_reembed_job
+    :param workers: pool size for decoding and encoding. None uses every core, 1 runs inline.
+    :param progress: called with the job after every batch
+    :return: the job, done or failed
+    """
+    from django.db import transaction
+    from django.utils import timezone
+    from main.chips import get_chip_store, save_chips
+    from main.models import DetectionMatch, Person, PersonFace, ReembedJob, ReembedResult
+    from main.sightings import pack_encoding
+
+    encode = functools.partial(_encode_face, num_jitters=job.num_jitters, model=job.landmark_model)
+    pool = process_pool(workers) if workers != 1 else None
+    store = get_chip_store()
+
+    # (model, staged result field, cursor field, rows to re-encode)
+    sources = (
+        (Person, 'person_id', 'person_cursor', Person.objects.exclude(picture='')),
+        (PersonFace, 'person_face_id', 'face_cursor', PersonFace.objects.all()),
+        (DetectionMatch, 'detection_match_id', 'match_cursor',
+         DetectionMatch.objects.filter(face_encoding__isnull=False, chip__isnull=False)),
+    )
+    chip_fields = ('chip__segment', 'chip__offset', 'chip__length', 'chip__landmark_model')
+
+    def run_batch(model, field, cursor, rows):
+        faces = [
+            (picture, store.read(segment, offset, length) if segment is not None else None, chip_model)
+            for _, picture, segment, offset, length, chip_model, *_ in rows
+        ]
+        results = pool.map(encode, faces) if pool is not None else list(map(encode, faces))
+
+        # Chips cut from original pictures are kept for next time
+        cut = [(row[0], chip) for row, (_, chip) in zip(rows, results) if chip is not None]
+        chips = save_chips([chip for _, chip in cut], job.landmark_model)
+
+        with transaction.atomic():
+            model.objects.bulk_update(
+                [model(id=row_id, chip=chip) for (row_id, _), chip in zip(cut, chips)], ['chip'],
+            )
+            ReembedResult.objects.bulk_create([
+                ReembedResult(
+                    job=job,
+                    picture=picture or '',
+                    picture_updated_at=updated_at[0] if updated_at else None,
+                    face_encoding=np.asarray(encoding, dtype=np.float64).tobytes() if encoding is not None else None,
+                    **{field: row_id}
+                )
+                for (row_id, picture, _, _, _, _, *updated_at), (encoding, _) in zip(rows, results)
+            ])
+            job.processed += len(rows)
+            job.failed += sum(1 for encoding, _ in results if encoding is None)
+            setattr(job, cursor, rows[-1][0])
+            job.save()
+        if progress is not None:
+            progress(job)
+
+    try:
+        while True:
+            pending = sum(queryset.filter(id__gt=getattr(job, cursor)).count() for _, _, cursor, queryset in sources)
+            job.total = job.processed + pending
+            if not pending:
+                break
+
+            for model, field, cursor, queryset in sources:
+                picture = 'picture' if model is not DetectionMatch else 'detection_event__image_path'
+                # Citizen encodings are cached by (picture, updated_at), so the gallery needs both to reuse them
+                fields = ('id', picture) + chip_fields + (('updated_at',) if model is Person else ())
+                while True:
+                    rows = list(queryset.filter(id__gt=getattr(job, cursor)).order_by('id').values_list(
+                        *fields)[:batch_size])
+                    if not rows:
+                        break
+                    run_batch(model, field, cursor, rows)
+
+        with transaction.atomic():
+            # Faces the new settings cannot find keep their old version, which leaves them out of searches
+            staged = job.results.filter(person_face__isnull=False, face_encoding__isnull=False)
+            PersonFace.objects.bulk_update([
+                PersonFace(id=face_id, face_encoding=bytes(data), encoder_version=job.encoder_version)
+                for face_id, data in staged.values_list('person_face_id', 'face_encoding').iterator()
+            ], ['face_encoding', 'encoder_version'], batch_size=500)
+
+            staged = job.results.filter(detection_match__isnull=False, face_encoding__isnull=False)
+            DetectionMatch.objects.bulk_update([
+                DetectionMatch(
+                    id=match_id,
+                    face_encoding=pack_encoding(np.frombuffer(bytes(data), dtype=np.float64)),
+                    encoder_version=job.encoder_version,
+                )
+                for match_id, data in staged.values_list('detection_match_id', 'face_encoding').iterator()
+            ], ['face_encoding', 'encoder_version'], batch_size=500)
+
+            # Citizen encodings stay staged for galleries to switch over with; the rest are applied
+            job.results.filter(person__isnull=True).delete()
+            ReembedResult.objects.filter(job__status='done').exclude(job=job).delete()
+
+            job.status = 'done'
+            job.completed_at = timezone.now()
+            job.save()
+    except Exception as e:
+        ReembedJob.objects.filter(pk=job.pk).update(status='failed', error=str(e))
+        job.status = 'failed'
+        job.error = str(e)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return job
@@ -0,0 +1,133 @@
+import contextlib
+import os
+import struct
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: rebuilds are not serialized across processes
+    fcntl = None
+
+
+MAGIC = b'VGAL'
+FORMAT_VERSION = 1
+# magic, format version, generation, row count, rows with a face, dimensions, dtype, signature
+HEADER = struct.Struct('<4sIQQQI8s32s')
+HEADER_SIZE = 128
+
+
+class SharedGalleryFile:
+    """
+    The gallery matrix published as a memory-mapped file that every worker
+    process on the host maps read-only, so N workers share one copy in the
+    page cache instead of holding N copies.
+
+    Layout: a fixed size header, then person ids (int64), picture keys
+    (int64) and the encoding matrix. Rows whose picture had no face are
+    kept after the rows with a face so they are not re-encoded on every
+    rebuild, while matrix[:faces] stays a zero-copy view.
+
+    A new version is written to a temporary file and renamed over the old
+    one, so processes still mapping the old file keep a consistent view
+    until they notice the change and re-map. That rename and the rebuild
+    lock need a POSIX host (see supported).
+    """
+
+    # Windows refuses to replace a file another process has mapped, and has no flock to serialize rebuilds
+    supported = fcntl is not None
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self.signature = None
+        self.faces = 0
+        self.ids = np.empty(0, dtype=np.int64)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.matrix = np.empty((0, 128))
+        self._stat = None
+
+    def changed(self):
+        """True when the file on disk is not the one currently mapped."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return self._stat is not None
+        return self._stat != (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def attach(self):
+        """Map the current file read-only. Returns False if there is no valid file yet."""
+        try:
+            with open(self.path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                header = f.read(HEADER_SIZE)
+        except FileNotFoundError:
+            return False
+
+        if len(header) < HEADER.size:
+            return False
+        magic, version, generation, count, faces, dimensions, dtype, signature = HEADER.unpack_from(header)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            return False
+
+        dtype = np.dtype(dtype.rstrip(b'\0').decode())
+        offset = HEADER_SIZE
+        if count:
+            ids = np.memmap(self.path, dtype=np.int64, mode='r', offset=offset, shape=(count,))
+            offset += ids.nbytes
+            keys = np.memmap(self.path, dtype=np.int64, mode='r', offset=offset, shape=(count,))
+            offset += keys.nbytes
+            matrix = np.memmap(self.path, dtype=dtype, mode='r', offset=offset, shape=(count, dimensions))
+        else:
+            ids = keys = np.empty(0, dtype=np.int64)
+            matrix = np.empty((0, dimensions), dtype=dtype)
+
+        self.generation = generation
+        self.signature = signature
+        self.faces = faces
+        self.ids, self.keys, self.matrix = ids, keys, matrix
+        self._stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return True
+
+    def publish(self, ids, keys, matrix, faces, signature):
+        """
+        Atomically replace the file with a new version.
+
+        :param ids: person id of each row
+        :param keys: picture key of each row, used to reuse encodings on the next rebuild
+        :param matrix: encoding of each row; rows past `faces` are placeholders for pictures without a face
+        :param faces: number of leading rows that hold real encodings
+        :param signature: 32 byte digest of the database state the file was built from
+        """
+        matrix = np.ascontiguousarray(matrix)
+        header = HEADER.pack(
+            MAGIC, FORMAT_VERSION, self.generation + 1, len(ids), faces, matrix.shape[1],
+            matrix.dtype.str.encode(), signature,
+        )
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            f.write(np.asarray(ids, dtype=np.int64).tobytes())
+            f.write(np.asarray(keys, dtype=np.int64).tobytes())
+            f.write(matrix.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold an exclusive lock across processes while rebuilding, so only one worker does the encoding."""
+        if fcntl is None:
+            yield
+            return
+
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,140 @@
+import threading
+
+import numpy as np
+import face_recognition
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from main.gallery import get_gallery
+from main.models import DetectionMatch, RetroSearch, RetroSighting
+
+
+def pack_encoding(face_encoding):
+    """Pack a face encoding into the 256 byte float16 form stored on DetectionMatch.face_encoding."""
+    return np.asarray(face_encoding, dtype=np.float16).tobytes()
+
+
+def unpack_encoding(data):
+    return np.frombuffer(bytes(data), dtype=np.float16).astype(np.float64)
+
+
+class SightingIndex:
+    """
+    In-memory index over the stored encodings of unknown faces.
+
+    Each refresh only loads DetectionMatch rows newer than the last one
+    loaded and appends them as a new float16 chunk, so keeping the index
+    current costs one small query. Chunks are merged once there are more
+    than `max_chunks`. At 260 bytes per face a million stored faces fit in
+    about 260 MB and are scanned in well under a second.
+
+    Only faces of one encoder version are indexed; refreshing with another
+    version drops the index and loads that version's faces.
+    """
+
+    def __init__(self, max_chunks=8):
+        self._lock = threading.Lock()
+        self.max_chunks = max_chunks
+        # (DetectionMatch ids, CompactEncodings) in id order
+        self.chunks = []
+        self.last_id = 0
+        self.encoder_version = None
+
+    def __len__(self):
+        return sum(len(ids) for ids, _ in self.chunks)
+
+    def refresh(self, encoder_version, batch_size=10000):
+        with self._lock:
+            if encoder_version != self.encoder_version:
+                self.chunks = []
+                self.last_id = 0
+                self.encoder_version = encoder_version
+
+            rows = DetectionMatch.objects.filter(
+                is_match=False, face_encoding__isnull=False, encoder_version=encoder_version, id__gt=self.last_id,
+            ).order_by('id').values_list('id', 'face_encoding')
+
+            ids = []
+            blobs = []
+            for match_id, data in rows.iterator(chunk_size=batch_size):
+                ids.append(match_id)
+                blobs.append(bytes(data))
+
+            if ids:
+                encodings = np.frombuffer(b''.join(blobs), dtype=np.float16).reshape(-1, 128)
+                self.chunks.append((np.array(ids, dtype=np.int64), face_recognition.CompactEncodings(encodings)))
+                self.last_id = ids[-1]
+
+            if len(self.chunks) > self.max_chunks:
+                ids = np.concatenate([chunk_ids for chunk_ids, _ in self.chunks])
+                encodings = np.concatenate([compact.data for _, compact in self.chunks])
+                self.chunks = [(ids, face_recognition.CompactEncodings(encodings))]
+
+        return self
+
+    def search(self, face_encoding, k=100, tolerance=0.5):
+        """Return up to k (DetectionMatch id, distance) pairs within tolerance, closest first."""
+        found_ids = []
+        found_distances = []
+        for ids, compact in list(self.chunks):
+            indices, distances = face_recognition.search_compact(compact, face_encoding, k)
+            found_ids.append(ids[indices])
+            found_distances.append(distances)
+
+        if not found_ids:
+            return []
+
+        ids = np.concatenate(found_ids)
+        distances = np.concatenate(found_distances)
+        order = np.argsort(distances, kind="stable")[:k]
+        return [(int(ids[i]), float(distances[i])) for i in order if distances[i] <= tolerance]
+
+
+_index = SightingIndex()
+
+
+def get_sighting_index(encoder_version):
+    """Return the process-wide index of stored unknown faces of an encoder version, brought up to date with the database."""
+    return _index.refresh(encoder_version)
+
+
+def start_retro_search(person_id):
+    """
+    Search stored unknown faces for a citizen on a background thread.
+
+    :return: the RetroSearch row, which the thread fills in with sightings and marks done or failed
+    """
+    search = RetroSearch.objects.create(person_id=person_id)
+    threading.Thread(target=run_retro_search, args=(search.id,), name="retro-search-{}".format(search.id), daemon=True).start()
+    return search
+
+
+def run_retro_search(search_id):
+    try:
+        RetroSearch.objects.filter(pk=search_id).update(status='running')
+        search = RetroSearch.objects.get(pk=search_id)
+
+        gallery = get_gallery()
+        encoding = gallery.encoding_for(search.person_id)
+        if encoding is None:
+            raise ValueError("No face was found in the citizen's picture")
+
+        index = get_sighting_index(gallery.encoder.version)
+        found = index.search(encoding, settings.RETRO_SEARCH_LIMIT, settings.RETRO_SEARCH_TOLERANCE)
+
+        # Matches deleted since they were indexed are dropped
+        existing = set(DetectionMatch.objects.filter(id__in=[match_id for match_id, _ in found]).values_list('id', flat=True))
+        RetroSighting.objects.bulk_create([
+            RetroSighting(retro_search_id=search_id, detection_match_id=match_id, distance=distance)
+            for match_id, distance in found
+            if match_id in existing
+        ])
+        RetroSearch.objects.filter(pk=search_id).update(
+            status='done', faces_searched=len(index), completed_at=timezone.now(),
+        )
+    except Exception as e:
+        RetroSearch.objects.filter(pk=search_id).update(status='failed', error=str(e), completed_at=timezone.now())
+    finally:
+        # The thread's own database connection is not closed by the request cycle
+        connection.close()
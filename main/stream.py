@@ -0,0 +1,220 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+import face_recognition
+
+
+def open_capture(source):
+    """
+    Open a cv2.VideoCapture for a device index, video file path or stream URL.
+
+    Device indices may be given as ints or digit strings (e.g. "0" from the
+    command line).
+    """
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise IOError("Could not open video source {!r}".format(source))
+    return capture
+
+
+def frame_timestamp(capture, started):
+    """Seconds into the stream: the container position for files, wall clock for devices."""
+    position = capture.get(cv2.CAP_PROP_POS_MSEC)
+    if position and position > 0:
+        return position / 1000.0
+    return time.time() - started
+
+
+class MotionDetector:
+    """
+    Cheap frame-difference motion check on a tiny grayscale copy of the frame.
+
+    :param threshold: fraction of pixels that must change for the frame to count as motion
+    :param pixel_delta: per-pixel intensity change (0-255) that counts as a change
+    """
+
+    def __init__(self, threshold=0.01, pixel_delta=25, size=(160, 120)):
+        self.threshold = threshold
+        self.pixel_delta = pixel_delta
+        self.size = size
+        self._previous = None
+
+    def __call__(self, frame):
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        previous, self._previous = self._previous, gray
+
+        if previous is None:
+            return True
+
+        changed = np.count_nonzero(cv2.absdiff(gray, previous) > self.pixel_delta)
+        return changed >= self.threshold * gray.size
+
+
+class StreamProcessor:
+    """
+    Headless face recognition over a stream of BGR frames.
+
+    Detection runs on a downsampled copy of the frame and only every
+    `detect_every` frames, or earlier when motion is detected. Faces found
+    are encoded on the full resolution frame and matched against the gallery,
+    unless they fall under the gallery's face quality thresholds. Citizens on
+    the gallery's watchlist are checked first (see Gallery.match).
+
+    :param gallery: a main.gallery.Gallery to match faces against
+    :param detect_every: run detection at least once every N frames
+    :param scale: factor frames are resized by before detection (1.0 keeps full resolution)
+    :param motion_threshold: fraction of changed pixels that triggers an early detection. None disables motion checks.
+    :param tolerance: how much distance between faces to consider it a match
+    :param model: face detection model, "hog" or "cnn"
+    :param upsample: how many times to upsample the downsampled frame when looking for faces
+    :param tracker: optional main.tracking.FaceTracker. Tracked faces reuse their last identity and are
+                    only re-encoded when the tracker asks for it; with correlation tracking enabled, skipped
+                    frames report the tracked boxes instead of None.
+    :param refresh_every: refresh the gallery when it is older than this many seconds, so new citizens and
+                          status changes reach a stream that runs for hours. None never refreshes it.
+    """
+
+    def __init__(self, gallery, detect_every=5, scale=0.5, motion_threshold=None, tolerance=0.5, model="hog", upsample=1,
+                 tracker=None, refresh_every=None):
+        self.gallery = gallery
+        self.refresh_every = refresh_every
+        self.detect_every = max(1, detect_every)
+        self.scale = scale
+        self.tolerance = tolerance
+        self.model = model
+        self.upsample = upsample
+        self.motion = MotionDetector(motion_threshold) if motion_threshold is not None else None
+        self.tracker = tracker
+        self.encoder_calls = 0
+        self._calls_lock = threading.Lock()
+        self._last_detection = None
+
+    @property
+    def stateless(self):
+        """
+        True when every frame is detected on its own (no frame skipping, motion checks or tracking), so
+        several threads may process frames concurrently and out of order.
+        """
+        return self.detect_every == 1 and self.motion is None and self.tracker is None
+
+    def should_detect(self, frame, frame_index):
+        if self.detect_every == 1 or self._last_detection is None or frame_index - self._last_detection >= self.detect_every:
+            return True
+        return self.motion is not None and self.motion(frame)
+
+    def detect(self, frame, frame_index=0, timestamp=None):
+        """Detect, encode and match every face in a BGR frame, returning a list of detection dicts."""
+        self._last_detection = frame_index
+        if self.refresh_every is not None:
+            self.gallery.refresh_if_stale(self.refresh_every)
+
+        if self.scale != 1.0:
+            small = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        else:
+            small = frame
+        rgb_small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+
+        locations = face_recognition.face_locations(rgb_small, self.upsample, self.model)
+        if not locations and self.tracker is None:
+            return []
+
+        height, width = frame.shape[:2]
+        locations = [
+            (
+                max(int(top / self.scale), 0),
+                min(int(right / self.scale), width),
+                min(int(bottom / self.scale), height),
+                max(int(left / self.scale), 0),
+            )
+            for top, right, bottom, left in locations
+        ]
+
+        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if locations else None
+
+        if self.tracker is not None:
+            return self._detect_tracked(rgb_frame, locations, frame_index, timestamp)
+
+        assessed = self.gallery.face_quality(rgb_frame, locations)
+        encoded = iter(self._encode(assessed))
+
+        detections = []
+        for (top, right, bottom, left), (chip, quality) in zip(locations, assessed):
+            if chip is None:
+                detection = self.gallery.unmatched()
+            else:
+                detection = self._match(next(encoded))
+            detection["quality"] = quality.score
+            detection["box"] = [top, right, bottom, left]
+            detection["frame"] = frame_index
+            detection["timestamp"] = timestamp
+            detections.append(detection)
+        return detections
+
+    def _detect_tracked(self, rgb_frame, locations, frame_index, timestamp):
+        tracks = self.tracker.update(locations, frame_index, rgb_frame)
+
+        stale = [track for track in tracks if self.tracker.needs_encoding(track)]
+        if stale:
+            # A track whose face is under the quality thresholds keeps its identity and is tried again next time
+            assessed = self.gallery.face_quality(rgb_frame, [track.box for track in stale])
+            encoded = [track for track, (chip, _) in zip(stale, assessed) if chip is not None]
+            for track, encoding in zip(encoded, self._encode(assessed)):
+                self.tracker.set_identity(track, self._match(encoding))
+
+        return [self._track_detection(track, frame_index, timestamp) for track in tracks]
+
+    def _match(self, encoding):
+        return self.gallery.match(encoding, self.tolerance, statuses=self.gallery.watchlist)
+
+    def _encode(self, assessed):
+        encodings = self.gallery.chip_encodings([chip for chip, _ in assessed if chip is not None])
+        with self._calls_lock:
+            self.encoder_calls += len(encodings)
+        return encodings
+
+    def _track_detection(self, track, frame_index, timestamp):
+        detection = dict(track.identity or self.gallery.unmatched())
+        detection["box"] = list(track.box)
+        detection["track_id"] = track.track_id
+        detection["frame"] = frame_index
+        detection["timestamp"] = timestamp
+        return detection
+
+    def process(self, frame, frame_index, timestamp=None):
+        """
+        Run detection on the frame if it is due.
+
+        :return: a list of detection dicts, or None when the frame was skipped
+        """
+        if self.should_detect(frame, frame_index):
+            return self.detect(frame, frame_index, timestamp)
+
+        if self.tracker is not None and self.tracker.use_correlation:
+            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            return [self._track_detection(track, frame_index, timestamp) for track in self.tracker.predict(rgb_frame)]
+        return None
+
+    def run(self, capture, max_frames=None):
+        """
+        Read frames from a cv2.VideoCapture until it is exhausted.
+
+        Yields (frame_index, frame, detections) for every frame read, where
+        detections is None for frames that were skipped.
+        """
+        started = time.time()
+        frame_index = 0
+
+        while max_frames is None or frame_index < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+
+            detections = self.process(frame, frame_index, frame_timestamp(capture, started))
+            yield frame_index, frame, detections
+            frame_index += 1
@@ -1,3 +1,647 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import face_recognition
+from face_recognition.api import _search_regions, _tile_spans
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils.http import http_date
+
+from main.bulk_enroll import enroll_citizens, open_images, read_manifest
+from main.clustering import ClusterIndex, unpack_centroid
+from main.encoders import active_encoder, encoder_config
+from main.gallery import Gallery
+from main.media import serve_file
+from main.models import DetectionEvent, FaceChip, Person, ReembedResult, UnknownCluster, VideoJob
+from main.reembed import run_reembed_job, start_reembed_job
+from main.thumbnails import media_path
+from main.tracking import FaceTracker
+from main.video import run_video_job
+
+
+class FaceTrackerTests(TestCase):
+
+    def test_boxes_keep_their_track_across_detections(self):
+        tracker = FaceTracker()
+        first = tracker.update([(10, 60, 60, 10), (100, 260, 160, 200)], 0)
+        second = tracker.update([(104, 264, 164, 204), (12, 62, 62, 12)], 5)
+
+        self.assertEqual([track.track_id for track in second], [first[1].track_id, first[0].track_id])
+
+    def test_fast_moving_face_is_matched_on_centroid_distance(self):
+        tracker = FaceTracker(max_centroid_distance=0.5)
+        first = tracker.update([(0, 100, 100, 0)], 0)
+        # No overlap left, but the centre moved less than half a face
+        second = tracker.update([(0, 140, 100, 40)], 1)
+
+        self.assertIs(second[0], first[0])
+
+    def test_unmatched_tracks_are_dropped_after_max_missed(self):
+        tracker = FaceTracker(max_missed=2)
+        tracker.update([(0, 50, 50, 0)], 0)
+        for frame_index in range(1, 3):
+            tracker.update([], frame_index)
+        self.assertEqual(len(tracker.tracks), 1)
+
+        tracker.update([], 3)
+        self.assertEqual(tracker.tracks, [])
+
+    def test_new_track_needs_encoding_until_it_has_an_identity(self):
+        tracker = FaceTracker()
+        track = tracker.update([(0, 50, 50, 0)], 0)[0]
+        self.assertTrue(tracker.needs_encoding(track))
+
+        tracker.set_identity(track, {'name': 'Unknown'})
+        self.assertFalse(tracker.needs_encoding(track))
+
+    def test_steady_track_is_reencoded_every_reencode_every_detections(self):
+        tracker = FaceTracker(reencode_every=3)
+        track = tracker.update([(0, 50, 50, 0)], 0)[0]
+        tracker.set_identity(track, {'name': 'Unknown'})
+
+        for frame_index in range(1, 3):
+            tracker.update([(0, 50, 50, 0)], frame_index)
+            self.assertFalse(tracker.needs_encoding(track))
+        tracker.update([(0, 50, 50, 0)], 3)
+        self.assertTrue(tracker.needs_encoding(track))
+
+    def test_track_is_reencoded_when_its_box_moves_away_from_the_encoded_box(self):
+        tracker = FaceTracker(reencode_iou=0.5)
+        track = tracker.update([(0, 100, 100, 0)], 0)[0]
+        tracker.set_identity(track, {'name': 'Unknown'})
+
+        tracker.update([(0, 140, 100, 40)], 1)
+        self.assertTrue(tracker.needs_encoding(track))
+
+
+class SearchGalleryTests(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.gallery = rng.normal(scale=0.1, size=(1000, 128))
+        self.probe = rng.normal(scale=0.1, size=128)
+        self.distances = np.linalg.norm(self.gallery - self.probe, axis=1)
+
+    def test_shard_merge_matches_brute_force(self):
+        expected = np.argsort(self.distances)[:10]
+        for shards in (1, 3, 7):
+            indices, distances = face_recognition.search_gallery(self.gallery, self.probe, 10, shards=shards)
+            np.testing.assert_array_equal(indices, expected)
+            np.testing.assert_allclose(distances, self.distances[expected])
+
+    def test_k_larger_than_the_gallery_returns_every_row(self):
+        indices, _ = face_recognition.search_gallery(self.gallery[:5], self.probe, 10, shards=2)
+        np.testing.assert_array_equal(indices, np.argsort(self.distances[:5]))
+
+    def test_empty_gallery(self):
+        indices, distances = face_recognition.search_gallery(np.empty((0, 128)), self.probe, 5)
+        self.assertEqual((len(indices), len(distances)), (0, 0))
+
+
+class SearchCompactTests(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.gallery = rng.normal(scale=0.1, size=(2000, 128))
+        self.probe = self.gallery[42] + rng.normal(scale=0.02, size=128)
+        self.distances = np.linalg.norm(self.gallery - self.probe, axis=1)
+
+    def test_reranked_search_matches_brute_force(self):
+        expected = np.argsort(self.distances)[:5]
+        for dtype in ('float16', 'int8'):
+            compact = face_recognition.CompactEncodings(self.gallery, dtype)
+            indices, distances = face_recognition.search_compact(
+                compact, self.probe, 5, exact_encodings=self.gallery, shards=3,
+            )
+            np.testing.assert_array_equal(indices, expected, err_msg=dtype)
+            np.testing.assert_allclose(distances, self.distances[expected], err_msg=dtype)
+
+    def test_compact_distances_approximate_exact_distances(self):
+        for dtype, tolerance in (('float16', 1e-3), ('int8', 2e-2)):
+            compact = face_recognition.CompactEncodings(self.gallery, dtype)
+            indices, distances = face_recognition.search_compact(compact, self.probe, 20)
+            self.assertEqual(indices[0], 42)
+            np.testing.assert_allclose(distances, self.distances[indices], atol=tolerance, err_msg=dtype)
+
+
+class ClusterIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = ClusterIndex(tolerance=0.5, merge_distance=0.4)
+        self.direction = np.zeros(128)
+        self.direction[0] = 1.0
+
+    def face(self, position):
+        return position * self.direction
+
+    def test_faces_within_tolerance_join_the_nearest_cluster(self):
+        first = self.index.assign(self.face(0.0), 'v1')
+        self.assertEqual(self.index.assign(self.face(0.2), 'v1'), first)
+        other = self.index.assign(self.face(0.8), 'v1')
+
+        self.assertNotEqual(other, first)
+        cluster = UnknownCluster.objects.get(pk=first)
+        self.assertEqual(cluster.size, 2)
+        np.testing.assert_allclose(unpack_centroid(cluster.centroid), self.face(0.1))
+
+    def test_clusters_that_drift_together_are_merged_into_the_larger(self):
+        a = self.index.assign(self.face(0.0), 'v1')
+        b = self.index.assign(self.face(0.6), 'v1')
+        self.assertEqual(self.index.assign(self.face(0.45), 'v1'), b)
+        self.assertEqual(self.index.assign(self.face(0.2), 'v1'), a)
+        # Pulls a's centroid to within merge_distance of b's
+        self.assertEqual(self.index.assign(self.face(0.3), 'v1'), a)
+
+        cluster = UnknownCluster.objects.get()
+        self.assertEqual((cluster.pk, cluster.size), (a, 5))
+        np.testing.assert_allclose(unpack_centroid(cluster.centroid), self.face(0.31))
+        self.assertEqual(self.index.ids, [a])
+
+    def test_faces_of_another_encoder_version_get_their_own_clusters(self):
+        first = self.index.assign(self.face(0.0), 'v1')
+        second = self.index.assign(self.face(0.0), 'v2')
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.index.assign(self.face(0.1), 'v1'), first)
+
+
+class ReadManifestTests(TestCase):
+
+    def test_csv_rows_carry_their_line_and_accept_picture_for_image(self):
+        manifest = io.BytesIO(
+            b"name,national_id,address,picture\n"
+            b"Ann,1,Harare,ann.jpg\n"
+            b"Ben,2,Bulawayo,ben.jpg\n"
+        )
+        rows = read_manifest(manifest, 'citizens.csv')
+
+        self.assertEqual([(row['name'], row['image'], row['line']) for row in rows],
+                         [('Ann', 'ann.jpg', 2), ('Ben', 'ben.jpg', 3)])
+
+    def test_jsonl_skips_blank_lines_but_counts_them(self):
+        manifest = io.BytesIO(
+            b'{"name": "Ann", "national_id": "1", "address": "Harare", "image": "ann.jpg"}\n'
+            b'\n'
+            b'{"name": "Ben", "national_id": "2", "address": "Bulawayo", "image": "ben.jpg"}\n'
+        )
+        rows = read_manifest(manifest, 'citizens.jsonl')
+
+        self.assertEqual([(row['national_id'], row['line']) for row in rows], [('1', 1), ('2', 3)])
+
+
+class EnrollCitizensTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.images = os.path.join(self.directory, 'images')
+        os.mkdir(self.images)
+        self.rows = []
+        for number in range(1, 4):
+            with open(os.path.join(self.images, '{}.jpg'.format(number)), 'wb') as f:
+                f.write(b'image')
+            self.rows.append({'name': 'Citizen {}'.format(number), 'national_id': str(number),
+                              'address': 'Harare', 'image': '{}.jpg'.format(number), 'line': number + 1})
+
+        rng = np.random.default_rng(2)
+        encode = mock.patch('main.bulk_enroll._encode_image',
+                            side_effect=lambda data, **kwargs: (rng.normal(scale=0.1, size=128), None, None))
+        gallery = mock.patch('main.gallery.get_gallery', side_effect=lambda: Gallery().refresh())
+        for patch in (encode, gallery):
+            patch.start()
+            self.addCleanup(patch.stop)
+        media = override_settings(MEDIA_ROOT=os.path.join(self.directory, 'media'))
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def test_rerun_after_an_interruption_resumes_where_it_stopped(self):
+        def interrupt(report):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            enroll_citizens(self.rows, open_images(self.images), workers=1, batch_size=2, progress=interrupt)
+        self.assertEqual(Person.objects.count(), 2)
+
+        report = enroll_citizens(self.rows, open_images(self.images), workers=1, batch_size=2)
+        self.assertEqual((report['enrolled'], report['skipped'], report['failed']), (1, 2, 0))
+        self.assertEqual(sorted(Person.objects.values_list('national_id', flat=True)), ['1', '2', '3'])
+
+    def test_bad_rows_are_reported_with_their_line(self):
+        self.rows[0]['address'] = ''
+        self.rows[1]['image'] = 'missing.jpg'
+        self.rows.append(dict(self.rows[2], line=5))
+
+        report = enroll_citizens(self.rows, open_images(self.images), workers=1)
+
+        self.assertEqual(report['enrolled'], 1)
+        self.assertEqual([failure['line'] for failure in report['failures']], [2, 3, 5])
+
+
+class ReembedJobTests(TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        self.old = {}
+        for number in range(5):
+            picture = 'media/{}.jpg'.format(number)
+            Person.objects.create(name='Citizen {}'.format(number), national_id=str(number), address='Harare',
+                                  picture=picture, status='Free')
+            self.old[picture] = rng.normal(scale=0.1, size=128)
+        # The new encoder puts the same faces somewhere else entirely
+        self.new = {picture: encoding + 1.0 for picture, encoding in self.old.items()}
+        self.encoder = encoder_config(5, 'large')
+
+        self.encoded = []
+
+        def encode_picture(picture, encoder):
+            self.encoded.append(picture)
+            return self.new[picture] if encoder == self.encoder else self.old[picture]
+
+        for patch in (
+            mock.patch('main.gallery._encode_picture', side_effect=encode_picture),
+            mock.patch('main.reembed._encode_face', side_effect=lambda face, **kwargs: (self.new[face[0]], None)),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_interrupted_job_resumes_after_its_last_batch(self):
+        def interrupt(job):
+            if job.processed >= 2:
+                raise RuntimeError("killed")
+
+        job = run_reembed_job(start_reembed_job(self.encoder), workers=1, batch_size=2, progress=interrupt)
+        self.assertEqual((job.status, job.processed), ('failed', 2))
+        self.assertNotEqual(active_encoder(), self.encoder)
+
+        resumed = start_reembed_job(self.encoder)
+        self.assertEqual(resumed.pk, job.pk)
+        with mock.patch('main.reembed._encode_face', side_effect=lambda face, **kwargs: (self.new[face[0]], None)) as encode:
+            resumed = run_reembed_job(resumed, workers=1, batch_size=2)
+
+        self.assertEqual((resumed.status, resumed.processed, resumed.total), ('done', 5, 5))
+        self.assertEqual(encode.call_count, 3)
+        self.assertEqual(ReembedResult.objects.filter(job=resumed).count(), 5)
+
+    def test_gallery_switches_to_the_new_encoder_from_staged_encodings(self):
+        gallery = Gallery().refresh()
+        self.assertEqual(gallery.match(self.old['media/3.jpg'])['national_id'], '3')
+
+        job = run_reembed_job(start_reembed_job(self.encoder), workers=1)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(active_encoder(), self.encoder)
+
+        self.encoded.clear()
+        gallery.refresh()
+        self.assertEqual(gallery.encoder, self.encoder)
+        self.assertEqual(self.encoded, [])
+        self.assertEqual(gallery.match(self.new['media/3.jpg'])['national_id'], '3')
+        self.assertEqual(gallery.match(self.old['media/3.jpg'])['name'], 'Unknown')
+
+
+class MediaPathTests(TestCase):
+
+    def test_stored_references_map_into_media_root(self):
+        self.assertEqual(media_path('media/John%20Doe.jpg'), 'John Doe.jpg')
+        self.assertEqual(media_path('/media/detections/frame.jpg'), 'detections/frame.jpg')
+
+    def test_references_escaping_media_root_are_rejected(self):
+        for reference in ('../crimedetec/settings.py', '/media/../../etc/passwd', 'media/%2e%2e/%2e%2e/etc/passwd', ''):
+            self.assertIsNone(media_path(reference), reference)
+
+    def test_windows_separators_and_drives_are_rejected(self):
+        for reference in ('x%5C..%5C..%5Ccrimedetec%5Csettings.py', 'media/x\\..\\..\\manage.py',
+                          'C:/Windows/win.ini', '/media/C:%5Csecrets.txt', '%5C%5Cserver%5Cshare%5Cfile.jpg',
+                          'media/picture.jpg:stream'):
+            self.assertIsNone(media_path(reference), reference)
+
+    def test_symlinks_out_of_media_root_are_rejected(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.mkdir(os.path.join(directory, 'media'))
+        os.symlink(os.path.dirname(os.path.abspath(__file__)), os.path.join(directory, 'media', 'code'))
+
+        with override_settings(MEDIA_ROOT=os.path.join(directory, 'media')):
+            self.assertIsNone(media_path('media/code/tests.py'))
+            self.assertEqual(media_path('media/picture.jpg'), 'picture.jpg')
+
+
+@override_settings(MEDIA_SENDFILE=None)
+class ServeFileTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'file.bin')
+        with open(self.path, 'wb') as f:
+            f.write(b'0123456789')
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        response = serve_file(self.factory.get('/media/file.bin', **headers), self.path)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_full_file_carries_validators(self):
+        response, body = self.get()
+
+        self.assertEqual((response.status_code, body), (200, b'0123456789'))
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_matching_etag_is_answered_with_304(self):
+        etag = self.get()[0]['ETag']
+
+        response, body = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, body), (304, b''))
+
+    def test_byte_ranges(self):
+        for header, status, content_range, expected in (
+            ('bytes=2-4', 206, 'bytes 2-4/10', b'234'),
+            ('bytes=7-', 206, 'bytes 7-9/10', b'789'),
+            ('bytes=-3', 206, 'bytes 7-9/10', b'789'),
+            ('bytes=8-100', 206, 'bytes 8-9/10', b'89'),
+            ('bytes=10-', 416, 'bytes */10', b''),
+        ):
+            response, body = self.get(HTTP_RANGE=header)
+            self.assertEqual((response.status_code, response.get('Content-Range'), body),
+                             (status, content_range, expected), header)
+
+    def test_invalid_and_multiple_ranges_get_the_whole_file(self):
+        for header in ('bytes=5-3', 'bytes=0-1,4-5', 'bytes=-', 'lines=1-2'):
+            response, body = self.get(HTTP_RANGE=header)
+            self.assertEqual((response.status_code, body), (200, b'0123456789'), header)
+
+    def test_if_range_only_sends_part_of_an_unchanged_file(self):
+        response, _ = self.get()
+
+        for if_range in (response['ETag'], response['Last-Modified']):
+            self.assertEqual(self.get(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=if_range)[0].status_code, 206)
+        for if_range in ('"stale"', http_date(0)):
+            response, body = self.get(HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=if_range)
+            self.assertEqual((response.status_code, body), (200, b'0123456789'), if_range)
+
+    def test_media_view_refuses_paths_outside_media_root_and_dotfiles(self):
+        with open(os.path.join(self.directory, '.hidden'), 'wb') as f:
+            f.write(b'secret')
+
+        with override_settings(MEDIA_ROOT=self.directory, MEDIA_REQUIRE_LOGIN=False):
+            self.assertEqual(self.client.get('/media/file.bin').status_code, 200)
+            for path in ('/media/%2e%2e/manage.py', '/media/x%5C..%5C..%5Cmanage.py', '/media/C:%5Cwin.ini',
+                         '/media/.hidden', '/media/missing.bin'):
+                self.assertEqual(self.client.get(path).status_code, 404, path)
+
+
+class FaceQualityTests(TestCase):
+
+    def setUp(self):
+        self.flat = np.full((300, 300, 3), 128, dtype=np.uint8)
+        self.detailed = np.random.default_rng(5).integers(0, 256, (300, 300, 3), dtype=np.uint8)
+        self.box = (50, 200, 200, 50)
+
+    def test_small_faces_are_rejected_from_their_box_alone(self):
+        with mock.patch('face_recognition.api._raw_face_landmarks') as landmarks:
+            [(chip, quality)] = face_recognition.face_quality(self.detailed, [(0, 30, 30, 0)], min_size=36)
+
+        self.assertIsNone(chip)
+        self.assertEqual(quality, face_recognition.FaceQuality(30, None, None, 0.0))
+        landmarks.assert_not_called()
+
+    def test_blurred_faces_are_rejected_on_sharpness(self):
+        [(flat_chip, flat)] = face_recognition.face_quality(self.flat, [self.box], min_sharpness=20)
+        [(chip, quality)] = face_recognition.face_quality(self.detailed, [self.box], min_sharpness=20)
+
+        self.assertIsNone(flat_chip)
+        self.assertEqual(flat.score, 0.0)
+        self.assertEqual(chip.shape, (150, 150, 3))
+        self.assertGreater(quality.sharpness, 20)
+
+    def test_turned_faces_are_rejected_on_yaw(self):
+        [(chip, quality)] = face_recognition.face_quality(self.detailed, [self.box])
+        self.assertIsNotNone(chip)
+
+        [(chip, _)] = face_recognition.face_quality(self.detailed, [self.box], max_yaw=abs(quality.yaw) / 2)
+        self.assertIsNone(chip)
+
+    @override_settings(FACE_MIN_SIZE=200, FACE_MIN_SHARPNESS=0.0, FACE_MAX_YAW=90.0)
+    def test_gallery_applies_the_thresholds_from_settings(self):
+        [(chip, quality)] = Gallery().refresh().face_quality(self.detailed, [self.box])
+
+        self.assertIsNone(chip)
+        self.assertEqual(quality.size, 150)
+
+
+class DetectionRegionTests(TestCase):
+
+    def test_non_max_suppression_keeps_the_best_box_of_each_face(self):
+        boxes = [(0, 100, 100, 0), (5, 105, 105, 5), (200, 300, 300, 200)]
+
+        self.assertEqual(face_recognition.non_max_suppression(boxes, [0.5, 0.9, 0.1]),
+                         [(5, 105, 105, 5), (200, 300, 300, 200)])
+        # Without scores the larger box wins
+        self.assertEqual(face_recognition.non_max_suppression([(10, 90, 90, 10), (0, 100, 100, 0)]),
+                         [(0, 100, 100, 0)])
+
+    def test_tiles_cover_the_length_evenly_with_overlap(self):
+        spans = _tile_spans(1920, 480, 80)
+
+        self.assertEqual(spans, [(0, 448), (368, 816), (736, 1184), (1104, 1552), (1472, 1920)])
+        self.assertTrue(all(end - start <= 480 for start, end in spans))
+        self.assertTrue(all(previous[1] - current[0] == 80 for previous, current in zip(spans, spans[1:])))
+        self.assertEqual(_tile_spans(300, 480, 80), [(0, 300)])
+
+    def test_search_regions_skip_flat_tiles(self):
+        img = np.zeros((960, 1920, 3), dtype=np.uint8)
+        self.assertEqual(_search_regions(img, 480, 80, 3.0), [])
+
+        img[100:300, 900:1300] = np.random.default_rng(6).integers(0, 256, (200, 400, 3))
+        # The two neighbouring tiles of the first row that the detail falls in, merged into one region
+        self.assertEqual(_search_regions(img, 480, 80, 3.0), [(0, 1552, 374, 736)])
+
+    def test_search_regions_cover_the_image_once_when_every_tile_is_detailed(self):
+        img = np.random.default_rng(7).integers(0, 256, (960, 1920, 3), dtype=np.uint8)
+
+        self.assertEqual(_search_regions(img, 480, 80, 3.0), [(0, 1920, 960, 0)])
+
+
+class GalleryMatchTests(TestCase):
+
+    def setUp(self):
+        self.encodings = {}
+        for national_id, status, position in (('1', 'Wanted', 0.4), ('2', 'Free', 0.1)):
+            picture = 'media/{}.jpg'.format(national_id)
+            Person.objects.create(name='Citizen {}'.format(national_id), national_id=national_id, address='Harare',
+                                  picture=picture, status=status)
+            self.encodings[picture] = np.full(128, position / np.sqrt(128))
+
+        patch = mock.patch('main.gallery._encode_picture', side_effect=lambda picture, encoder: self.encodings[picture])
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.gallery = Gallery().refresh()
+
+    def test_watchlist_hit_closer_than_anyone_else_is_reported(self):
+        probe = np.full(128, 0.45 / np.sqrt(128))
+
+        for fallback in (True, False):
+            self.assertEqual(self.gallery.match(probe, statuses=('Wanted',), fallback=fallback)['status'], 'Wanted')
+
+    def test_watchlist_hit_is_not_reported_when_another_citizen_is_closer(self):
+        probe = np.zeros(128)
+
+        self.assertEqual(self.gallery.match(probe, statuses=('Wanted',))['national_id'], '2')
+        self.assertEqual(self.gallery.match(probe, statuses=('Wanted',), fallback=False)['name'], 'Unknown')
+
+    def test_status_changes_reach_a_long_running_gallery_on_its_next_stale_refresh(self):
+        Person.objects.filter(national_id='2').update(status='Wanted')
+        probe = np.zeros(128)
+
+        self.gallery.refresh_if_stale(3600)
+        self.assertEqual(self.gallery.match(probe, statuses=('Wanted',))['status'], 'Free')
+        self.gallery.refresh_if_stale(0)
+        self.assertEqual(self.gallery.match(probe, statuses=('Wanted',))['status'], 'Wanted')
+
+
+class GalleryCacheTests(TestCase):
+
+    def setUp(self):
+        self.person = Person.objects.create(name='Citizen', national_id='1', address='Harare',
+                                            picture='media/1.jpg', status='Free')
+        self.encode = mock.patch('main.gallery._encode_picture', return_value=np.zeros(128)).start()
+        self.addCleanup(mock.patch.stopall)
+        self.gallery = Gallery().refresh()
+        self.encode.reset_mock()
+
+    def test_unchanged_pictures_are_not_encoded_again(self):
+        self.gallery.refresh()
+        self.encode.assert_not_called()
+
+    def test_picture_replaced_at_the_same_path_is_encoded_again(self):
+        self.person.save()
+        self.gallery.refresh()
+        self.assertEqual(self.encode.call_count, 1)
+
+    def test_remembered_encoding_is_used_for_a_new_citizen(self):
+        person = Person.objects.create(name='Other', national_id='2', address='Harare',
+                                       picture='media/2.jpg', status='Free')
+        self.gallery.remember(person, np.ones(128))
+        self.gallery.refresh()
+
+        self.encode.assert_not_called()
+        np.testing.assert_array_equal(self.gallery.encoding_for(person.id), np.ones(128))
+
+
+class FaceChipViewTests(TestCase):
+
+    def setUp(self):
+        self.chip = FaceChip.objects.create(segment=0, offset=0, length=4)
+        patch = mock.patch('main.api_views.read_chip', return_value=b'RIFF')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_chips_are_public_by_default(self):
+        with override_settings(MEDIA_REQUIRE_LOGIN=False):
+            response = self.client.get('/api/chips/{}'.format(self.chip.pk))
+
+        self.assertEqual((response.status_code, response.content), (200, b'RIFF'))
+
+    @override_settings(MEDIA_REQUIRE_LOGIN=True)
+    def test_anonymous_clients_are_refused_when_login_is_required(self):
+        self.assertEqual(self.client.get('/api/chips/{}'.format(self.chip.pk)).status_code, 403)
+
+        session = self.client.session
+        session['id'] = 1
+        session.save()
+        self.assertEqual(self.client.get('/api/chips/{}'.format(self.chip.pk)).status_code, 200)
+
+
+class VideoJobTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = override_settings(MEDIA_ROOT=self.media_root, VIDEO_DETECTION_WORKERS=1)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.person = Person.objects.create(name='Citizen', national_id='1', address='Harare',
+                                            picture='media/1.jpg', status='Wanted')
+        self.result = {
+            'frames_analyzed': 12,
+            'processing_time': 1.5,
+            'tracks': [{
+                'track_id': 3, 'person_id': self.person.pk, 'name': 'Citizen', 'status': 'Wanted', 'national_id': '1',
+                'confidence': 71.5, 'quality': 0.8, 'box': [10, 60, 60, 10], 'timestamp': 1.0,
+                'first_seen': 0.5, 'last_seen': 4.0, 'frames_seen': 7,
+            }],
+            'encodings': [np.zeros(128)],
+            'chips': [None],
+            'landmark_model': 'small',
+            'encoder_version': active_encoder().version,
+        }
+        for patch in (
+            mock.patch('main.gallery.get_gallery'),
+            mock.patch('main.chips.save_chips', return_value=[None]),
+            # The job thread closes its own connection, which would end the test's transaction
+            mock.patch('main.video.connection'),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_upload_starts_a_background_job(self):
+        with mock.patch('main.api_views.start_video_job') as start:
+            response = self.client.post('/api/detect-video', {'video': io.BytesIO(b'video'), 'sample_fps': '4'})
+
+        self.assertEqual(response.status_code, 202)
+        job = VideoJob.objects.get(pk=response.json()['job_id'])
+        start.assert_called_once_with(job)
+        self.assertEqual((job.status, job.sample_fps), ('pending', 4.0))
+        self.assertTrue(job.video_url.startswith('/media/'))
+        self.assertEqual(response.json()['poll_url'], '/api/video-jobs/{}'.format(job.pk))
+
+    def test_finished_job_reports_its_tracks(self):
+        job = VideoJob.objects.create(video_name='clip.mp4', video_url='/media/clip.mp4', sample_fps=4.0)
+        with mock.patch('main.video.analyze_video', return_value=self.result) as analyze:
+            run_video_job(job.pk)
+
+        self.assertEqual(analyze.call_args[0][0], os.path.join(self.media_root, 'clip.mp4'))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.frames_analyzed), ('done', 12))
+        self.assertEqual(job.detection_event.image_path, '/media/clip.mp4')
+
+        data = self.client.get('/api/video-jobs/{}'.format(job.pk)).json()
+        self.assertEqual(data['status'], 'done')
+        self.assertEqual(data['event_id'], job.detection_event_id)
+        self.assertEqual([(t['track_id'], t['person_id'], t['frames_seen']) for t in data['tracks']],
+                         [(3, self.person.pk, 7)])
+        self.assertEqual((data['statistics']['frames_analyzed'], data['statistics']['known_faces']), (12, 1))
+
+    def test_failed_job_reports_its_error(self):
+        job = VideoJob.objects.create(video_name='clip.mp4', video_url='/media/clip.mp4')
+        with mock.patch('main.video.analyze_video', side_effect=IOError('Could not open video')):
+            run_video_job(job.pk)
+
+        data = self.client.get('/api/video-jobs/{}'.format(job.pk)).json()
+        self.assertEqual((data['status'], data['error']), ('failed', 'Could not open video'))
+        self.assertNotIn('tracks', data)
+        self.assertEqual(self.client.get('/api/video-jobs/{}'.format(job.pk + 1)).status_code, 404)
+
+    def test_command_stores_a_media_url(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        inside = os.path.join(self.media_root, 'cam 1.mp4')
+        copied = os.path.join(outside, 'clip.mp4')
+        for path in (inside, copied):
+            with open(path, 'wb') as f:
+                f.write(b'video')
+
+        with mock.patch('main.management.commands.detect_video.analyze_video', return_value=self.result), \
+                mock.patch('main.management.commands.detect_video.get_gallery'):
+            call_command('detect_video', inside, stdout=io.StringIO(), stderr=io.StringIO())
+            call_command('detect_video', copied, stdout=io.StringIO(), stderr=io.StringIO())
+
+        paths = list(DetectionEvent.objects.order_by('id').values_list('image_path', flat=True))
+        self.assertEqual(paths, ['/media/cam%201.mp4', '/media/clip.mp4'])
+        self.assertTrue(os.path.isfile(os.path.join(self.media_root, 'clip.mp4')))
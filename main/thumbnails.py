@@ -0,0 +1,132 @@
+import hashlib
+import os
+import posixpath
+from urllib.parse import unquote
+
+import PIL.Image
+import PIL.ImageOps
+from django.conf import settings
+from django.urls import reverse
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')
+
+# format name -> (PIL format, content type, save options)
+FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+# Hex digits of the source key carried by thumbnail URLs
+VERSION_LENGTH = 16
+
+
+def media_path(reference):
+    """
+    Turn a stored image reference into a path relative to MEDIA_ROOT, or None when it is not a media file.
+
+    Citizen pictures are stored as "media/name.jpg" and detection images as "/media/name.jpg", both
+    URL-quoted. Backslashes, drive letters and colons never occur in stored names and are refused, so a
+    reference cannot name another drive or a UNC share on Windows, and the resolved path (symlinks
+    included) must stay inside MEDIA_ROOT.
+    """
+    if not reference:
+        return None
+    path = unquote(reference)
+    if '\\' in path or ':' in path:
+        return None
+    path = posixpath.normpath(path.lstrip('/'))
+    prefix = settings.MEDIA_URL.strip('/') + '/'
+    if path.startswith(prefix):
+        path = path[len(prefix):]
+    if path.startswith(('..', '/')) or path == '.':
+        return None
+
+    root = os.path.realpath(settings.MEDIA_ROOT)
+    try:
+        if os.path.commonpath([os.path.realpath(os.path.join(root, path)), root]) != root:
+            return None
+    except ValueError:
+        # On another drive
+        return None
+    return path
+
+
+def size_bucket(size):
+    """Round a requested size up to the next of settings.THUMBNAIL_SIZES, so a handful of sizes are ever cached."""
+    for bucket in sorted(settings.THUMBNAIL_SIZES):
+        if size <= bucket:
+            return bucket
+    return max(settings.THUMBNAIL_SIZES)
+
+
+def source_key(path):
+    """
+    Hash of a media file's path, byte size and modification time, which changes whenever the file is replaced.
+
+    :raises FileNotFoundError: when there is no such media file
+    """
+    stat = os.stat(os.path.join(settings.MEDIA_ROOT, path))
+    return hashlib.sha256("{}:{}:{}".format(path, stat.st_size, stat.st_mtime_ns).encode()).hexdigest()
+
+
+def thumbnail_url(reference, size=None):
+    """
+    The api/thumbnails URL of a stored image reference, or None when it is not a media image (e.g. a video).
+
+    The URL carries a version of the source file (?v=), so clients may cache it for good: a replaced
+    source gets a new URL.
+    """
+    path = media_path(reference)
+    if path is None or not path.lower().endswith(IMAGE_EXTENSIONS):
+        return None
+    url = reverse('api_thumbnail', args=[size_bucket(size or settings.THUMBNAIL_LIST_SIZE), path])
+    try:
+        return "{}?v={}".format(url, source_key(path)[:VERSION_LENGTH])
+    except OSError:
+        return url
+
+
+def get_thumbnail(path, size, image_format='webp'):
+    """
+    Return the filesystem path of a thumbnail of a media image, rendering and caching it on first use.
+
+    Thumbnails are cached under settings.THUMBNAIL_CACHE_DIR, keyed by a hash of the source's path, byte
+    size and modification time plus the size and format, so a replaced source gets new thumbnails
+    without anything having to be invalidated.
+
+    :param path: path relative to MEDIA_ROOT, as returned by media_path
+    :param size: longest side in pixels, rounded up to one of settings.THUMBNAIL_SIZES
+    :param image_format: 'webp' or 'jpeg'
+    :raises FileNotFoundError: when there is no such media file
+    """
+    pil_format, _, options = FORMATS[image_format]
+    size = size_bucket(size)
+    source = os.path.join(settings.MEDIA_ROOT, path)
+    key = source_key(path)
+    cached = os.path.join(settings.THUMBNAIL_CACHE_DIR, key[:2], "{}-{}.{}".format(key, size, image_format))
+    if os.path.exists(cached):
+        return cached
+
+    with PIL.Image.open(source) as image:
+        # JPEGs are decoded straight at a fraction of their resolution, which is most of the saving
+        image.draft('RGB', (size, size))
+        image = PIL.ImageOps.exif_transpose(image)
+        image.thumbnail((size, size), PIL.Image.LANCZOS)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(cached, os.getpid())
+        image.save(tmp_path, pil_format, **options)
+    os.replace(tmp_path, cached)
+    return cached
+
+
+def content_type(image_format):
+    return FORMATS[image_format][1]
+
+
+def thumbnail_version(thumbnail):
+    """The ?v= version of the thumbnail URLs a cached thumbnail file answers."""
+    return os.path.basename(thumbnail)[:VERSION_LENGTH]
@@ -0,0 +1,156 @@
+import itertools
+
+import dlib
+
+
+def box_iou(a, b):
+    """Intersection over union of two boxes in css (top, right, bottom, left) order."""
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    if right <= left or bottom <= top:
+        return 0.0
+
+    intersection = (right - left) * (bottom - top)
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return intersection / float(area_a + area_b - intersection)
+
+
+def _centroid_distance(a, b):
+    """Distance between box centres, relative to the size of box a."""
+    ay, ax = (a[0] + a[2]) / 2.0, (a[1] + a[3]) / 2.0
+    by, bx = (b[0] + b[2]) / 2.0, (b[1] + b[3]) / 2.0
+    size = max(a[1] - a[3], a[2] - a[0], 1)
+    return ((ay - by) ** 2 + (ax - bx) ** 2) ** 0.5 / size
+
+
+class Track:
+    def __init__(self, track_id, box, frame_index):
+        self.track_id = track_id
+        self.box = box
+        self.first_frame = frame_index
+        self.last_frame = frame_index
+        self.missed = 0
+        # Gallery match for this track and the box it was encoded from
+        self.identity = None
+        self.encoded_box = None
+        self.since_encoding = 0
+        self.correlation = None
+
+
+class FaceTracker:
+    """
+    Associates face boxes across frames so each face keeps a track id and
+    its last identity, and only has to be re-encoded now and then.
+
+    Boxes are matched greedily to existing tracks by IoU, falling back to
+    centroid distance for fast-moving faces whose boxes no longer overlap.
+    A track is re-encoded when it is new, every `reencode_every` detections,
+    or when its box has moved or resized enough that the IoU with the box
+    it was last encoded from drops below `reencode_iou`.
+
+    :param iou_threshold: minimum IoU for a box to continue a track
+    :param max_centroid_distance: centre distance, relative to the face size, accepted when boxes don't overlap enough
+    :param max_missed: detections a track may go unmatched before it is dropped
+    :param reencode_every: re-encode a track after this many detections without encoding
+    :param reencode_iou: re-encode a track when its box IoU with the encoded box falls below this
+    :param use_correlation: follow tracks between detections with dlib's correlation tracker
+    """
+
+    def __init__(self, iou_threshold=0.3, max_centroid_distance=0.5, max_missed=5, reencode_every=15,
+                 reencode_iou=0.5, use_correlation=False):
+        self.iou_threshold = iou_threshold
+        self.max_centroid_distance = max_centroid_distance
+        self.max_missed = max_missed
+        self.reencode_every = reencode_every
+        self.reencode_iou = reencode_iou
+        self.use_correlation = use_correlation
+        self.tracks = []
+        self._ids = itertools.count(1)
+
+    def update(self, boxes, frame_index, rgb_frame=None):
+        """
+        Feed the boxes from a detection pass.
+
+        :return: the tracks seen in this pass, in the same order as boxes
+        """
+        candidates = []
+        for t, track in enumerate(self.tracks):
+            for b, box in enumerate(boxes):
+                overlap = box_iou(track.box, box)
+                distance = _centroid_distance(track.box, box)
+                if overlap >= self.iou_threshold or distance <= self.max_centroid_distance:
+                    candidates.append((-overlap, distance, t, b))
+        candidates.sort()
+
+        matched_tracks = set()
+        assigned = [None] * len(boxes)
+        for _, _, t, b in candidates:
+            if t in matched_tracks or assigned[b] is not None:
+                continue
+            matched_tracks.add(t)
+            assigned[b] = self.tracks[t]
+
+        for b, box in enumerate(boxes):
+            track = assigned[b]
+            if track is None:
+                track = Track(next(self._ids), box, frame_index)
+                self.tracks.append(track)
+                assigned[b] = track
+            track.box = box
+            track.last_frame = frame_index
+            track.missed = 0
+            track.since_encoding += 1
+            if self.use_correlation and rgb_frame is not None:
+                track.correlation = dlib.correlation_tracker()
+                track.correlation.start_track(rgb_frame, _css_to_rect(box))
+
+        seen = set(id(track) for track in assigned)
+        for track in self.tracks:
+            if id(track) not in seen:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        return assigned
+
+    def needs_encoding(self, track):
+        return (
+            track.identity is None
+            or track.since_encoding >= self.reencode_every
+            or box_iou(track.box, track.encoded_box) < self.reencode_iou
+        )
+
+    def set_identity(self, track, identity):
+        track.identity = identity
+        track.encoded_box = track.box
+        track.since_encoding = 0
+
+    def predict(self, rgb_frame):
+        """
+        Move every live track to its correlation tracker's estimate for a
+        frame that skipped detection.
+
+        :return: the tracks that have an identity and were updated
+        """
+        if not self.use_correlation:
+            return []
+
+        height, width = rgb_frame.shape[:2]
+        predicted = []
+        for track in self.tracks:
+            if track.correlation is None or track.missed or track.identity is None:
+                continue
+            track.correlation.update(rgb_frame)
+            position = track.correlation.get_position()
+            track.box = (
+                max(int(position.top()), 0),
+                min(int(position.right()), width),
+                min(int(position.bottom()), height),
+                max(int(position.left()), 0),
+            )
+            predicted.append(track)
+        return predicted
+
+
+def _css_to_rect(css):
+    return dlib.rectangle(css[3], css[0], css[1], css[2])
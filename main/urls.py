@@ -1,6 +1,4 @@
 from django.urls import path
-from django.conf import settings
-from django.conf.urls.static import static
 
 from main.views import FileView
 from . import views
@@ -30,6 +28,3 @@ urlpatterns = [
     path("found_thief/<int:thief_id>/", views.foundThief, name="found_thief"),
     path("reports", views.viewReports),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
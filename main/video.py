@@ -0,0 +1,276 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+import face_recognition
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from main.tracking import FaceTracker
+
+
+def sample_frames(path, sample_fps=2.0, max_seconds=None):
+    """
+    Stream-decode a video file, yielding (frame_index, timestamp, rgb_frame)
+    for roughly `sample_fps` frames per second of footage.
+
+    Frames in between are only grabbed, not decoded into images, so a low
+    sample rate also skips most of the colour conversion work.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError("Could not open video {!r}".format(path))
+
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    step = max(1, int(round(fps / sample_fps))) if sample_fps else 1
+    frame_index = 0
+
+    try:
+        while capture.grab():
+            timestamp = frame_index / fps
+            if max_seconds is not None and timestamp > max_seconds:
+                break
+            if frame_index % step == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield frame_index, timestamp, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            frame_index += 1
+    finally:
+        capture.release()
+
+
+def _detect_frame(frame_index, timestamp, rgb_frame, model, upsample, num_jitters=1, landmark_model="small",
+                  thresholds=None):
+    # Runs in a pool worker, so it returns plain lists rather than touching the database. Faces under the
+    # quality thresholds get None for their encoding and chip.
+    locations = face_recognition.face_locations(rgb_frame, upsample, model)
+    assessed = face_recognition.face_quality(rgb_frame, locations, landmark_model, **(thresholds or {})) if locations else []
+    chips = [chip for chip, _ in assessed]
+    encoded = iter(face_recognition.chip_encodings([chip for chip in chips if chip is not None], num_jitters))
+    encodings = [next(encoded) if chip is not None else None for chip in chips]
+    return frame_index, timestamp, locations, encodings, chips, [quality.score for _, quality in assessed]
+
+
+def process_pool(workers):
+    # macOS will crash due to a bug in libdispatch if you don't use 'forkserver'
+    context = multiprocessing
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+    return context.Pool(processes=workers)
+
+
+def detect_frames(frames, workers=None, model="hog", upsample=1, num_jitters=1, landmark_model="small", thresholds=None,
+                  pool=None):
+    """
+    Run detection and encoding over an iterable of sampled frames on a
+    process pool, yielding results in frame order.
+
+    At most two frames per worker are in flight, so decoding never runs
+    ahead of the pool and memory stays flat however long the video is.
+
+    :param num_jitters: passed to face_encodings
+    :param landmark_model: landmark model passed to face_encodings
+    :param thresholds: face_quality thresholds (keyword arguments) faces must pass to be encoded
+    :param pool: an existing process pool of `workers` processes to use, which is left running afterwards
+    """
+    encoder_args = (model, upsample, num_jitters, landmark_model, thresholds)
+    if workers == 1 and pool is None:
+        for frame_index, timestamp, rgb_frame in frames:
+            yield _detect_frame(frame_index, timestamp, rgb_frame, *encoder_args)
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        pool = process_pool(workers)
+    in_flight = deque()
+    limit = 2 * (workers or os.cpu_count() or 1)
+
+    try:
+        for frame_index, timestamp, rgb_frame in frames:
+            in_flight.append(pool.apply_async(_detect_frame, (frame_index, timestamp, rgb_frame) + encoder_args))
+            if len(in_flight) >= limit:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+def analyze_video(path, gallery, sample_fps=2.0, workers=None, tolerance=0.5, model="hog", upsample=1, max_seconds=None,
+                  pool=None):
+    """
+    Recognize faces in a video file and collapse them into one summary per tracked face.
+
+    :param path: path to a local video file
+    :param gallery: a main.gallery.Gallery to match faces against
+    :param sample_fps: frames per second of footage to analyze
+    :param workers: pool size for detection and encoding. None uses every core, 1 runs inline.
+    :param pool: an existing process pool of `workers` processes to use instead of starting one
+    :return: a dict with the frames analyzed, elapsed seconds, a list of track summaries, each with
+             the best match, best confidence, its box and first/last seen timestamps, the face encoding
+             of each track's best detection with its aligned face chip, and the version of the encoder the
+             encodings were computed with. Tracks never seen clearly enough to pass the face quality
+             thresholds are left out.
+    """
+    from main.encoders import quality_thresholds
+
+    started = time.time()
+    # Sampled frames are far apart, so allow faces to move further between them than in a live stream
+    tracker = FaceTracker(iou_threshold=0.2, max_centroid_distance=1.0, max_missed=max(2, int(sample_fps * 2)))
+    tracks = {}
+    # Encoding and face chip of each track's best detection, stored with its match for later retroactive searches
+    best_encodings = {}
+    best_chips = {}
+    frames = 0
+
+    encoder = gallery.encoder
+    results = detect_frames(
+        sample_frames(path, sample_fps, max_seconds), workers, model, upsample, encoder.num_jitters, encoder.model,
+        quality_thresholds(), pool,
+    )
+    for frame_index, timestamp, locations, encodings, chips, scores in results:
+        frames += 1
+        for track, encoding, chip, score in zip(tracker.update(locations, frame_index), encodings, chips, scores):
+            # Low quality sightings still move the track along, but only faces that were encoded are matched
+            if encoding is None:
+                continue
+            detection = gallery.match(encoding, tolerance, statuses=gallery.watchlist)
+            detection["quality"] = score
+            summary = tracks.get(track.track_id)
+            if summary is None:
+                summary = tracks[track.track_id] = {
+                    "track_id": track.track_id,
+                    "first_seen": timestamp,
+                    "frames_seen": 0,
+                    "best": None,
+                }
+            summary["last_seen"] = timestamp
+            summary["frames_seen"] += 1
+
+            # A known identity always beats an unknown one, then the higher confidence wins
+            best = summary["best"]
+            known = detection["person_id"] is not None
+            if best is None or (known, detection["confidence"]) > (best["person_id"] is not None, best["confidence"]):
+                detection["box"] = [int(v) for v in track.box]
+                detection["timestamp"] = timestamp
+                summary["best"] = detection
+                best_encodings[track.track_id] = encoding
+                best_chips[track.track_id] = chip
+
+    summaries = []
+    for summary in tracks.values():
+        best = summary.pop("best")
+        summary.update(best)
+        summaries.append(summary)
+
+    return {
+        "frames_analyzed": frames,
+        "processing_time": time.time() - started,
+        "tracks": summaries,
+        "encodings": [best_encodings[summary["track_id"]] for summary in summaries],
+        "chips": [best_chips[summary["track_id"]] for summary in summaries],
+        "landmark_model": encoder.model,
+        "encoder_version": encoder.version,
+    }
+
+
+def record_video_event(image_name, image_path, result, user_id=None):
+    """Store an analyze_video result as one DetectionEvent with a DetectionMatch per track."""
+    from main.models import DetectionEvent, DetectionMatch
+    from main.sightings import pack_encoding
+    from main.clustering import assign_unknown_face
+    from main.chips import save_chips
+
+    tracks = result["tracks"]
+    known = sum(1 for track in tracks if track["person_id"] is not None)
+
+    event = DetectionEvent.objects.create(
+        image_name=image_name,
+        image_path=image_path,
+        total_faces_detected=len(tracks),
+        known_faces_matched=known,
+        unknown_faces_detected=len(tracks) - known,
+        processing_time_seconds=result["processing_time"],
+        detection_method='video_file',
+        user_id=user_id,
+    )
+
+    # Each unknown track is one face, so it joins a cluster once rather than once per frame
+    clusters = [
+        assign_unknown_face(encoding, result["encoder_version"]) if track["person_id"] is None else None
+        for track, encoding in zip(tracks, result["encodings"])
+    ]
+
+    chips = save_chips(result["chips"], result["landmark_model"])
+
+    DetectionMatch.objects.bulk_create([
+        DetectionMatch(
+            detection_event=event,
+            matched_person_id=track["person_id"],
+            confidence_score=track["confidence"],
+            is_match=track["person_id"] is not None,
+            face_top=track["box"][0],
+            face_right=track["box"][1],
+            face_bottom=track["box"][2],
+            face_left=track["box"][3],
+            track_id=track["track_id"],
+            first_seen_seconds=track["first_seen"],
+            last_seen_seconds=track["last_seen"],
+            frames_seen=track["frames_seen"],
+            face_encoding=pack_encoding(encoding),
+            encoder_version=result["encoder_version"],
+            chip=chip,
+            quality_score=track["quality"],
+            unknown_cluster_id=cluster_id,
+        )
+        for track, encoding, chip, cluster_id in zip(tracks, result["encodings"], chips, clusters)
+    ])
+    return event
+
+
+# Uploaded videos are analyzed one at a time per process, on a pool kept running between jobs
+_job_lock = threading.Lock()
+_job_pool = None
+
+
+def start_video_job(job):
+    """Analyze the video of a pending VideoJob on a background thread, which marks the job done or failed."""
+    threading.Thread(target=run_video_job, args=(job.id,), name="video-job-{}".format(job.id), daemon=True).start()
+
+
+def run_video_job(job_id):
+    global _job_pool
+    from django.core.files.storage import FileSystemStorage
+    from main.models import VideoJob
+    from main.gallery import get_gallery
+    from main.thumbnails import media_path
+
+    try:
+        with _job_lock:
+            VideoJob.objects.filter(pk=job_id).update(status='running')
+            job = VideoJob.objects.get(pk=job_id)
+
+            workers = settings.VIDEO_DETECTION_WORKERS
+            if workers != 1 and _job_pool is None:
+                _job_pool = process_pool(workers)
+            result = analyze_video(
+                FileSystemStorage().path(media_path(job.video_url)), get_gallery(), sample_fps=job.sample_fps, workers=workers,
+                pool=_job_pool if workers != 1 else None,
+            )
+
+        event = record_video_event(job.video_name, job.video_url, result, job.user_id)
+        VideoJob.objects.filter(pk=job_id).update(
+            status='done', detection_event=event, frames_analyzed=result["frames_analyzed"], completed_at=timezone.now(),
+        )
+    except Exception as e:
+        VideoJob.objects.filter(pk=job_id).update(status='failed', error=str(e), completed_at=timezone.now())
+    finally:
+        # The thread's own database connection is not closed by the request cycle
+        connection.close()
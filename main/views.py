@@ -1,4 +1,5 @@
 
+from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.shortcuts import render, HttpResponse, redirect
 from django.contrib import messages
@@ -16,6 +17,11 @@ from django.contrib.auth import logout
 
 
 from main.models import User, Person, ThiefLocation
+from main.gallery import get_gallery, update_gallery_status
+from main.sightings import start_retro_search
+from main.enrollment import check_enrollment, remember_enrollment
+from main.stream import StreamProcessor, open_capture
+from main.pipeline import Pipeline
 
 
 class FileView(APIView):
@@ -85,6 +91,17 @@ def saveCitizen(request):
             filename = fs.save(myfile.name, myfile)
             uploaded_file_url = fs.url(filename)
 
+            encoding, duplicates, chip = check_enrollment(fs.path(filename))
+            if duplicates:
+                fs.delete(filename)
+                messages.error(
+                    request,
+                    "This face is already enrolled as {} (National ID {})".format(
+                        duplicates[0]["name"], duplicates[0]["national_id"]
+                    ),
+                )
+                return redirect(addCitizen)
+
             person = Person.objects.create(
                 name=request.POST["name"],
                 national_id=request.POST["national_id"],
@@ -93,6 +110,7 @@ def saveCitizen(request):
                 status="Free",
             )
             person.save()
+            remember_enrollment(person, encoding, chip)
             messages.add_message(request, messages.INFO, "Citizen successfully added")
             return redirect(viewCitizens)
 
@@ -106,6 +124,8 @@ def viewCitizens(request):
 def wantedCitizen(request, citizen_id):
     wanted = Person.objects.filter(pk=citizen_id).update(status="Wanted")
     if wanted:
+        update_gallery_status(citizen_id, "Wanted")
+        start_retro_search(citizen_id)
         # person = Person.objects.filter(pk=citizen_id)
         # thief = ThiefLocation.objects.create(
         #     name=person.get().name,
@@ -128,6 +148,7 @@ def wantedCitizen(request, citizen_id):
 def freeCitizen(request, citizen_id):
     free = Person.objects.filter(pk=citizen_id).update(status="Free")
     if free:
+        update_gallery_status(citizen_id, "Free")
         messages.add_message(
             request,
             messages.INFO,
@@ -305,32 +326,15 @@ def detectImage(request):
 
 def detectWithWebcam(request):
     # Get a reference to webcam #0 (the default one)
-    video_capture = cv2.VideoCapture(0)
-
-    # Load a sample picture and learn how to recognize it.
-    images = []
-    encodings = []
-    names = []
-    files = []
-    nationalIds = []
-
-    prsn = Person.objects.all()
-    for crime in prsn:
-        images.append(crime.name + "_image")
-        encodings.append(crime.name + "_face_encoding")
-        files.append(crime.picture)
-        # Modify here to include only the name
-        names.append(crime.name)
-        nationalIds.append(crime.national_id)
+    video_capture = open_capture(0)
 
-    for i in range(0, len(images)):
-        images[i] = face_recognition.load_image_file(files[i])
-        encodings[i] = face_recognition.face_encodings(images[i])[0]
-
-    # Create arrays of known face encodings and their names
-    known_face_encodings = encodings
-    known_face_names = names
-    n_id = nationalIds
+    # Known faces come from the shared gallery cache, and detection runs on
+    # a downsampled frame every few frames instead of on every full frame.
+    # Capture and detection run on their own threads so this loop only
+    # draws and displays the freshest results.
+    gallery = get_gallery()
+    pipeline = Pipeline(video_capture, StreamProcessor(gallery, refresh_every=settings.GALLERY_REFRESH_SECONDS)).start()
+    detections = []
 
     # Global variables to store the coordinates of the selected region
     top_left = (0, 0)
@@ -352,77 +356,27 @@ def detectWithWebcam(request):
     cv2.namedWindow("Select Area")
     cv2.setMouseCallback("Select Area", mouse_callback)
 
-    while True:
-        # Grab a single frame of video
-        ret, frame = video_capture.read()
-
-        # Convert the image from BGR color (which OpenCV uses) to RGB color (which face_recognition uses)
-        rgb_frame = frame[:, :, ::-1]
-
-        # Find all the faces and face enqcodings in the frame of video
-        face_locations = face_recognition.face_locations(rgb_frame)
-        face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+    for frame_index, frame, result in pipeline:
+        # Boxes from the last detection are redrawn on the frames in between
+        if result is not None:
+            detections = result
 
-        frame_count = 0
         # Loop through each face in this frame of video
-        for (top, right, bottom, left), face_encoding in zip(
-            face_locations, face_encodings
-        ):
-            frame_count += 1
-            # See if the face is a match for the known face(s)
-            matches = face_recognition.compare_faces(
-                known_face_encodings, face_encoding
-            )
+        for detection in detections:
+            top, right, bottom, left = detection["box"]
+            name = detection["name"]
 
-            name = "Unknown"
-            color = (0, 255, 0)  # color for unknown faces i.e green
-
-            # If a match was found in known_face_encodings, just use the first one.
-            if True in matches:
-                first_match_index = matches.index(True)
-                name = known_face_names[first_match_index]
-                color = (0, 0, 255)  # color for known faces red without blinking
-
-                # Draw a blinking rectangle around the known faces
-                if True in matches and frame_count % 10 < 5:
-                    cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
-                else:
-                    # draw rectangle aroud the face for unknown faces
-                    cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
-                
-                cv2.rectangle(frame, (left, bottom - 35), (right, bottom), color, cv2.FILLED)
-                font = cv2.FONT_HERSHEY_DUPLEX
-                cv2.putText(frame, name, (left + 6, bottom - 6), font, 1.0, (255,255,255), 1)
+            if name != "Unknown":
+                color = (0, 0, 255)  # color for known faces i.e red
             elif selected:
-
                 continue
-            if name == "Unknown" and not selected:
-                cv2.rectangle(frame, (left, top), (right,bottom), color, 2)
-                cv2.rectangle(frame, (left, bottom - 35), (right, bottom), color, cv2.FILLED)
-                font = cv2.FONT_HERSHEY_DUPLEX
-                cv2.putText(frame, name, (left + 6, bottom - 6), font, 1.0, (255,255,255), 1)
-
-
-
-            # Or instead, use the known face with the smallest distance to the new face
-            # face_distances = face_recognition.face_distance(
-            #     known_face_encodings, face_encoding
-            # )
-            # best_match_index = np.argmin(face_distances)
-            # if matches[best_match_index]:
-            #     name = known_face_names[best_match_index]
-
-            # Draw a box around the face
-            # cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
-
-            # # Draw a label with a name below the face
-            # cv2.rectangle(
-            #     frame, (left, bottom - 35), (right, bottom), color, cv2.FILLED
-            # )
-            # font = cv2.FONT_HERSHEY_DUPLEX
-            # cv2.putText(
-            #     frame, name, (left + 6, bottom - 6), font, 1.0, (255, 255, 255), 1
-            # )
+            else:
+                color = (0, 255, 0)  # color for unknown faces i.e green
+
+            cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
+            cv2.rectangle(frame, (left, bottom - 35), (right, bottom), color, cv2.FILLED)
+            font = cv2.FONT_HERSHEY_DUPLEX
+            cv2.putText(frame, name, (left + 6, bottom - 6), font, 1.0, (255, 255, 255), 1)
 
         # If an unknown face is detected and a region is selected, capture the selected area
         if name == "Unknown" and selected:
@@ -436,6 +390,7 @@ def detectWithWebcam(request):
                 cv2.imwrite("selected_area.jpg", roi)
                 print("Selected area saved as 'selected_area.jpg'")
                 selected = False
+                pipeline.stop()
                 video_capture.release()  # Release webcam resources
                 cv2.destroyAllWindows()  # Close OpenCV windows
                 return redirect("/add_citizen")
@@ -449,6 +404,7 @@ def detectWithWebcam(request):
             break
 
     # Release handle to the webcam
+    pipeline.stop()
     video_capture.release()
     cv2.destroyAllWindows()
 
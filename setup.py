@@ -37,6 +37,7 @@ setup(
     entry_points={
         'console_scripts': [
             'face_recognition=face_recognition.face_recognition_cli:main',
+            'face_recognition_cache=face_recognition.face_recognition_cli:build_cache',
             'face_detection=face_recognition.face_detection_cli:main'
         ]
     },